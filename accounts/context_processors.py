@@ -0,0 +1,6 @@
+from .profiles import get_profile
+
+
+def profile(request):
+    """``profile``, the logged-in user's Profile or None, queried only if a template uses it."""
+    return {'profile': lambda: get_profile(request)}
@@ -1,7 +1,9 @@
 # forms.py
 from django import forms
+from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.models import User
 from .models import Profile
+from .tasks import send_password_reset_email
 import re
 from django.core.exceptions import ValidationError
 
@@ -36,4 +38,24 @@ class ProfileForm(forms.ModelForm):
         if not (re.match(mobile_regex, phone_number)):
             raise ValidationError("Give Valid mobile number.")
             
-        return phone_number
\ No newline at end of file
+        return phone_number
+
+class QueuedPasswordResetForm(PasswordResetForm):
+    """Leaves rendering and sending the reset mail to a background job."""
+
+    # Rebuilt by the job, which makes its own token: none of it is queued.
+    context_fields = {'email', 'domain', 'site_name', 'uid', 'user', 'token', 'protocol'}
+
+    def send_mail(self, subject_template_name, email_template_name, context, from_email, to_email,
+                  html_email_template_name=None):
+        send_password_reset_email.enqueue(
+            user_id=context['user'].pk,
+            subject_template_name=subject_template_name,
+            email_template_name=email_template_name,
+            html_email_template_name=html_email_template_name,
+            from_email=from_email,
+            domain=context['domain'],
+            site_name=context['site_name'],
+            protocol=context['protocol'],
+            extra_context={key: value for key, value in context.items() if key not in self.context_fields},
+        )
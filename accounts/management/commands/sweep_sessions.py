@@ -0,0 +1,31 @@
+import time
+
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = ('Delete expired sessions from the database, a batch at a time. Run it periodically (e.g. from cron); '
+            'cached copies expire from the cache on their own.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of sessions deleted per DELETE statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        expired = Session.objects.using(options['database']).filter(expire_date__lt=timezone.now())
+        started = time.perf_counter()
+
+        deleted = 0
+        while True:
+            keys = list(expired.order_by().values_list('pk', flat=True)[:options['batch_size']])
+            if not keys:
+                break
+            # Each batch is its own statement, so a large sweep never holds one big write lock.
+            deleted += expired.filter(pk__in=keys).delete()[0]
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired sessions in {elapsed:.2f}s.'))
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 00:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_remove_profile_user_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='photo_renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
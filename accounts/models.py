@@ -3,17 +3,22 @@ from django.db import models
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils import timezone
+from classifieds.images import RenditionsMixin
 
 
-class Profile(models.Model):
+class Profile(RenditionsMixin, models.Model):
     user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     date_of_birth = models.DateField(blank=False, null=False)
     photo = models.ImageField(upload_to='users/%Y/%m/%d/', blank=True, null=True)
+    photo_renditions = models.JSONField(default=dict, blank=True, editable=False)
     phone_number = models.CharField(max_length=15, blank=False, null=False)
     address = models.TextField(blank=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    renditions_source = 'photo'
+    renditions_field = 'photo_renditions'
+
     def __str__(self):
         return f"{self.user.username} Profile"
     
@@ -0,0 +1,20 @@
+from .models import Profile
+
+
+def get_profile(request):
+    """
+    The logged-in user's Profile, or None, fetched at most once per request.
+    ``request.user.profile`` is filled in too, so code reaching the profile
+    through the user doesn't query it again.
+    """
+    if not hasattr(request, '_cached_profile'):
+        user = request.user
+        profile = None
+        if user.is_authenticated:
+            profile = Profile.objects.filter(user=user).first()
+            if profile is not None:
+                profile.user = user
+            # Cached even when missing: user.profile then raises without a query.
+            Profile.user.field.remote_field.set_cached_value(user, profile)
+        request._cached_profile = profile
+    return request._cached_profile
@@ -0,0 +1,33 @@
+from django.contrib.auth.models import User
+from django.contrib.auth.tokens import default_token_generator
+from django.core.mail import EmailMultiAlternatives
+from django.template import loader
+from django.utils.encoding import force_bytes
+from django.utils.http import urlsafe_base64_encode
+
+from jobs.queue import task
+
+
+@task
+def send_password_reset_email(user_id, subject_template_name, email_template_name, from_email,
+                              domain, site_name, protocol, html_email_template_name=None, extra_context=None):
+    # The token is made here rather than queued: job kwargs are kept and shown in the admin.
+    user = User.objects.filter(pk=user_id, is_active=True).first()
+    if user is None or not user.email:
+        return
+    context = {
+        'email': user.email,
+        'domain': domain,
+        'site_name': site_name,
+        'uid': urlsafe_base64_encode(force_bytes(user.pk)),
+        'user': user,
+        'token': default_token_generator.make_token(user),
+        'protocol': protocol,
+        **(extra_context or {}),
+    }
+    subject = ''.join(loader.render_to_string(subject_template_name, context).splitlines())
+    body = loader.render_to_string(email_template_name, context)
+    message = EmailMultiAlternatives(subject, body, from_email, [user.email])
+    if html_email_template_name:
+        message.attach_alternative(loader.render_to_string(html_email_template_name, context), 'text/html')
+    message.send()
@@ -1,4 +1,8 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from io import BytesIO
+from PIL import Image
+import tempfile
 from django.contrib.auth import get_user_model
 from .models import Profile
 from django.db import IntegrityError
@@ -9,6 +13,16 @@ from datetime import date, timedelta
 from django.urls import reverse
 from django.contrib.auth.models import User
 from .forms import UserRegistrationForm, ProfileForm
+from .profiles import get_profile
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
+import io
 
 User = get_user_model()
 
@@ -92,6 +106,123 @@ class ProfileModelTest(TestCase):
         self.assertNotEqual(original_updated_at, profile.updated_at)
 
 
+class ProfilePhotoRenditionTests(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(MEDIA_ROOT=self.media.name, IMAGE_RENDITIONS={'card': 40, 'detail': 100},
+                                            IMAGE_RENDITIONS_IN_BACKGROUND=False))
+        self.addCleanup(self.media.cleanup)
+        self.user = User.objects.create_user(username='testuser', password='password123')
+
+    def upload(self):
+        buffer = BytesIO()
+        Image.new('RGB', (60, 60), 'blue').save(buffer, 'JPEG')
+        return SimpleUploadedFile('me.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_photo_renditions_follow_the_photo(self):
+        profile = Profile.objects.create(user=self.user, date_of_birth=date(1990, 1, 1), phone_number='123',
+                                         address='Street', photo=self.upload())
+        self.assertEqual(profile.photo_renditions['card']['width'], 40)
+        self.assertEqual(profile.photo_renditions['detail']['width'], 60)
+        self.assertTrue(profile.rendition_url('card').endswith('-card.jpeg'))
+
+        profile.photo = None
+        profile.save()
+        self.assertEqual(Profile.objects.get(pk=profile.pk).photo_renditions, {})
+
+    def test_profile_without_photo_has_no_renditions(self):
+        profile = Profile.objects.create(user=self.user, date_of_birth=date(1990, 1, 1), phone_number='123',
+                                         address='Street')
+        self.assertEqual(profile.photo_renditions, {})
+        self.assertEqual(profile.rendition_url('card'), '')
+
+
+class ProfileAccessorTests(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(MEDIA_ROOT=self.media.name, IMAGE_RENDITIONS={'card': 40},
+                                            IMAGE_RENDITIONS_IN_BACKGROUND=False))
+        self.addCleanup(self.media.cleanup)
+        self.user = User.objects.create_user(username='testuser', password='password123')
+
+    def request(self, user):
+        request = RequestFactory().get('/')
+        request.user = user
+        return request
+
+    def create_profile(self, **fields):
+        return Profile.objects.create(user=self.user, date_of_birth=date(1990, 1, 1), phone_number='123',
+                                      address='Street', **fields)
+
+    def test_fetched_once_per_request(self):
+        profile = self.create_profile()
+        request = self.request(User.objects.get(pk=self.user.pk))
+
+        with self.assertNumQueries(1):
+            self.assertEqual(get_profile(request), profile)
+            self.assertIs(get_profile(request), get_profile(request))
+            self.assertIs(request.user.profile, get_profile(request))
+            self.assertIs(get_profile(request).user, request.user)
+
+    def test_missing_profile(self):
+        request = self.request(User.objects.get(pk=self.user.pk))
+
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_profile(request))
+            self.assertIsNone(get_profile(request))
+            with self.assertRaises(Profile.DoesNotExist):
+                request.user.profile
+
+    def test_anonymous(self):
+        with self.assertNumQueries(0):
+            self.assertIsNone(get_profile(self.request(AnonymousUser())))
+
+    def test_header_avatar(self):
+        buffer = BytesIO()
+        Image.new('RGB', (60, 60), 'blue').save(buffer, 'JPEG')
+        self.create_profile(photo=SimpleUploadedFile('me.jpg', buffer.getvalue(), content_type='image/jpeg'))
+        self.client.force_login(self.user)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('ads:home'))
+
+        self.assertContains(response, '-card.jpeg')
+        self.assertContains(response, 'w-8 h-8 mr-2 rounded-full')
+        self.assertEqual(sum('"accounts_profile"' in query['sql'] for query in queries), 1)
+
+
+class SessionTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='password123')
+
+    def test_sessions_are_read_from_the_cache(self):
+        self.assertEqual(settings.SESSION_ENGINE, 'django.contrib.sessions.backends.cached_db')
+        self.client.force_login(self.user)
+        self.assertTrue(Session.objects.filter(pk=self.client.session.session_key).exists())
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('password_change'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if 'django_session' in query['sql']])
+
+    def test_sweep_sessions(self):
+        for number in range(5):
+            session = SessionStore()
+            session['number'] = number
+            session.set_expiry(-60 if number < 3 else 60)
+            session.save()
+        output = io.StringIO()
+
+        call_command('sweep_sessions', batch_size=2, stdout=output)
+
+        self.assertEqual(Session.objects.count(), 2)
+        self.assertIn('Deleted 3 expired sessions', output.getvalue())
+
+
 class UserRegistrationTests(TestCase):
 
     def test_successful_registration(self):
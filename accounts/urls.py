@@ -1,7 +1,10 @@
 from django.urls import path, include
+from django.contrib.auth import views as auth_views
 from . import views
+from .forms import QueuedPasswordResetForm
 
 urlpatterns = [ 
+    path('password_reset/', auth_views.PasswordResetView.as_view(form_class=QueuedPasswordResetForm), name='password_reset'),
     path('', include('django.contrib.auth.urls')),
     path('register/', views.register, name ='register'),
     
@@ -0,0 +1,217 @@
+"""
+Search-as-you-type suggestions for the tags and locations of ads.
+
+``PrefixIndex`` keeps the distinct values of one field as a sorted list of
+normalized keys (case folded, whitespace collapsed, so "Bangalore " and
+"bangalore" are one value) with the number of ads using each. A lookup
+bisects to the first key with the prefix and takes the most used keys of
+that range. Results are memoized per prefix as the ranked keys, and a change
+to one value updates the memos of that value's own prefixes in place, so
+popular prefixes stay answered from memory while new tags come in.
+
+Each process keeps its own indexes (``get_source``), loaded once from the
+database. After that they only read what is new: at most every
+``AUTOCOMPLETE_REFRESH`` seconds a lookup first fetches the tag assignments
+and ads with a primary key above the highest one seen, an index range scan
+however large the tables. Deletions and location edits in this process are
+applied by the signals in ``ads.signals``; those made by other processes are
+picked up by a full reload every ``AUTOCOMPLETE_RELOAD`` seconds.
+"""
+import bisect
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Max
+from taggit.models import TaggedItem
+
+from .models import Ads
+
+MAX_RESULTS = 20
+MAX_MEMOS = 10000
+CATCH_UP_BATCH = 5000
+
+
+def normalize(value):
+    return ' '.join(value.split()).casefold()
+
+
+class PrefixIndex:
+
+    def __init__(self):
+        self.keys = []
+        # key -> [display value, count]
+        self.values = {}
+        self.memos = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def load(self, counts):
+        """Replace the contents with ``(value, count)`` pairs; the most used spelling of a key is shown."""
+        values = {}
+        for value, count in counts:
+            key = normalize(value)
+            if not key or count <= 0:
+                continue
+            entry = values.setdefault(key, [' '.join(value.split()), 0, 0])
+            if count > entry[2]:
+                entry[0], entry[2] = ' '.join(value.split()), count
+            entry[1] += count
+        with self.lock:
+            self.values = {key: entry[:2] for key, entry in values.items()}
+            self.keys = sorted(self.values)
+            self.memos = {}
+
+    def rank(self, key):
+        # Most used first, ties alphabetically.
+        return -self.values[key][1], key
+
+    def add(self, value, delta=1):
+        key = normalize(value)
+        if not key:
+            return
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                if delta <= 0:
+                    return
+                bisect.insort(self.keys, key)
+                entry = self.values[key] = [' '.join(value.split()), 0]
+            entry[1] += delta
+            if entry[1] <= 0:
+                del self.values[key]
+                del self.keys[bisect.bisect_left(self.keys, key)]
+            for end in range(1, len(key) + 1):
+                self.update_memo(key[:end], key, delta)
+
+    def update_memo(self, prefix, key, delta):
+        """Fix the memo of ``prefix`` after the count of ``key`` changed by ``delta``."""
+        best = self.memos.get(prefix)
+        if best is None:
+            return
+        if key not in best:
+            if delta < 0 or (len(best) == MAX_RESULTS and self.rank(key) > self.rank(best[-1])):
+                return
+            best.append(key)
+        elif delta < 0 and len(best) == MAX_RESULTS:
+            # A key outside the memo may now rank higher: find out on the next lookup.
+            del self.memos[prefix]
+            return
+        elif key not in self.values:
+            best.remove(key)
+        best.sort(key=self.rank)
+        del best[MAX_RESULTS:]
+
+    def lookup(self, prefix, limit=10):
+        """``[(value, count), ...]`` for the ``limit`` most used values starting with ``prefix``."""
+        key = normalize(prefix)
+        if not key:
+            return []
+        with self.lock:
+            best = self.memos.get(key)
+            if best is None:
+                start = bisect.bisect_left(self.keys, key)
+                end = bisect.bisect_left(self.keys, key + '\U0010ffff', start)
+                best = heapq.nsmallest(MAX_RESULTS, self.keys[start:end], key=self.rank)
+                if len(self.memos) >= MAX_MEMOS:
+                    self.memos = {}
+                self.memos[key] = best
+            return [tuple(self.values[item]) for item in best[:limit]]
+
+
+class Source:
+    """
+    A ``PrefixIndex`` over ``value_field`` of the rows of ``queryset``, kept up to date.
+
+    With ``id_field``, the foreign key ``value_field`` is read through, the
+    value of each id is remembered too, so a deleted row can be subtracted
+    without reading the related row again.
+    """
+
+    def __init__(self, queryset, value_field, id_field=None):
+        self.queryset = queryset
+        self.value_field = value_field
+        self.id_field = id_field
+        self.values = {}
+        self.index = PrefixIndex()
+        self.last_id = 0
+        self.loaded_at = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def fields(self):
+        return [self.id_field, self.value_field] if self.id_field else [self.value_field]
+
+    def lookup(self, prefix, limit=10):
+        self.refresh()
+        return self.index.lookup(prefix, limit)
+
+    def refresh(self):
+        now = time.monotonic()
+        with self.lock:
+            if self.loaded_at is None or now - self.loaded_at >= getattr(settings, 'AUTOCOMPLETE_RELOAD', 600):
+                self.reload()
+            elif now - self.refreshed_at >= getattr(settings, 'AUTOCOMPLETE_REFRESH', 5):
+                self.catch_up()
+            else:
+                return
+            self.refreshed_at = now
+
+    def reload(self):
+        rows = self.queryset.all()
+        last_id = rows.aggregate(last=Max('pk'))['last'] or 0
+        counts = list(rows.filter(pk__lte=last_id).order_by().values_list(*self.fields).annotate(count=Count('pk')))
+        if self.id_field:
+            self.values = {id: value for id, value, _ in counts}
+        self.index.load((row[-2], row[-1]) for row in counts)
+        self.last_id = last_id
+        self.loaded_at = time.monotonic()
+
+    def catch_up(self):
+        while True:
+            rows = list(self.queryset.filter(pk__gt=self.last_id).order_by('pk').values_list(
+                'pk', *self.fields
+            )[:CATCH_UP_BATCH])
+            for row in rows:
+                if self.id_field:
+                    self.values[row[1]] = row[2]
+                self.index.add(row[-1])
+            if rows:
+                self.last_id = rows[-1][0]
+            if len(rows) < CATCH_UP_BATCH:
+                return
+
+    def counted(self, pk):
+        """Whether the row ``pk`` is in the index, so deleting it must be subtracted."""
+        return self.loaded_at is not None and pk <= self.last_id
+
+    def value_of(self, id):
+        """The value read for ``id_field`` ``id``, ``None`` if no counted row has it."""
+        return self.values.get(id)
+
+
+def tag_source():
+    return Source(TaggedItem.objects.filter(content_type=ContentType.objects.get_for_model(Ads)), 'tag__name', 'tag_id')
+
+
+def location_source():
+    return Source(Ads.objects.all(), 'location')
+
+
+SOURCES = {'tags': tag_source, 'location': location_source}
+sources = {}
+
+
+def get_source(field):
+    if field not in sources:
+        sources[field] = SOURCES[field]()
+    return sources[field]
+
+
+def reset():
+    sources.clear()
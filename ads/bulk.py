@@ -0,0 +1,371 @@
+"""
+Bulk import and export of ads as CSV or JSON Lines, for ``manage.py
+import_ads`` and ``export_ads``.
+
+A record has the keys of ``FIELDS``. ``category`` is a category slug or
+name, ``user`` a username, ``tags`` and ``images`` are lists; in CSV, tags
+are written the way the ad form takes them (comma separated, quoted if
+needed) and image paths are separated by ``|``. Exports list images by
+their storage name, so importing with ``--image-root`` set to MEDIA_ROOT
+brings them back. ``id``, ``slug`` and ``created_at`` are exported for
+reference and ignored on import: imported ads get new ones.
+
+Both directions stream: records are read, checked and written a batch at a
+time, so memory stays flat whatever the size of the file.
+
+Imports go in with ``bulk_create``, which skips ``save()`` and the signals,
+so ``AdImporter`` does their work per batch instead: slugs come from
+``allocate_slugs``, and the search index and page cache are updated for the
+whole batch at once. Image renditions are left to ``manage.py
+build_renditions``, which builds them in parallel.
+"""
+import csv
+import json
+import os
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from taggit.models import Tag, TaggedItem
+from taggit.utils import edit_string_for_tags, parse_tags
+
+from classifieds.slugs import allocate_slugs
+from . import cache as page_cache
+from .models import AdImage, Ads, Category
+from .search import get_search_backend
+
+FIELDS = [
+    'id', 'slug', 'title', 'description', 'category', 'user', 'price', 'location', 'postal_code',
+    'contact_info', 'show_contact_info', 'event_start_date', 'event_end_date', 'tags', 'images', 'created_at',
+]
+FORMATS = ['csv', 'jsonl']
+IMAGE_SEPARATOR = '|'
+TRUE_VALUES = {'1', 'true', 'yes', 'y', 'on'}
+FALSE_VALUES = {'0', 'false', 'no', 'n', 'off'}
+
+
+def detect_format(path):
+    return 'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv'
+
+
+def read_records(file, format):
+    """Yield ``(line_number, record)``; a JSON line that can't be parsed yields a ValidationError as its record."""
+    if format == 'csv':
+        reader = csv.DictReader(file)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as error:
+            yield number, ValidationError(f'Invalid JSON: {error}')
+            continue
+        if not isinstance(record, dict):
+            record = ValidationError('Expected a JSON object.')
+        yield number, record
+
+
+class RecordWriter:
+
+    def __init__(self, file, format):
+        self.file = file
+        self.format = format
+        if format == 'csv':
+            self.writer = csv.DictWriter(file, FIELDS)
+            self.writer.writeheader()
+
+    def write(self, record):
+        if self.format == 'jsonl':
+            self.file.write(json.dumps(record, cls=DjangoJSONEncoder) + '\n')
+            return
+        self.writer.writerow({
+            **record,
+            'tags': edit_string_for_tags([Tag(name=name) for name in record['tags']]),
+            'images': IMAGE_SEPARATOR.join(record['images']),
+            'event_start_date': record['event_start_date'] and record['event_start_date'].isoformat(),
+            'event_end_date': record['event_end_date'] and record['event_end_date'].isoformat(),
+            'created_at': record['created_at'].isoformat(),
+        })
+
+
+def export_records(queryset, batch_size=1000):
+    """One record per ad of ``queryset``, fetched in primary key order a batch at a time."""
+    content_type = ContentType.objects.get_for_model(Ads)
+    rows = queryset.order_by('pk').values(
+        'id', 'slug', 'title', 'description', 'price', 'location', 'postal_code', 'contact_info',
+        'show_contact_info', 'event_start_date', 'event_end_date', 'created_at',
+        category_slug=F('category__slug'), username=F('user__username'),
+    )
+    last_id = 0
+    while True:
+        batch = list(rows.filter(pk__gt=last_id)[:batch_size])
+        if not batch:
+            return
+        ids = [row['id'] for row in batch]
+        tags = defaultdict(list)
+        for ad_id, name in TaggedItem.objects.filter(content_type=content_type, object_id__in=ids).order_by(
+            'pk'
+        ).values_list('object_id', 'tag__name'):
+            tags[ad_id].append(name)
+        images = defaultdict(list)
+        for ad_id, name in AdImage.objects.filter(ad_id__in=ids).order_by('pk').values_list('ad_id', 'image'):
+            images[ad_id].append(name)
+
+        for row in batch:
+            row['category'] = row.pop('category_slug')
+            row['user'] = row.pop('username')
+            row['tags'] = tags[row['id']]
+            row['images'] = images[row['id']]
+            yield {field: row[field] for field in FIELDS}
+        last_id = ids[-1]
+
+
+def text(record, field):
+    value = record.get(field)
+    return '' if value is None else str(value).strip()
+
+
+def parse_list(value, parse):
+    if value is None:
+        return []
+    items = value if isinstance(value, list) else parse(str(value))
+    return [str(item).strip() for item in items if str(item).strip()]
+
+
+def parse_boolean(value, default=True):
+    if isinstance(value, bool):
+        return value
+    value = '' if value is None else str(value).strip().lower()
+    if not value:
+        return default
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValidationError(f'Not a boolean: {value!r}.')
+
+
+def parse_moment(value):
+    value = '' if value is None else str(value).strip()
+    if not value:
+        return None
+    try:
+        moment = parse_datetime(value)
+        if moment is None:
+            day = parse_date(value)
+            moment = day and datetime.combine(day, time())
+    except ValueError:
+        moment = None
+    if moment is None:
+        raise ValidationError(f'Not a date: {value!r}.')
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def describe(error):
+    if hasattr(error, 'error_dict'):
+        return '; '.join(f'{field}: {" ".join(messages)}' for field, messages in error.message_dict.items())
+    return ' '.join(error.messages)
+
+
+class AdImporter:
+    """
+    Creates ads from records, ``batch_size`` at a time. Categories, users and
+    tags are looked up once and remembered; records that fail validation are
+    skipped and collected in ``errors`` as ``(line_number, message)``.
+    """
+
+    def __init__(self, user=None, create_categories=False, image_root=None, batch_size=1000):
+        self.default_user = user
+        self.create_categories = create_categories
+        self.image_root = image_root or os.getcwd()
+        self.batch_size = batch_size
+        self.content_type = ContentType.objects.get_for_model(Ads)
+        self.image_field = AdImage._meta.get_field('image')
+
+        self.categories = {}
+        self.category_slugs = {}
+        for pk, name, slug in Category.objects.values_list('pk', 'name', 'slug'):
+            self.remember_category(pk, name, slug)
+        self.users = {}
+        self.tags = {}
+        self.slugs = {}
+
+        self.read = 0
+        self.created = 0
+        self.images = 0
+        self.errors = []
+
+    def remember_category(self, pk, name, slug):
+        self.categories[name.lower()] = self.categories[slug] = pk
+        self.category_slugs[pk] = slug
+
+    def run(self, records, progress=None):
+        records = iter(records)
+        while True:
+            batch = list(islice(records, self.batch_size))
+            if not batch:
+                return
+            self.import_batch(batch)
+            if progress:
+                progress(self)
+
+    def import_batch(self, batch):
+        self.read += len(batch)
+        self.load_users(record for _, record in batch)
+
+        rows = []
+        for line, record in batch:
+            try:
+                if isinstance(record, ValidationError):
+                    raise record
+                rows.append(self.build(record))
+            except ValidationError as error:
+                self.errors.append((line, describe(error)))
+        if not rows:
+            return
+
+        ads = [ad for ad, _, _ in rows]
+        for fresh in (False, True):
+            for ad, slug in zip(ads, allocate_slugs(Ads, [ad.title for ad in ads], fresh=fresh, counters=self.slugs)):
+                ad.slug = slug
+            try:
+                with self.saving_files() as saved, transaction.atomic():
+                    Ads.objects.bulk_create(ads)
+                    self.attach(rows, saved)
+                break
+            except IntegrityError:
+                # A slug was taken meanwhile, or the cached counters were behind.
+                for ad in ads:
+                    ad.pk, ad._state.adding = None, True
+        else:
+            # Still clashing: let save() allocate the slugs one at a time.
+            for ad, tags, images in rows:
+                ad.slug = ''
+                with self.saving_files() as saved, transaction.atomic():
+                    ad.save()
+                    self.attach([(ad, tags, images)], saved)
+        self.created += len(rows)
+
+    def build(self, record):
+        """An unsaved ad from ``record``, with its tag names and image paths."""
+        ad = Ads(
+            title=text(record, 'title'),
+            description=text(record, 'description'),
+            location=text(record, 'location'),
+            postal_code=text(record, 'postal_code'),
+            contact_info=text(record, 'contact_info'),
+            show_contact_info=parse_boolean(record.get('show_contact_info')),
+            event_start_date=parse_moment(record.get('event_start_date')),
+            event_end_date=parse_moment(record.get('event_end_date')),
+            category_id=self.category(text(record, 'category')),
+            user_id=self.user(text(record, 'user')),
+        )
+        try:
+            ad.price = Decimal(text(record, 'price'))
+        except InvalidOperation:
+            raise ValidationError({'price': [f'Not a number: {text(record, "price")!r}.']})
+        ad.clean_fields(exclude=['slug', 'user', 'category'])
+        ad.clean()
+
+        tags = list(dict.fromkeys(parse_list(record.get('tags'), parse_tags)))
+        images = []
+        for path in parse_list(record.get('images'), lambda value: value.split(IMAGE_SEPARATOR)):
+            path = os.path.join(self.image_root, path)
+            if not os.path.isfile(path):
+                raise ValidationError({'images': [f'No such file: {path}.']})
+            images.append(path)
+        return ad, tags, images
+
+    def category(self, value):
+        if not value:
+            raise ValidationError({'category': ['This field cannot be blank.']})
+        pk = self.categories.get(value) or self.categories.get(value.lower())
+        if pk is None:
+            if not self.create_categories:
+                raise ValidationError({'category': [f'No such category: {value!r}.']})
+            category = Category.objects.create(name=value)
+            self.remember_category(category.pk, category.name, category.slug)
+            pk = category.pk
+        return pk
+
+    def load_users(self, records):
+        usernames = {text(record, 'user') for record in records if isinstance(record, dict)}
+        missing = usernames - set(self.users) - {''}
+        if missing:
+            self.users.update(User.objects.filter(username__in=missing).values_list('username', 'pk'))
+
+    def user(self, username):
+        if not username:
+            if self.default_user is None:
+                raise ValidationError({'user': ['This field cannot be blank.']})
+            return self.default_user.pk
+        if username not in self.users:
+            raise ValidationError({'user': [f'No such user: {username!r}.']})
+        return self.users[username]
+
+    def tag_ids(self, names):
+        missing = set(names) - set(self.tags)
+        if missing:
+            self.tags.update(Tag.objects.filter(name__in=missing).values_list('name', 'pk'))
+            for name in missing - set(self.tags):
+                # Tag.save() finds a free slug; new tags are few next to the ads.
+                self.tags[name] = Tag.objects.create(name=name).pk
+        return [self.tags[name] for name in names]
+
+    @contextmanager
+    def saving_files(self):
+        """
+        A list for the names of the images copied into storage in the block;
+        if the block fails, its rows are rolled back and those files deleted.
+        """
+        saved = []
+        try:
+            yield saved
+        except BaseException:
+            for name in saved:
+                self.image_field.storage.delete(name)
+            raise
+
+    def attach(self, rows, saved):
+        """
+        Tag, illustrate and index freshly inserted ads, and expire their
+        category pages. The names of the copied images are added to ``saved``.
+        """
+        self.tag_ids({name for _, tags, _ in rows for name in tags})
+        TaggedItem.objects.bulk_create([
+            TaggedItem(content_type=self.content_type, object_id=ad.pk, tag_id=self.tags[name])
+            for ad, tags, _ in rows
+            for name in tags
+        ])
+
+        images = []
+        for ad, _, paths in rows:
+            for path in paths:
+                image = AdImage(ad=ad)
+                with open(path, 'rb') as file:
+                    name = self.image_field.generate_filename(image, os.path.basename(path))
+                    image.image = self.image_field.storage.save(name, File(file))
+                saved.append(image.image.name)
+                images.append(image)
+        AdImage.objects.bulk_create(images)
+        self.images += len(images)
+
+        get_search_backend().index([ad.pk for ad, _, _ in rows])
+        page_cache.expire(*{f'category:{self.category_slugs[ad.category_id]}' for ad, _, _ in rows})
@@ -0,0 +1,118 @@
+"""
+Whole-page caching of the public ad pages for anonymous visitors.
+
+Every cached page depends on a few *scopes*: ``categories`` (the category
+list and names), ``category:<slug>`` (the ads of one category) and
+``ad:<slug>`` (one ad). Each scope has a version number stored in the cache;
+the page key includes the current versions of its scopes, so bumping a
+version from the signals in ``ads.signals`` makes every dependent page miss
+without having to know or delete its keys. Stale entries simply expire.
+
+Only anonymous GET requests are served from or stored in the cache: a
+logged-in user's page carries their like and edit state and is always
+rendered fresh.
+
+The versions have to live in a cache every worker shares (``CACHE_LOCATION``
+in settings); with several processes each keeping its own local memory
+cache, an edit would only expire the pages of the process that made it.
+``ADS_PAGE_CACHE_ENABLED`` is off in that case.
+
+A page rendered from a read replica may predate an edit that already bumped
+its versions, so it is only kept for ``REPLICA_PIN_SECONDS``.
+"""
+import hashlib
+import time
+from functools import partial
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from classifieds import replicas
+from classifieds.metrics import record_cache
+
+VERSION_PREFIX = 'ads:version:'
+PAGE_PREFIX = 'ads:page:'
+
+
+def get_cache():
+    return caches[getattr(settings, 'ADS_PAGE_CACHE', 'default')]
+
+
+def get_versions(scopes):
+    cache = get_cache()
+    keys = [VERSION_PREFIX + scope for scope in scopes]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # Start from the clock rather than 1, so a version lost to eviction
+            # never comes back as one an old page was stored under.
+            cache.add(key, time.time_ns(), None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def bump(*scopes):
+    cache = get_cache()
+    for scope in scopes:
+        key = VERSION_PREFIX + scope
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), None)
+
+
+def expire(*scopes):
+    """
+    Bump ``scopes`` now and again once the current transaction commits, so a
+    page rendered from the old rows in between can't stay cached.
+    """
+    bump(*scopes)
+    transaction.on_commit(partial(bump, *scopes))
+
+
+def page_key(request, scopes):
+    versions = '.'.join(str(version) for version in get_versions(scopes))
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'{PAGE_PREFIX}{path}:{versions}'
+
+
+def page_timeout():
+    timeout = getattr(settings, 'ADS_PAGE_CACHE_TIMEOUT', 300)
+    state = replicas.current.get()
+    if state is not None and state.replica is not None and not state.wrote:
+        # A replica may not have the edit whose bump this page's key already
+        # carries yet: keep the page no longer than the lag the pin allows for.
+        timeout = min(timeout, getattr(settings, 'REPLICA_PIN_SECONDS', 10))
+    return timeout
+
+
+class AnonymousPageCacheMixin:
+    """Serve the view's response from the page cache to anonymous visitors."""
+
+    def get_cache_scopes(self):
+        raise NotImplementedError
+
+    def dispatch(self, request, *args, **kwargs):
+        if (request.method != 'GET' or request.user.is_authenticated
+                or not getattr(settings, 'ADS_PAGE_CACHE_ENABLED', True)):
+            return super().dispatch(request, *args, **kwargs)
+
+        key = page_key(request, self.get_cache_scopes())
+        response = get_cache().get(key)
+        record_cache(response is not None)
+        if response is not None:
+            return response
+
+        response = super().dispatch(request, *args, **kwargs)
+
+        def store(response):
+            # A page that handed out a CSRF token or set a cookie is not generic.
+            if response.status_code == 200 and not response.cookies and not request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+                get_cache().set(key, response, page_timeout())
+            return response
+
+        if hasattr(response, 'add_post_render_callback') and not response.is_rendered:
+            response.add_post_render_callback(store)
+        else:
+            store(response)
+        return response
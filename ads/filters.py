@@ -0,0 +1,149 @@
+"""
+Query-string filters and facet counts for ad listings.
+
+Filters are plain ``AdFilterForm`` fields so bad input is ignored rather than
+erroring the page. Facet counts are computed for the current filter set with
+one aggregate query each; the price and location facets ignore their own
+filter so a buyer can still see and switch to the other ranges and places.
+"""
+import datetime
+from decimal import Decimal
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, Q
+from django.utils import timezone
+from taggit.models import TaggedItem
+
+from .forms import AdFilterForm
+from .models import Ads
+
+
+PRICE_BUCKETS = [
+    (None, 1000),
+    (1000, 5000),
+    (5000, 20000),
+    (20000, 100000),
+    (100000, None),
+]
+# Prices have two decimal places: a bucket link asks for at most this much
+# under the bucket's upper bound, as the bound itself belongs to the next one.
+PRICE_STEP = Decimal('0.01')
+TOP_FACETS = 10
+
+
+class AdFilter:
+
+    def __init__(self, data, queryset):
+        self.data = data
+        self.queryset = queryset
+        self.form = AdFilterForm(data)
+        self.cleaned_data = self.form.cleaned_data if self.form.is_valid() else {}
+
+    @property
+    def is_active(self):
+        return any(value not in (None, '', []) for value in self.cleaned_data.values())
+
+    @property
+    def qs(self):
+        return self.filter_queryset(self.queryset)
+
+    def filter_queryset(self, queryset, exclude=()):
+        data = {key: value for key, value in self.cleaned_data.items() if key not in exclude}
+
+        if data.get('min_price') is not None:
+            queryset = queryset.filter(price__gte=data['min_price'])
+        if data.get('max_price') is not None:
+            queryset = queryset.filter(price__lte=data['max_price'])
+        if data.get('postal_code'):
+            queryset = queryset.filter(postal_code__startswith=data['postal_code'].strip())
+        if data.get('location'):
+            queryset = queryset.filter(location__iexact=data['location'].strip())
+        for tag in data.get('tags', []):
+            queryset = queryset.filter(tags__name__iexact=tag)
+        if data.get('event_from'):
+            queryset = queryset.filter(event_start_date__gte=self._day_start(data['event_from']))
+        if data.get('event_to'):
+            queryset = queryset.filter(
+                event_start_date__lt=self._day_start(data['event_to'] + datetime.timedelta(days=1))
+            )
+        return queryset
+
+    def facets(self):
+        return {
+            'prices': self.price_facets(),
+            'tags': self.tag_facets(),
+            'locations': self.location_facets(),
+        }
+
+    def price_facets(self):
+        queryset = self.filter_queryset(self.queryset, exclude=('min_price', 'max_price'))
+        aggregates = {}
+        for index, (low, high) in enumerate(PRICE_BUCKETS):
+            condition = Q()
+            if low is not None:
+                condition &= Q(price__gte=low)
+            if high is not None:
+                condition &= Q(price__lt=high)
+            aggregates[f'bucket_{index}'] = Count('pk', filter=condition)
+        counts = queryset.order_by().aggregate(**aggregates)
+
+        return [
+            {
+                'low': low,
+                'high': high,
+                'count': counts[f'bucket_{index}'],
+                'querystring': self.querystring(min_price=low, max_price=None if high is None else high - PRICE_STEP),
+            }
+            for index, (low, high) in enumerate(PRICE_BUCKETS)
+        ]
+
+    def tag_facets(self):
+        content_type = ContentType.objects.get_for_model(Ads)
+        selected = {tag.lower() for tag in self.cleaned_data.get('tags', [])}
+        rows = (
+            TaggedItem.objects
+            .filter(content_type=content_type, object_id__in=self.qs.order_by().values('pk'))
+            .values('tag__name')
+            .annotate(count=Count('pk'))
+            .order_by('-count', 'tag__name')[:TOP_FACETS + len(selected)]
+        )
+        facets = []
+        for row in rows:
+            if row['tag__name'].lower() in selected:
+                continue
+            tags = self.cleaned_data.get('tags', []) + [row['tag__name']]
+            facets.append({
+                'name': row['tag__name'],
+                'count': row['count'],
+                'querystring': self.querystring(tags=', '.join(tags)),
+            })
+        return facets[:TOP_FACETS]
+
+    def location_facets(self):
+        queryset = self.filter_queryset(self.queryset, exclude=('location',))
+        rows = (
+            queryset.order_by()
+            .values('location')
+            .annotate(count=Count('pk'))
+            .order_by('-count', 'location')[:TOP_FACETS]
+        )
+        return [
+            {'name': row['location'], 'count': row['count'], 'querystring': self.querystring(location=row['location'])}
+            for row in rows
+        ]
+
+    def querystring(self, **changes):
+        """The current query string with ``changes`` applied and any page cursor dropped."""
+        params = self.data.copy()
+        for key in ('cursor', 'page'):
+            params.pop(key, None)
+        for key, value in changes.items():
+            if value is None or value == '':
+                params.pop(key, None)
+            else:
+                params[key] = str(value)
+        return params.urlencode()
+
+    @staticmethod
+    def _day_start(day):
+        return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
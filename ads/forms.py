@@ -20,7 +20,6 @@ class AdsForm(forms.ModelForm):
 
     def clean_contact_info(self):
             contact_info = self.cleaned_data.get('contact_info')
-            print('contact_info')
             email_regex = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
             mobile_regex = r'^\d{10}$'
             
@@ -30,6 +29,31 @@ class AdsForm(forms.ModelForm):
             return contact_info
 
 
+class AdFilterForm(forms.Form):
+    min_price = forms.DecimalField(required=False, min_value=0, decimal_places=2)
+    max_price = forms.DecimalField(required=False, min_value=0, decimal_places=2)
+    postal_code = forms.CharField(required=False, max_length=10)
+    location = forms.CharField(required=False, max_length=255)
+    tags = forms.CharField(required=False)
+    event_from = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+    event_to = forms.DateField(required=False, widget=forms.DateInput(attrs={'type': 'date'}))
+
+    def clean_tags(self):
+        tags = self.cleaned_data.get('tags') or ''
+        return [tag.strip() for tag in tags.split(',') if tag.strip()]
+
+    def clean(self):
+        cleaned_data = super().clean()
+        min_price, max_price = cleaned_data.get('min_price'), cleaned_data.get('max_price')
+        if min_price is not None and max_price is not None and max_price < min_price:
+            raise ValidationError("Maximum price must be greater than the minimum price.")
+
+        event_from, event_to = cleaned_data.get('event_from'), cleaned_data.get('event_to')
+        if event_from and event_to and event_to < event_from:
+            raise ValidationError("The event window must end after it starts.")
+        return cleaned_data
+
+
 class AdImageForm(forms.ModelForm):
     class Meta:
         model= AdImage
@@ -0,0 +1,74 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from accounts.models import Profile
+from ads.models import AdImage
+from classifieds.images import render
+
+
+def setup_worker():
+    # Spawned workers start from a bare interpreter; forked ones are already set up.
+    if not apps.ready:
+        django.setup()
+
+
+def render_batch(sources):
+    # Runs in a worker: only reads and writes files, never the database.
+    return [render(source, default_storage) for source in sources]
+
+
+class Command(BaseCommand):
+    help = 'Generate missing image renditions for ad images and profile photos, in parallel worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Number of worker processes (default: one per CPU).')
+        parser.add_argument('--batch-size', type=int, default=20,
+                            help='Number of images handed to a worker at a time.')
+        parser.add_argument('--force', action='store_true',
+                            help='Rebuild renditions that are already up to date.')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        workers = options['workers'] or os.cpu_count() or 1
+        total = 0
+        with ProcessPoolExecutor(max_workers=workers, initializer=setup_worker) as pool:
+            for model in (AdImage, Profile):
+                count = self.build(pool, model, options['batch_size'], options['force'], workers)
+                self.stdout.write(f'{model._meta.verbose_name_plural}: {count} rebuilt')
+                total += count
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Built renditions for {total} images in {elapsed:.2f}s.'))
+
+    def build(self, pool, model, batch_size, force, workers):
+        source, field = model.renditions_source, model.renditions_field
+        images = model.objects.exclude(**{source: ''}).exclude(**{f'{source}__isnull': True})
+        images = images.only('pk', source, field).order_by('pk')
+
+        count = 0
+        pending = []
+        # Hand the pool a few batches per worker at a time, so memory stays flat on large trees.
+        for obj in images.iterator(chunk_size=batch_size * workers):
+            if force or obj.renditions_stale():
+                pending.append(obj)
+            if len(pending) == batch_size * workers:
+                count += self.render(pool, model, pending, batch_size)
+                pending = []
+        return count + self.render(pool, model, pending, batch_size)
+
+    def render(self, pool, model, objects, batch_size):
+        field = model.renditions_field
+        batches = [objects[i:i + batch_size] for i in range(0, len(objects), batch_size)]
+        sources = [[obj.source_file().name for obj in batch] for batch in batches]
+
+        for batch, renditions in zip(batches, pool.map(render_batch, sources)):
+            for obj, rendition in zip(batch, renditions):
+                setattr(obj, field, rendition)
+            model.objects.bulk_update(batch, [field])
+        return len(objects)
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from ads.bulk import FORMATS, RecordWriter, detect_format, export_records
+from ads.models import Ads
+
+
+class Command(BaseCommand):
+    help = 'Export ads to a CSV or JSON Lines file, streamed in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to write, or '-' for standard output.")
+        parser.add_argument('--format', choices=FORMATS,
+                            help='File format (default: from the extension, CSV unless .jsonl or .ndjson).')
+        parser.add_argument('--category',
+                            help='Only export the ads of the category with this slug.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of ads fetched per query.')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format'] or detect_format(path)
+        ads = Ads.objects.all()
+        if options['category']:
+            ads = ads.filter(category__slug=options['category'])
+        started = time.perf_counter()
+
+        try:
+            file = self.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError(error)
+        total = 0
+        try:
+            writer = RecordWriter(file, format)
+            for record in export_records(ads, options['batch_size']):
+                writer.write(record)
+                total += 1
+        finally:
+            if file is not self.stdout:
+                file.close()
+
+        elapsed = time.perf_counter() - started
+        rate = total / elapsed if elapsed else 0
+        # Keep standard output for the records when exporting there.
+        report = self.stderr if path == '-' else self.stdout
+        report.write(self.style.SUCCESS(f'Exported {total} ads in {elapsed:.2f}s ({rate:.0f} ads/s).'))
@@ -0,0 +1,20 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from ads.models import LikeCounterShard
+
+
+class Command(BaseCommand):
+    help = 'Fold buffered like deltas into Ads.total_likes. Run it periodically when ADS_LIKE_COUNTER is "buffered".'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of shard rows folded per transaction.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        updated = LikeCounterShard.objects.using(options['database']).flush(batch_size=options['batch_size'])
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(f'Flushed pending likes of {updated} ads in {elapsed:.2f}s.'))
@@ -0,0 +1,61 @@
+import sys
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from ads.bulk import FORMATS, AdImporter, detect_format, read_records
+
+
+class Command(BaseCommand):
+    help = 'Import ads from a CSV or JSON Lines file, streamed and inserted in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import, or '-' for standard input.")
+        parser.add_argument('--format', choices=FORMATS,
+                            help='File format (default: from the extension, CSV unless .jsonl or .ndjson).')
+        parser.add_argument('--user',
+                            help='Username of the seller for records without a user column.')
+        parser.add_argument('--create-categories', action='store_true',
+                            help='Create categories that do not exist yet instead of skipping their ads.')
+        parser.add_argument('--image-root',
+                            help='Directory relative image paths are resolved against (default: the current one).')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of ads inserted per transaction.')
+
+    def handle(self, *args, **options):
+        user = None
+        if options['user']:
+            user = User.objects.filter(username=options['user']).first()
+            if user is None:
+                raise CommandError(f"No such user: {options['user']!r}.")
+
+        path = options['path']
+        format = options['format'] or detect_format(path)
+        importer = AdImporter(
+            user=user, create_categories=options['create_categories'],
+            image_root=options['image_root'], batch_size=options['batch_size'],
+        )
+        started = time.perf_counter()
+
+        def progress(importer):
+            if options['verbosity'] > 1:
+                elapsed = time.perf_counter() - started
+                self.stdout.write(f'{importer.created} ads imported, {importer.read} read, {elapsed:.1f}s')
+
+        try:
+            file = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as error:
+            raise CommandError(error)
+        with file:
+            importer.run(read_records(file, format), progress)
+
+        for line, message in importer.errors:
+            self.stderr.write(f'Line {line}: {message}')
+        elapsed = time.perf_counter() - started
+        rate = importer.created / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {importer.created} ads and {importer.images} images in {elapsed:.2f}s ({rate:.0f} ads/s); '
+            f'skipped {len(importer.errors)} invalid records.'
+        ))
+        if importer.images:
+            self.stdout.write('Run `manage.py build_renditions` to build the renditions of the imported images.')
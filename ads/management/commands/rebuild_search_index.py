@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+from ads.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of all ads in bulk.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of ads reindexed per statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        backend = get_search_backend(options['database'])
+        started = time.perf_counter()
+
+        with transaction.atomic(using=options['database']):
+            total = backend.rebuild(batch_size=options['batch_size'])
+
+        elapsed = time.perf_counter() - started
+        rate = total / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Indexed {total} ads with {type(backend).__name__} in {elapsed:.2f}s ({rate:.0f} ads/s).'
+        ))
@@ -0,0 +1,39 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+from ads.models import Ads, LikeCounterShard
+
+
+class Command(BaseCommand):
+    help = 'Recompute the total_likes counter of every ad from its likes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Number of ads reconciled per UPDATE statement.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS)
+
+    def handle(self, *args, **options):
+        ads = Ads.objects.using(options['database']).order_by()
+        batch_size = options['batch_size']
+        started = time.perf_counter()
+
+        # Buffered deltas would be counted twice once the counters are exact.
+        LikeCounterShard.objects.using(options['database']).flush()
+
+        fixed = 0
+        checked = 0
+        last_id = 0
+        while True:
+            ids = list(ads.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not ids:
+                break
+            # Each batch is its own statement, so a long run never holds one big write lock.
+            fixed += ads.filter(pk__gte=ids[0], pk__lte=ids[-1]).reconcile_likes()
+            checked += len(ids)
+            last_id = ids[-1]
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Checked {checked} ads in {elapsed:.2f}s, corrected {fixed} like counters.'
+        ))
@@ -0,0 +1,328 @@
+import json
+import statistics
+import time
+from contextlib import contextmanager
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urljoin
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, get_resolver, reverse
+from ads.models import Ads, Category
+from chat.models import Chat, ChatInbox, Message
+from classifieds.bench import summary
+
+# The URL names the benchmark has to cover; a new view without a scenario is
+# reported under "uncovered".
+BENCHED_NAMESPACES = {'ads': 'ads.urls', 'chat': 'chat.urls', None: 'accounts.urls'}
+# Streams and long polls hold the request open by design.
+SKIPPED = {
+    'chat:notification_stream': 'Server-Sent Events stream, open until CHAT_SSE_TIMEOUT',
+    'chat:conversation_events': 'long poll, open until CHAT_LONG_POLL_TIMEOUT',
+    'chat:delete_message': 'POST only (from the conversation page), and it deletes the message',
+}
+
+
+def url_names(patterns, namespace=None):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from url_names(pattern.url_patterns, pattern.namespace or namespace)
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            yield f'{namespace}:{pattern.name}' if namespace else pattern.name
+
+
+class Scenario:
+    """
+    One URL to time. A scenario that writes has a ``checkpoint``: called
+    before its run, it returns a function that puts the data back.
+    """
+
+    def __init__(self, name, path, login=False, method='GET', data=None, label=None, checkpoint=None):
+        self.name = name
+        self.label = label or name + (' [logged in]' if login else '')
+        self.path = path
+        self.login = login
+        self.method = method
+        self.data = data or {}
+        self.checkpoint = checkpoint
+
+    @property
+    def writes(self):
+        return self.checkpoint is not None
+
+
+class TestClientDriver:
+    """Requests through Django's test client, in this process, counting queries."""
+
+    def __init__(self, username, password):
+        # Errors count as 500s in the report instead of stopping the run.
+        self.anonymous = Client(raise_request_exception=False, HTTP_HOST=self.host())
+        self.user = Client(raise_request_exception=False, HTTP_HOST=self.host())
+        if not self.user.login(username=username, password=password):
+            raise CommandError(f'Could not log in as {username!r}; check --user and --password.')
+
+    def host(self):
+        return next((host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost')
+
+    @contextmanager
+    def isolated(self, scenario):
+        """Roll back what a scenario that writes changed, so the ones after it see the same data."""
+        if not scenario.writes:
+            yield
+            return
+        with transaction.atomic():
+            yield
+            transaction.set_rollback(True)
+
+    def request(self, scenario):
+        client = self.user if scenario.login else self.anonymous
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(client, scenario.method.lower())(scenario.path, scenario.data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        return response.status_code, len(queries)
+
+
+class NoRedirect(HTTPRedirectHandler):
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HTTPDriver:
+    """Requests over HTTP to a running server (gunicorn, runserver); queries are not counted."""
+
+    def __init__(self, base_url, username, password):
+        self.base_url = base_url
+        self.anonymous = self.opener()
+        self.user = self.opener()
+        login = reverse('login')
+        self.fetch(self.user, 'GET', login)
+        status = self.fetch(self.user, 'POST', login, {'username': username, 'password': password})
+        if status != 302:
+            raise CommandError(f'Could not log in as {username!r} at {base_url}.')
+
+    def opener(self):
+        return build_opener(NoRedirect, HTTPCookieProcessor(CookieJar()))
+
+    def csrf_token(self, opener):
+        jar = next(handler.cookiejar for handler in opener.handlers if isinstance(handler, HTTPCookieProcessor))
+        return next((cookie.value for cookie in jar if cookie.name == settings.CSRF_COOKIE_NAME), '')
+
+    def fetch(self, opener, method, path, data=None):
+        url = urljoin(self.base_url, path)
+        body = None
+        headers = {}
+        if method == 'GET' and data:
+            url += '?' + urlencode(data)
+        elif method == 'POST':
+            if not self.csrf_token(opener):
+                # Sets the CSRF cookie.
+                self.fetch(opener, 'GET', reverse('login'))
+            body = urlencode(data or {}).encode()
+            headers = {'X-CSRFToken': self.csrf_token(opener), 'Referer': url}
+        try:
+            with opener.open(Request(url, data=body, method=method, headers=headers)) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+    @contextmanager
+    def isolated(self, scenario):
+        """Undo what a scenario that writes changed, through the database the server uses too."""
+        restore = scenario.checkpoint() if scenario.writes else None
+        try:
+            yield
+        finally:
+            if restore is not None:
+                restore()
+
+    def request(self, scenario):
+        opener = self.user if scenario.login else self.anonymous
+        return self.fetch(opener, scenario.method, scenario.path, scenario.data), None
+
+
+class Command(BaseCommand):
+    help = ('Time every page of the ads, chat and accounts apps against the current database (fill it with '
+            'seed_bench) and print p50/p95/p99 latency and queries per request as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per URL.')
+        parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per URL first.')
+        parser.add_argument('--base-url',
+                            help='Benchmark a running server at this URL (e.g. http://127.0.0.1:8000/) '
+                                 'instead of the test client.')
+        parser.add_argument('--user', default='bench-0',
+                            help='User to log in as; they need an ad and a chat with messages.')
+        parser.add_argument('--password', default='bench-password')
+        parser.add_argument('--only', help='Only URL names containing this text.')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of standard output.')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(username=options['user']).first()
+        if user is None:
+            raise CommandError(f"No such user: {options['user']!r}; run seed_bench first.")
+        scenarios = self.scenarios(user)
+        if options['only']:
+            scenarios = [scenario for scenario in scenarios if options['only'] in scenario.name]
+
+        if options['base_url']:
+            driver = HTTPDriver(options['base_url'], user.username, options['password'])
+        else:
+            driver = TestClientDriver(user.username, options['password'])
+
+        results = {}
+        for scenario in scenarios:
+            results[scenario.label] = self.measure(driver, scenario, options['requests'], options['warmup'])
+            if options['verbosity'] > 1:
+                self.stderr.write(f"{scenario.label}: p95 {results[scenario.label]['p95_ms']}ms")
+
+        covered = {scenario.name for scenario in scenarios} | set(SKIPPED)
+        report = {
+            'mode': 'http' if options['base_url'] else 'test_client',
+            'database': connection.vendor,
+            'ads': Ads.objects.count(),
+            'requests_per_url': options['requests'],
+            'results': results,
+            'skipped': SKIPPED,
+            'uncovered': sorted(self.url_names() - covered) if not options['only'] else [],
+        }
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def url_names(self):
+        names = set()
+        for namespace, urlconf in BENCHED_NAMESPACES.items():
+            names |= set(url_names(get_resolver(urlconf).url_patterns, namespace))
+        return names
+
+    def measure(self, driver, scenario, requests, warmup):
+        samples, statuses, queries = [], {}, []
+        with driver.isolated(scenario):
+            for _ in range(warmup):
+                driver.request(scenario)
+            for _ in range(requests):
+                started = time.perf_counter()
+                status, count = driver.request(scenario)
+                samples.append((time.perf_counter() - started) * 1000)
+                statuses[status] = statuses.get(status, 0) + 1
+                if count is not None:
+                    queries.append(count)
+        return {
+            'method': scenario.method,
+            'path': scenario.path,
+            'status': statuses,
+            **summary(samples),
+            'queries': round(statistics.mean(queries), 1) if queries else None,
+        }
+
+    def scenarios(self, user):
+        ad = Ads.objects.filter(user=user).select_related('category').order_by('pk').first()
+        chat = Chat.objects.filter(users=user).order_by('-last_message_at', 'pk').first()
+        if ad is None or chat is None:
+            raise CommandError(f'{user.username} needs an ad and a chat; run seed_bench first.')
+        other = Ads.objects.exclude(user=user).select_related('category').order_by('-pk').first() or ad
+        category = Category.objects.filter(pk=other.category_id).first()
+        messages = Message.objects.filter(chat=chat).order_by('-created_on', '-id')
+        own_message = messages.filter(sender=user).first()
+        newest = messages.first()
+        older = messages[min(chat.messages.count() - 1, 20)] if newest else None
+        ad_args = [ad.category.slug, ad.slug]
+        search = ad.title.split()[0]
+
+        scenarios = []
+        for login in (False, True):
+            scenarios += [
+                Scenario('ads:home', reverse('ads:home'), login),
+                Scenario('ads:ads_by_category', reverse('ads:ads_by_category', args=[category.slug]), login),
+                Scenario('ads:ad_detail', reverse('ads:ad_detail', args=[other.category.slug, other.slug]), login),
+                Scenario('ads:search', reverse('ads:search'), login, data={'q': search}),
+            ]
+        scenarios += [
+            Scenario('ads:autocomplete', reverse('ads:autocomplete', args=['tags']), data={'q': search[:2]}),
+            Scenario('ads:ad_create', reverse('ads:ad_create'), True),
+            Scenario('ads:ad_edit', reverse('ads:ad_edit', args=ad_args), True),
+            Scenario('ads:ad_delete', reverse('ads:ad_delete', args=ad_args), True),
+
+            Scenario('chat:conversation_list', reverse('chat:conversation_list'), True),
+            Scenario('chat:unread_counts', reverse('chat:unread_counts'), True),
+            Scenario('chat:conversation_detail', reverse('chat:conversation_detail', args=[chat.pk]), True),
+            Scenario('chat:older_messages', reverse('chat:older_messages', args=[chat.pk]), True,
+                     data={'before': older.pk if older else 0}),
+            Scenario('chat:new_messages', reverse('chat:new_messages', args=[chat.pk]), True,
+                     data={'after': newest.pk if newest else 0}),
+            Scenario('chat:edit_message', reverse('chat:edit_message', args=[chat.pk, own_message.pk if own_message else 0]), True),
+
+            Scenario('login', reverse('login')),
+            Scenario('register', reverse('register')),
+            Scenario('password_reset', reverse('password_reset')),
+            Scenario('password_reset_done', reverse('password_reset_done')),
+            Scenario('password_reset_confirm', reverse('password_reset_confirm', args=['MQ', 'set-password'])),
+            Scenario('password_reset_complete', reverse('password_reset_complete')),
+            Scenario('password_change', reverse('password_change'), True),
+            Scenario('password_change_done', reverse('password_change_done'), True),
+        ]
+        # The writes go after the reads, and each is undone after its run.
+        scenarios += [
+            Scenario('ads:ad_like', reverse('ads:ad_like', args=[other.category.slug, other.slug]), True, 'POST',
+                     checkpoint=lambda: self.like_checkpoint(other, user)),
+            Scenario('ads:toggle_contact_info', reverse('ads:toggle_contact_info', args=ad_args), True, 'POST',
+                     data={'show_contact_info': str(ad.show_contact_info)},
+                     checkpoint=lambda: self.contact_info_checkpoint(ad)),
+            Scenario('chat:mark_read', reverse('chat:mark_read', args=[chat.pk]), True, 'POST',
+                     data={'message_id': newest.pk if newest else 0},
+                     checkpoint=lambda: self.inbox_checkpoint(chat, user)),
+            Scenario('chat:send_message', reverse('chat:send_message', args=[chat.pk]), True, 'POST',
+                     data={'message': 'Is this still available?'},
+                     checkpoint=lambda: self.messages_checkpoint(chat, user)),
+        ]
+        # Logging out ends the session the other scenarios use, so it goes last.
+        scenarios.append(Scenario('logout', reverse('logout'), True, 'POST'))
+        return scenarios
+
+    def like_checkpoint(self, ad, user):
+        liked = ad.users_like.filter(pk=user.pk).exists()
+
+        def restore():
+            if ad.users_like.filter(pk=user.pk).exists() != liked:
+                ad.toggle_like(user)
+        return restore
+
+    def contact_info_checkpoint(self, ad):
+        shown = Ads.objects.get(pk=ad.pk).show_contact_info
+
+        def restore():
+            ad.refresh_from_db()
+            ad.show_contact_info = shown
+            ad.save()
+        return restore
+
+    def inbox_checkpoint(self, chat, user):
+        inbox = ChatInbox.objects.filter(chat=chat, user=user)
+        saved = inbox.values('last_read_message_id', 'unread_count').first()
+
+        def restore():
+            if saved:
+                inbox.update(**saved)
+        return restore
+
+    def messages_checkpoint(self, chat, user):
+        last_id = chat.messages.order_by('-id').values_list('id', flat=True).first() or 0
+        inbox = self.inbox_checkpoint(chat, user)
+
+        def restore():
+            chat.messages.filter(id__gt=last_id).delete()
+            # Sending marks the chat read for the sender.
+            inbox()
+        return restore
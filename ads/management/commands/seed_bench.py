@@ -0,0 +1,224 @@
+import random
+import time
+from io import BytesIO
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from PIL import Image
+from taggit.models import Tag, TaggedItem
+from ads.models import AdImage, Ads, Category
+from ads.search import get_search_backend
+from chat.models import Chat, ChatInbox, Message
+from classifieds.slugs import allocate_slugs
+
+WORDS = (
+    'bike car flat house sofa table phone laptop guitar piano camera lens watch shoes jacket bed '
+    'desk chair cooler fridge washer scooter helmet tent drone printer monitor keyboard speaker '
+    'vintage new used mint rare cheap premium compact large spacious wooden leather electric manual '
+    'blue red black white silver gold green family student office garden kitchen travel sports'
+).split()
+CATEGORIES = [
+    'Electronics', 'Furniture', 'Vehicles', 'Real Estate', 'Fashion', 'Sports', 'Music', 'Books',
+    'Home Appliances', 'Jobs', 'Services', 'Pets', 'Kids', 'Garden', 'Events', 'Tools',
+]
+LOCATIONS = ['Bengaluru', 'Chennai', 'Mumbai', 'Delhi', 'Hyderabad', 'Pune', 'Kolkata', 'Kochi', 'Jaipur', 'Mysuru']
+REPLIES = [
+    'Is this still available?', 'Yes, it is.', 'What is your best price?', 'Can you do {price}?',
+    'Where can I pick it up?', 'Does it come with the original box?', 'I can come by tomorrow evening.',
+    'Sounds good, see you then.', 'Could you send a few more photos?', 'Sure, sending them now.',
+]
+COLORS = ['#c0392b', '#2980b9', '#27ae60', '#8e44ad', '#f39c12', '#16a085', '#7f8c8d', '#2c3e50']
+
+
+class Command(BaseCommand):
+    help = ('Fill the database with synthetic users, categories, ads with tags, images and likes, and '
+            'chats with long message histories, for benchmarks (see run_bench).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--categories', type=int, default=len(CATEGORIES))
+        parser.add_argument('--ads', type=int, default=100_000)
+        parser.add_argument('--max-tags', type=int, default=4, help='Tags per ad, up to.')
+        parser.add_argument('--max-images', type=int, default=3, help='Images per ad, up to.')
+        parser.add_argument('--max-likes', type=int, default=5, help='Likes per ad, up to.')
+        parser.add_argument('--chats', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=200, help='Messages per chat.')
+        parser.add_argument('--prefix', default='bench',
+                            help='Prefix of the generated usernames; the first user is "<prefix>-0".')
+        parser.add_argument('--password', default='bench-password',
+                            help='Password of every generated user.')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Number of rows inserted per transaction.')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        if User.objects.filter(username__startswith=f"{options['prefix']}-").exists():
+            raise CommandError(f"Users named {options['prefix']}-* already exist; pick another --prefix.")
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+        started = time.perf_counter()
+
+        users = self.step('users', self.create_users, options['prefix'], options['users'], options['password'])
+        categories = self.step('categories', self.create_categories, options['categories'])
+        ads = self.step('ads', self.create_ads, options['ads'], users, categories,
+                        options['max_tags'], options['max_images'], options['max_likes'])
+        chats = self.step('chats', self.create_chats, options['chats'], options['messages'], ads)
+        self.step('search index', lambda: get_search_backend().rebuild())
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Seeded {len(users)} users, {len(categories)} categories, {len(ads)} ads and '
+            f"{chats} chats in {elapsed:.2f}s. Log in as {options['prefix']}-0 / {options['password']}."
+        ))
+
+    def step(self, name, function, *args):
+        started = time.perf_counter()
+        result = function(*args)
+        if self.verbosity > 1:
+            self.stdout.write(f'{name}: {time.perf_counter() - started:.2f}s')
+        return result
+
+    def batches(self, total):
+        for start in range(0, total, self.batch_size):
+            yield range(start, min(start + self.batch_size, total))
+
+    def create_users(self, prefix, total, password):
+        # Hashing is slow on purpose; every user shares one hash.
+        password = make_password(password)
+        ids = []
+        for numbers in self.batches(total):
+            users = User.objects.bulk_create([
+                User(username=f'{prefix}-{number}', email=f'{prefix}-{number}@example.com', password=password)
+                for number in numbers
+            ])
+            ids += [user.pk for user in users]
+        return ids
+
+    def create_categories(self, total):
+        names = [
+            CATEGORIES[number % len(CATEGORIES)] + (f' {number // len(CATEGORIES) + 1}' if number >= len(CATEGORIES) else '')
+            for number in range(total)
+        ]
+        existing = dict(Category.objects.filter(name__in=names).values_list('name', 'pk'))
+        missing = [name for name in names if name not in existing]
+        for name, slug in zip(missing, allocate_slugs(Category, missing)):
+            existing[name] = Category.objects.create(name=name, slug=slug).pk
+        return [existing[name] for name in names]
+
+    def create_images(self):
+        """A few small JPEGs in storage, shared by every generated ad image."""
+        names = []
+        for number, color in enumerate(COLORS):
+            buffer = BytesIO()
+            Image.new('RGB', (800, 600), color).save(buffer, 'JPEG')
+            field = AdImage._meta.get_field('image')
+            name = field.generate_filename(AdImage(), f'bench-{number}.jpg')
+            names.append(field.storage.save(name, ContentFile(buffer.getvalue())))
+        return names
+
+    def create_ads(self, total, users, categories, max_tags, max_images, max_likes):
+        rng = self.rng
+        tags = []
+        for word in WORDS:
+            tag, _ = Tag.objects.get_or_create(name=word, defaults={'slug': word})
+            tags.append(tag.pk)
+        content_type = ContentType.objects.get_for_model(Ads)
+        images = self.create_images() if max_images else []
+        likes = Ads.users_like.through
+        counters = {}
+        ads = []
+
+        for numbers in self.batches(total):
+            batch = []
+            for _ in numbers:
+                title = ' '.join(rng.sample(WORDS, 3)).capitalize()
+                liked_by = rng.sample(users, min(rng.randint(0, max_likes), len(users)))
+                batch.append(Ads(
+                    user_id=rng.choice(users), category_id=rng.choice(categories), title=title,
+                    description=' '.join(rng.choices(WORDS, k=rng.randint(20, 120))).capitalize() + '.',
+                    location=rng.choice(LOCATIONS), postal_code=str(rng.randint(110001, 855999)),
+                    contact_info=f'{rng.randint(6000000000, 9999999999)}', price=rng.randint(100, 500000),
+                    show_contact_info=rng.random() < 0.7, total_likes=len(liked_by),
+                ))
+                batch[-1].liked_by = liked_by
+            for ad, slug in zip(batch, allocate_slugs(Ads, [ad.title for ad in batch], counters=counters)):
+                ad.slug = slug
+
+            with transaction.atomic():
+                Ads.objects.bulk_create(batch)
+                TaggedItem.objects.bulk_create([
+                    TaggedItem(content_type=content_type, object_id=ad.pk, tag_id=tag)
+                    for ad in batch
+                    for tag in rng.sample(tags, rng.randint(0, max_tags))
+                ])
+                AdImage.objects.bulk_create([
+                    AdImage(ad=ad, image=rng.choice(images))
+                    for ad in batch
+                    for _ in range(rng.randint(0, max_images))
+                ])
+                likes.objects.bulk_create([likes(ads_id=ad.pk, user_id=user) for ad in batch for user in ad.liked_by])
+            ads += [(ad.pk, ad.user_id) for ad in batch]
+        return ads
+
+    def create_chats(self, total, messages, ads):
+        rng = self.rng
+        users = list({user for _, user in ads})
+        if len(users) < 2:
+            return 0
+        pairs = set()
+        for _ in range(total * 10):
+            if len(pairs) == total:
+                break
+            ad, seller = rng.choice(ads)
+            buyer = rng.choice(users)
+            if buyer != seller:
+                pairs.add((ad, seller, buyer))
+        pairs = sorted(pairs)
+
+        # About batch_size messages per transaction.
+        per_batch = max(self.batch_size // max(messages, 1), 1)
+        for start in range(0, len(pairs), per_batch):
+            batch = pairs[start:start + per_batch]
+            with transaction.atomic():
+                chats = Chat.objects.bulk_create([Chat(ad_id=ad, seller_id=seller, buyer_id=buyer) for ad, seller, buyer in batch])
+                Chat.users.through.objects.bulk_create([
+                    Chat.users.through(chat_id=chat.pk, user_id=user)
+                    for chat in chats
+                    for user in (chat.buyer_id, chat.seller_id)
+                ])
+                history = Message.objects.bulk_create([
+                    Message(
+                        chat_id=chat.pk,
+                        # The buyer opens, then they take turns.
+                        sender_id=(chat.buyer_id, chat.seller_id)[number % 2],
+                        receiver_id=(chat.seller_id, chat.buyer_id)[number % 2],
+                        message=rng.choice(REPLIES).format(price=rng.randint(100, 500000)),
+                    )
+                    for chat in chats
+                    for number in range(messages)
+                ], batch_size=self.batch_size)
+
+                inbox = []
+                for number, chat in enumerate(chats):
+                    window = history[number * messages:(number + 1) * messages]
+                    if window:
+                        last = window[-1]
+                        chat.last_message_id, chat.last_message_text = last.pk, last.message
+                        chat.last_message_at, chat.last_message_sender_id = last.created_on, last.sender_id
+                    for user, counterpart in ((chat.buyer_id, chat.seller_id), (chat.seller_id, chat.buyer_id)):
+                        # Everyone has read everything but the last message sent to them.
+                        unread = bool(window) and window[-1].receiver_id == user
+                        read_up_to = window[-2 if unread else -1].pk if len(window) > int(unread) else 0
+                        inbox.append(ChatInbox(
+                            user_id=user, chat_id=chat.pk, counterpart_id=counterpart,
+                            last_activity_at=chat.last_message_at or chat.created_on,
+                            last_read_message_id=read_up_to, unread_count=int(unread),
+                        ))
+                Chat.objects.bulk_update(chats, ['last_message', 'last_message_text', 'last_message_at', 'last_message_sender'])
+                ChatInbox.objects.bulk_create(inbox)
+        return len(pairs)
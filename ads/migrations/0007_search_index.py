@@ -0,0 +1,71 @@
+from django.db import migrations
+
+
+SQLITE_CREATE = """
+CREATE VIRTUAL TABLE IF NOT EXISTS ads_search USING fts5(
+    title, description, location, tags,
+    tokenize = 'porter unicode61 remove_diacritics 2'
+)
+"""
+
+SQLITE_FILL = """
+INSERT INTO ads_search (rowid, title, description, location, tags)
+SELECT a.id, a.title, a.description, a.location, COALESCE((
+    SELECT group_concat(t.name, ' ')
+    FROM taggit_taggeditem ti JOIN taggit_tag t ON t.id = ti.tag_id
+    JOIN django_content_type ct ON ct.id = ti.content_type_id
+    WHERE ti.object_id = a.id AND ct.app_label = 'ads' AND ct.model = 'ads'
+), '')
+FROM ads_ads a
+"""
+
+POSTGRES_CREATE = [
+    "ALTER TABLE ads_ads ADD COLUMN IF NOT EXISTS search_vector tsvector",
+    "CREATE INDEX IF NOT EXISTS ads_ads_search_vector_idx ON ads_ads USING GIN (search_vector)",
+]
+
+POSTGRES_FILL = """
+UPDATE ads_ads a SET search_vector =
+    setweight(to_tsvector('english', a.title), 'A') ||
+    setweight(to_tsvector('english', COALESCE((
+        SELECT string_agg(t.name, ' ')
+        FROM taggit_taggeditem ti JOIN taggit_tag t ON t.id = ti.tag_id
+        JOIN django_content_type ct ON ct.id = ti.content_type_id
+        WHERE ti.object_id = a.id AND ct.app_label = 'ads' AND ct.model = 'ads'
+    ), '')), 'B') ||
+    setweight(to_tsvector('english', a.location), 'C') ||
+    setweight(to_tsvector('english', a.description), 'D')
+"""
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_CREATE)
+        schema_editor.execute(SQLITE_FILL)
+    elif vendor == 'postgresql':
+        for statement in POSTGRES_CREATE:
+            schema_editor.execute(statement)
+        schema_editor.execute(POSTGRES_FILL)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS ads_search")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS ads_ads_search_vector_idx")
+        schema_editor.execute("ALTER TABLE ads_ads DROP COLUMN IF EXISTS search_vector")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0006_remove_ads_image_adimage'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taggit', '0006_rename_taggeditem_content_type_object_id_taggit_tagg_content_8fc721_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-17 00:39
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0007_search_index'),
+        ('taggit', '0006_rename_taggeditem_content_type_object_id_taggit_tagg_content_8fc721_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ads',
+            index=models.Index(fields=['category', 'price'], name='ads_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ads',
+            index=models.Index(fields=['category', 'created_at'], name='ads_category_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ads',
+            index=models.Index(fields=['category', 'event_start_date'], name='ads_category_event_idx'),
+        ),
+    ]
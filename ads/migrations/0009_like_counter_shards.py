@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-17 00:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0008_ads_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LikeCounterShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shard', models.PositiveSmallIntegerField()),
+                ('delta', models.IntegerField(default=0)),
+                ('ad', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='like_counter_shards', to='ads.ads')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('ad', 'shard'), name='unique_like_counter_shard')],
+            },
+        ),
+    ]
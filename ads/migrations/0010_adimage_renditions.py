@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-17 00:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0009_like_counter_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='adimage',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -1,28 +1,81 @@
-from django.db import models
-from django.utils.text import slugify
+import random
+import time
+from collections import defaultdict
+
+from django.db import IntegrityError, models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Prefetch, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.urls import reverse
 from taggit.managers import TaggableManager
 from django.core.exceptions import ValidationError
 from django.contrib.auth.models import User
 from django.conf import settings
+from classifieds.images import RenditionsMixin
+from classifieds.slugs import UniqueSlugMixin
 
 
-class Category(models.Model):
+class Category(UniqueSlugMixin, models.Model):
     name = models.CharField(max_length=255, unique=True, blank=False)  
     slug = models.SlugField(max_length=200, unique=True, blank=True)
     description = models.TextField(blank=True) 
     created_at = models.DateTimeField(auto_now_add=True)  
 
+    slug_source = 'name'
+
     def __str__(self):
         return self.name  
     
-    def save(self, *args, **kwargs):
-        if not self.slug:
-            self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
 
 
-class Ads(models.Model):
+class AdsQuerySet(models.QuerySet):
+
+    def for_listing(self):
+        """
+        Ads with their seller and category joined and a single cover image
+        prefetched into ``cover_images``, so a page of cards costs a fixed
+        number of queries whatever its size.
+        """
+        first_image = AdImage.objects.filter(ad=OuterRef('ad')).order_by('pk').values('pk')[:1]
+        cover_images = AdImage.objects.filter(pk=Subquery(first_image))
+        return self.select_related('user', 'category').prefetch_related(
+            Prefetch('images', queryset=cover_images, to_attr='cover_images')
+        )
+
+    def for_detail(self, user):
+        """
+        Ads with seller and category joined, all images prefetched, and
+        ``user_has_liked`` annotated as an EXISTS on the likes table, so the
+        detail page costs two queries however many images and likes it has.
+        """
+        if user.is_authenticated:
+            has_liked = Exists(self.model.users_like.through.objects.filter(ads=OuterRef('pk'), user=user))
+        else:
+            has_liked = Value(False)
+        return self.select_related('user', 'category').prefetch_related(
+            Prefetch('images', queryset=AdImage.objects.order_by('pk'))
+        ).with_pending_likes().annotate(user_has_liked=has_liked)
+
+    def reconcile_likes(self):
+        """
+        Reset ``total_likes`` to the number of rows in ``users_like`` with one
+        UPDATE, touching only the ads whose counter drifted. Returns that count.
+        """
+        through = self.model.users_like.through
+        likes = through.objects.filter(ads=OuterRef('pk')).order_by().values('ads').annotate(
+            count=Count('pk')
+        ).values('count')
+        actual = Coalesce(Subquery(likes), 0)
+        return self.annotate(actual_likes=actual).exclude(total_likes=F('actual_likes')).update(total_likes=actual)
+
+    def with_pending_likes(self):
+        """Annotate ``pending_likes``, the buffered like deltas not yet flushed into ``total_likes``."""
+        pending = LikeCounterShard.objects.filter(ad=OuterRef('pk')).order_by().values('ad').annotate(
+            total=Sum('delta')
+        ).values('total')
+        return self.annotate(pending_likes=Coalesce(Subquery(pending), 0))
+
+
+class Ads(UniqueSlugMixin, models.Model):
     user = models.ForeignKey(User, related_name='ads_posted', blank=False, null=False, on_delete=models.CASCADE)
     title = models.CharField(max_length=255, blank=False, null=False)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
@@ -41,6 +94,8 @@ class Ads(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = AdsQuerySet.as_manager()
+
     def clean(self):
         if self.price is not None and self.price < 0:
             raise ValidationError('Price is Invalid.')
@@ -62,20 +117,152 @@ class Ads(models.Model):
     def __str__(self):
         return f"{self.title} - {self.category.name} (${self.price})"
 
-    def save(self, *args, **kwargs):
-        if not self.slug:
-            self.slug = slugify(self.title)
-        super().save(*args, **kwargs)
-
     def get_absolute_url(self):
         return reverse('ads:ad_detail', args=[self.category.slug, self.slug])
 
+    def toggle_like(self, user):
+        """
+        Like the ad for ``user``, or unlike it if they already do. Returns
+        ``(liked, total_likes)``.
+
+        The like row is the source of truth: deleting it (or failing to insert
+        it twice) decides the direction, and the counter is moved with an
+        ``F()`` update of that one column in the same transaction, so parallel
+        likers never overwrite each other's increments.
+
+        With ``ADS_LIKE_COUNTER = 'buffered'`` the delta goes to a
+        ``LikeCounterShard`` instead of the ad row, see ``like_count``.
+        """
+        through = Ads.users_like.through
+        ads = Ads.objects.filter(pk=self.pk)
+        buffered = likes_buffered()
+
+        with transaction.atomic():
+            unliked, _ = through.objects.filter(ads_id=self.pk, user_id=user.pk).delete()
+            if unliked:
+                delta = -1
+            else:
+                try:
+                    with transaction.atomic():
+                        through.objects.create(ads_id=self.pk, user_id=user.pk)
+                except IntegrityError:
+                    # A concurrent request from the same user liked it first.
+                    delta = 0
+                else:
+                    delta = 1
+
+            if delta and buffered:
+                LikeCounterShard.objects.add(self.pk, delta)
+                schedule_like_flush()
+            elif delta > 0:
+                ads.update(total_likes=F('total_likes') + 1)
+            elif delta < 0:
+                ads.filter(total_likes__gt=0).update(total_likes=F('total_likes') - 1)
+
+            self.total_likes, pending = ads.with_pending_likes().values_list('total_likes', 'pending_likes').get()
+
+        return not unliked, max(self.total_likes + pending, 0)
+
+    @property
+    def like_count(self):
+        """``total_likes`` plus the buffered likes that have not been flushed yet."""
+        pending = getattr(self, 'pending_likes', None)
+        if pending is None:
+            pending = LikeCounterShard.objects.pending(self.pk) if likes_buffered() else 0
+        return max(self.total_likes + pending, 0)
+
+    @property
+    def cover_image(self):
+        if hasattr(self, 'cover_images'):
+            return self.cover_images[0] if self.cover_images else None
+        return self.images.order_by('pk').first()
+
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['category', 'price'], name='ads_category_price_idx'),
+            models.Index(fields=['category', 'created_at'], name='ads_category_created_idx'),
+            models.Index(fields=['category', 'event_start_date'], name='ads_category_event_idx'),
+        ]
+
+
+def likes_buffered():
+    return getattr(settings, 'ADS_LIKE_COUNTER', 'direct') == 'buffered'
+
+
+def schedule_like_flush():
+    """Queue one flush of the buffered likes per ``ADS_LIKE_FLUSH_INTERVAL``, whatever the number of likes."""
+    from .tasks import flush_like_counters
+
+    interval = getattr(settings, 'ADS_LIKE_FLUSH_INTERVAL', 60)
+    window = int(time.time() // interval)
+    flush_like_counters.enqueue(key=f'flush-like-counters:{window}', delay=interval)
+
+
+class LikeCounterShardQuerySet(models.QuerySet):
+
+    def add(self, ad_id, delta):
+        """Add ``delta`` to a random shard of the ad, creating the shard row on first use."""
+        shard = random.randrange(getattr(settings, 'ADS_LIKE_COUNTER_SHARDS', 16))
+        row = self.filter(ad_id=ad_id, shard=shard)
+        if row.update(delta=F('delta') + delta):
+            return
+        try:
+            with transaction.atomic(using=self.db):
+                self.create(ad_id=ad_id, shard=shard, delta=delta)
+        except IntegrityError:
+            row.update(delta=F('delta') + delta)
+
+    def pending(self, ad_id):
+        return self.filter(ad_id=ad_id).aggregate(total=Coalesce(Sum('delta'), 0))['total']
+
+    def flush(self, batch_size=1000):
+        """
+        Fold the buffered deltas into ``Ads.total_likes`` and delete them, a
+        batch of shard rows per transaction. Returns the number of ads updated.
+        """
+        updated = 0
+        while True:
+            with transaction.atomic(using=self.db):
+                rows = list(self.select_for_update().order_by('pk').values_list('pk', 'ad_id', 'delta')[:batch_size])
+                if not rows:
+                    return updated
+                deltas = defaultdict(int)
+                for _, ad_id, delta in rows:
+                    deltas[ad_id] += delta
+                for ad_id, delta in deltas.items():
+                    if delta:
+                        Ads.objects.using(self.db).filter(pk=ad_id).update(
+                            total_likes=Greatest(F('total_likes') + delta, 0)
+                        )
+                        updated += 1
+                self.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+
+
+class LikeCounterShard(models.Model):
+    """
+    Pending like deltas of an ad, spread over a few rows so that likes on a
+    viral ad don't all queue on the same row. ``flush_like_counters`` folds
+    them into ``Ads.total_likes``.
+    """
+    ad = models.ForeignKey(Ads, related_name='like_counter_shards', on_delete=models.CASCADE)
+    shard = models.PositiveSmallIntegerField()
+    delta = models.IntegerField(default=0)
+
+    objects = LikeCounterShardQuerySet.as_manager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ad', 'shard'], name='unique_like_counter_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.ad_id}#{self.shard}: {self.delta:+d}"
 
 
-class AdImage(models.Model):
+class AdImage(RenditionsMixin, models.Model):
     ad = models.ForeignKey(Ads, related_name='images', on_delete=models.CASCADE)
     image = models.ImageField(upload_to='ads/%Y/%m/%d/', blank=False, null=False)
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
     created_on  = models.DateTimeField(auto_now_add=True)
\ No newline at end of file
@@ -0,0 +1,256 @@
+"""
+Full-text search over ads.
+
+Ads are indexed on title, description, location and tag names. The index
+lives in the database next to the ads, so it is picked per database vendor:
+
+* SQLite: an FTS5 virtual table ``ads_search`` whose rowid is the ad id,
+  ranked with bm25.
+* PostgreSQL: a ``search_vector`` tsvector column on ``ads_ads`` with a GIN
+  index, ranked with ts_rank_cd.
+* Anything else: a plain ``icontains`` scan, so search still works.
+
+The tables are created by migration ``0007_search_index`` and kept in sync by
+the signals in ``ads.signals``; ``manage.py rebuild_search_index`` rebuilds
+them in bulk.
+"""
+import re
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import Q
+from taggit.models import Tag, TaggedItem
+
+from .models import Ads
+
+
+SQLITE_TABLE = 'ads_search'
+# bm25 column weights, in table column order: title, description, location, tags.
+SQLITE_WEIGHTS = (10.0, 1.0, 2.0, 5.0)
+POSTGRES_CONFIG = 'english'
+
+
+def tokenize(query):
+    return re.findall(r'\w+', query.lower())
+
+
+class SearchBackend:
+
+    def __init__(self, using='default'):
+        self.using = using
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def index(self, ad_ids):
+        raise NotImplementedError
+
+    def remove(self, ad_ids):
+        raise NotImplementedError
+
+    def rebuild(self, batch_size=5000):
+        """Reindex every ad in id-ordered batches; returns the number of ads indexed."""
+        ids = Ads.objects.using(self.using).order_by('pk').values_list('pk', flat=True)
+        total = 0
+        last_id = 0
+        while True:
+            batch = list(ids.filter(pk__gt=last_id)[:batch_size])
+            if not batch:
+                return total
+            self.index(batch)
+            total += len(batch)
+            last_id = batch[-1]
+
+    def search(self, query, limit=20, offset=0):
+        """Ids of matching ads, best match first."""
+        raise NotImplementedError
+
+    def count(self, query):
+        raise NotImplementedError
+
+    def _tags_sql(self, aggregate):
+        """Correlated subquery returning the space separated tag names of ad ``a``."""
+        content_type = ContentType.objects.db_manager(self.using).get_for_model(Ads)
+        return (
+            f"(SELECT {aggregate} FROM {TaggedItem._meta.db_table} ti "
+            f"JOIN {Tag._meta.db_table} t ON t.id = ti.tag_id "
+            f"WHERE ti.object_id = a.id AND ti.content_type_id = {int(content_type.pk)})"
+        )
+
+
+class SQLiteSearchBackend(SearchBackend):
+
+    def match_expression(self, query):
+        # Quote every token so user input can't inject FTS5 syntax, and match
+        # prefixes so partially typed words still hit.
+        return ' '.join(f'"{token}"*' for token in tokenize(query))
+
+    def index(self, ad_ids):
+        ad_ids = list(ad_ids)
+        if not ad_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(ad_ids))
+        tags = self._tags_sql("group_concat(t.name, ' ')")
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SQLITE_TABLE} WHERE rowid IN ({placeholders})", ad_ids)
+            cursor.execute(
+                f"INSERT INTO {SQLITE_TABLE} (rowid, title, description, location, tags) "
+                f"SELECT a.id, a.title, a.description, a.location, COALESCE({tags}, '') "
+                f"FROM {Ads._meta.db_table} a WHERE a.id IN ({placeholders})",
+                ad_ids,
+            )
+
+    def remove(self, ad_ids):
+        ad_ids = list(ad_ids)
+        if not ad_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(ad_ids))
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SQLITE_TABLE} WHERE rowid IN ({placeholders})", ad_ids)
+
+    def rebuild(self, batch_size=5000):
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SQLITE_TABLE}")
+        total = super().rebuild(batch_size)
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {SQLITE_TABLE} ({SQLITE_TABLE}) VALUES ('optimize')")
+        return total
+
+    def search(self, query, limit=20, offset=0):
+        expression = self.match_expression(query)
+        if not expression:
+            return []
+        weights = ', '.join(str(weight) for weight in SQLITE_WEIGHTS)
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s "
+                f"ORDER BY bm25({SQLITE_TABLE}, {weights}), rowid DESC LIMIT %s OFFSET %s",
+                [expression, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def count(self, query):
+        expression = self.match_expression(query)
+        if not expression:
+            return 0
+        with self.connection.cursor() as cursor:
+            cursor.execute(f"SELECT COUNT(*) FROM {SQLITE_TABLE} WHERE {SQLITE_TABLE} MATCH %s", [expression])
+            return cursor.fetchone()[0]
+
+
+class PostgresSearchBackend(SearchBackend):
+
+    def index(self, ad_ids):
+        ad_ids = list(ad_ids)
+        if not ad_ids:
+            return
+        tags = self._tags_sql("string_agg(t.name, ' ')")
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {Ads._meta.db_table} a SET search_vector = "
+                f"setweight(to_tsvector('{POSTGRES_CONFIG}', a.title), 'A') || "
+                f"setweight(to_tsvector('{POSTGRES_CONFIG}', COALESCE({tags}, '')), 'B') || "
+                f"setweight(to_tsvector('{POSTGRES_CONFIG}', a.location), 'C') || "
+                f"setweight(to_tsvector('{POSTGRES_CONFIG}', a.description), 'D') "
+                f"WHERE a.id = ANY(%s)",
+                [ad_ids],
+            )
+
+    def remove(self, ad_ids):
+        # The vector is a column of the ad row, so it goes away with it.
+        pass
+
+    def search(self, query, limit=20, offset=0):
+        if not tokenize(query):
+            return []
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT id FROM {Ads._meta.db_table}, websearch_to_tsquery('{POSTGRES_CONFIG}', %s) query "
+                f"WHERE search_vector @@ query "
+                f"ORDER BY ts_rank_cd(search_vector, query) DESC, id DESC LIMIT %s OFFSET %s",
+                [query, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def count(self, query):
+        if not tokenize(query):
+            return 0
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT COUNT(*) FROM {Ads._meta.db_table} "
+                f"WHERE search_vector @@ websearch_to_tsquery('{POSTGRES_CONFIG}', %s)",
+                [query],
+            )
+            return cursor.fetchone()[0]
+
+
+class SimpleSearchBackend(SearchBackend):
+    """Unindexed fallback for databases without a full-text engine."""
+
+    def index(self, ad_ids):
+        pass
+
+    def remove(self, ad_ids):
+        pass
+
+    def rebuild(self, batch_size=5000):
+        return 0
+
+    def queryset(self, query):
+        tokens = tokenize(query)
+        if not tokens:
+            return Ads.objects.none()
+        condition = Q()
+        for token in tokens:
+            condition &= (Q(title__icontains=token) | Q(description__icontains=token) |
+                          Q(location__icontains=token) | Q(tags__name__icontains=token))
+        return Ads.objects.using(self.using).filter(condition).distinct()
+
+    def search(self, query, limit=20, offset=0):
+        ids = self.queryset(query).order_by('-created_at', '-id').values_list('pk', flat=True)
+        return list(ids[offset:offset + limit])
+
+    def count(self, query):
+        return self.queryset(query).count()
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend(using='default'):
+    vendor = connections[using].vendor
+    return BACKENDS.get(vendor, SimpleSearchBackend)(using)
+
+
+class SearchResults:
+    """
+    Lazy, sliceable view of ranked search results, so Django's Paginator only
+    ever fetches the ads of the requested page.
+    """
+
+    def __init__(self, query, queryset=None, using='default'):
+        self.query = query
+        self.queryset = queryset if queryset is not None else Ads.objects.for_listing()
+        self.backend = get_search_backend(using)
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.query)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = index.stop if index.stop is not None else self.count()
+        ids = self.backend.search(self.query, limit=max(stop - start, 0), offset=start)
+        ads = self.queryset.in_bulk(ids)
+        return [ads[pk] for pk in ids if pk in ads]
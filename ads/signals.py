@@ -0,0 +1,144 @@
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from taggit.models import TaggedItem
+from . import autocomplete, cache as page_cache
+from .models import Ads, AdImage, Category
+from .search import get_search_backend
+
+
+@receiver(post_save, sender=Ads)
+def index_ad(sender, instance, raw=False, using='default', **kwargs):
+    if not raw:
+        get_search_backend(using).index([instance.pk])
+
+
+@receiver(m2m_changed, sender=Ads.tags.through)
+def index_ad_tags(sender, instance, action, reverse, using='default', **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear') and isinstance(instance, Ads):
+        get_search_backend(using).index([instance.pk])
+
+
+@receiver(post_delete, sender=Ads)
+def unindex_ad(sender, instance, using='default', **kwargs):
+    get_search_backend(using).remove([instance.pk])
+
+
+def ad_scopes(ad_ids):
+    return [
+        scope
+        for slug, category_slug in Ads.objects.filter(pk__in=ad_ids).values_list('slug', 'category__slug')
+        for scope in (f'ad:{slug}', f'category:{category_slug}')
+    ]
+
+
+@receiver(pre_save, sender=Ads)
+def remember_previous_ad(sender, instance, raw=False, **kwargs):
+    previous = None
+    if instance.pk and not raw:
+        previous = Ads.objects.filter(pk=instance.pk).values('slug', 'category__slug', 'location').first()
+    # An edit can move the ad to another category or slug; both old pages go stale too.
+    instance._previous_cache_scopes = [
+        f'ad:{previous["slug"]}', f'category:{previous["category__slug"]}'
+    ] if previous else []
+    source = autocomplete.sources.get('location')
+    if previous and source is not None and source.counted(instance.pk) and (
+        autocomplete.normalize(previous['location']) != autocomplete.normalize(instance.location)
+    ):
+        source.index.add(previous['location'], -1)
+        source.index.add(instance.location)
+
+
+def deleted_model(origin):
+    """The model whose delete() removed the row: the row's own or one it cascaded from."""
+    if isinstance(origin, QuerySet):
+        return origin.model
+    return None if origin is None else type(origin)
+
+
+def deletes_ads(origin):
+    # Ads go with their category and their user; expire_deleted_ad_pages
+    # expires their pages.
+    return deleted_model(origin) in (Ads, Category, User)
+
+
+class DeletedAdPages:
+    """
+    The pages of the ads removed by one delete, however many it cascades to:
+    each scope is bumped once as it first shows up and all again on commit,
+    and category slugs are read in one query.
+    """
+
+    def __init__(self):
+        self.scopes = set()
+        self.category_slugs = dict(Category.objects.values_list('pk', 'slug'))
+        transaction.on_commit(lambda: page_cache.bump(*self.scopes))
+
+    @classmethod
+    def of(cls, origin):
+        if not hasattr(origin, '_deleted_ad_pages'):
+            origin._deleted_ad_pages = cls()
+        return origin._deleted_ad_pages
+
+    def expire(self, ad):
+        scopes = {f'ad:{ad.slug}', f'category:{self.category_slugs.get(ad.category_id)}'} - self.scopes
+        page_cache.bump(*scopes)
+        self.scopes |= scopes
+
+
+@receiver(post_save, sender=Ads)
+def expire_ad_pages(sender, instance, **kwargs):
+    scopes = getattr(instance, '_previous_cache_scopes', [])
+    page_cache.expire(*scopes, f'ad:{instance.slug}', f'category:{instance.category.slug}')
+
+
+@receiver(post_delete, sender=Ads)
+def expire_deleted_ad_pages(sender, instance, origin=None, **kwargs):
+    if deleted_model(origin) is Category:
+        # expire_category_pages bumps 'categories', which every page depends on.
+        return
+    if origin is None:
+        page_cache.expire(f'ad:{instance.slug}', f'category:{instance.category.slug}')
+    else:
+        DeletedAdPages.of(origin).expire(instance)
+
+
+@receiver(post_save, sender=AdImage)
+@receiver(post_delete, sender=AdImage)
+def expire_ad_image_pages(sender, instance, origin=None, **kwargs):
+    if not deletes_ads(origin):
+        page_cache.expire(*ad_scopes([instance.ad_id]))
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def expire_ad_tag_pages(sender, instance, origin=None, **kwargs):
+    if instance.content_type_id == ContentType.objects.get_for_model(Ads).pk and not deletes_ads(origin):
+        page_cache.expire(*ad_scopes([instance.object_id]))
+
+
+@receiver(post_delete, sender=Ads)
+def forget_ad_location(sender, instance, **kwargs):
+    source = autocomplete.sources.get('location')
+    if source is not None and source.counted(instance.pk):
+        source.index.add(instance.location, -1)
+
+
+@receiver(post_delete, sender=TaggedItem)
+def forget_tag_use(sender, instance, **kwargs):
+    source = autocomplete.sources.get('tags')
+    if source is not None and source.counted(instance.pk) and (
+        instance.content_type_id == ContentType.objects.get_for_model(Ads).pk
+    ):
+        name = source.value_of(instance.tag_id)
+        if name is not None:
+            source.index.add(name, -1)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def expire_category_pages(sender, instance, **kwargs):
+    page_cache.expire('categories', f'category:{instance.slug}')
@@ -0,0 +1,7 @@
+from jobs.queue import task
+from .models import LikeCounterShard
+
+
+@task
+def flush_like_counters():
+    LikeCounterShard.objects.flush()
@@ -0,0 +1,22 @@
+from django import template
+
+register = template.Library()
+
+
+@register.inclusion_tag('responsive_image.html')
+def responsive_image(image, rendition, sizes='100vw', alt='', css_class='', loading='lazy'):
+    """
+    ``<picture>`` for an image model with renditions: WebP and JPEG ``srcset``s
+    of every width, and the ``rendition`` JPEG as the fallback ``src``.
+    """
+    context = {'image': image, 'sizes': sizes, 'alt': alt, 'css_class': css_class, 'loading': loading}
+    if image:
+        size = image.get_renditions().get(rendition, {})
+        context.update(
+            src=image.rendition_url(rendition),
+            webp_srcset=image.srcset('webp'),
+            jpeg_srcset=image.srcset('jpeg'),
+            width=size.get('width'),
+            height=size.get('height'),
+        )
+    return context
@@ -1,16 +1,40 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase, override_settings
 from django.urls import reverse
-from .models import Category, Ads
-from chat.models import Chat, Message
-from django.db import IntegrityError
-from django.core.exceptions import ValidationError
+from .models import Category, Ads, AdImage, LikeCounterShard
+from .search import get_search_backend
+from .cache import get_cache as get_page_cache
+from . import cache as ads_cache
+from . import autocomplete
+from jobs.models import Job
+from jobs.queue import claim_many, execute
+from django.core.management import CommandError, call_command
+from django.conf import settings
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.cache import cache
+from chat.models import Chat, ChatInbox, Message
+from ads.management.commands import run_bench
+from django.db import IntegrityError, OperationalError, connection, connections, transaction
+from django.test.utils import CaptureQueriesContext
+from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.utils.text import slugify
+from django.utils import timezone
+from classifieds.metrics import QueryBudgetExceeded, RequestMetricsMiddleware
+from classifieds import replicas, sqlite
+from classifieds.slugs import allocate_slug, allocate_slugs
+from unittest import mock
+from asgiref.sync import iscoroutinefunction
 from io import BytesIO
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
 from PIL import Image
 import io,os
+import brotli
+import gzip
+import json
+import tempfile
+import threading
+import time
 
 class CategoryModelTest(TestCase):
     """
@@ -385,26 +409,45 @@ class AdsListViewTests(TestCase):
         self.assertTemplateUsed(response, 'ads/ads_list.html')
 
     def test_pagination_links(self):
-        response = self.client.get(reverse('ads:ads_by_category', args=[self.category.slug]) + '?page=1')
+        url = reverse('ads:ads_by_category', args=[self.category.slug])
+        response = self.client.get(url)
         self.assertContains(response, 'First')
         self.assertContains(response, 'Previous')
         self.assertContains(response, 'Next')
-        self.assertContains(response, 'Last')
-
-        self.assertContains(response, '<span class="px-4 py-2 text-sm font-medium text-white bg-blue-600 rounded">1<span class="sr-only">(current)</span></span>', html=True)
+        self.assertContains(response, '<span class="px-4 py-2 text-sm font-medium text-gray-400 bg-gray-200 rounded">Previous</span>', html=True)
+        self.assertNotContains(response, 'Last')
 
-        response = self.client.get(reverse('ads:ads_by_category', args=[self.category.slug]) + '?page=2')
-        self.assertContains(response, 'Previous')  
-        self.assertContains(response, 'Next')      
-        self.assertContains(response, '<span class="px-4 py-2 text-sm font-medium text-white bg-blue-600 rounded">2<span class="sr-only">(current)</span></span>', html=True)
+        response = self.client.get(url, {'cursor': response.context['page_obj'].next_cursor})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['page_obj'].has_previous())
+        self.assertTrue(response.context['page_obj'].has_next())
 
     def test_pagination_edge_cases(self):
-        response = self.client.get(reverse('ads:ads_by_category', args=[self.category.slug]) + '?page=4')
-        self.assertContains(response, 'Previous')  
-        self.assertContains(response, '<span class="px-4 py-2 text-sm font-medium text-gray-400 bg-gray-200 rounded">Next</span>', html=True)   
+        url = reverse('ads:ads_by_category', args=[self.category.slug])
+        seen = []
+        cursor = None
+        for _ in range(4):
+            response = self.client.get(url, {'cursor': cursor} if cursor else {})
+            seen.extend(ad.id for ad in response.context['ads'])
+            cursor = response.context['page_obj'].next_cursor
+
+        self.assertIsNone(cursor)
+        self.assertContains(response, 'Previous')
+        self.assertContains(response, '<span class="px-4 py-2 text-sm font-medium text-gray-400 bg-gray-200 rounded">Next</span>', html=True)
+        self.assertEqual(sorted(seen), sorted(ad.id for ad in self.ads))
 
-        self.assertContains(response, 'First')
-        self.assertContains(response, '<span class="px-4 py-2 text-sm font-medium text-gray-400 bg-gray-200 rounded">Last</span>', html=True)
+        response = self.client.get(url, {'cursor': response.context['page_obj'].previous_cursor})
+        self.assertEqual([ad.id for ad in response.context['ads']], seen[12:18])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse('ads:ads_by_category', args=[self.category.slug]), {'cursor': 'garbage'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_no_count_query(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('ads:ads_by_category', args=[self.category.slug]))
+        # Facet counts are grouped aggregates; the paginator itself must not count rows.
+        self.assertFalse([query for query in queries if '__count' in query['sql']])
 
     def test_no_ads_pagination(self):
         empty_category = Category.objects.create(name='Empty Category', slug='empty-category')
@@ -412,6 +455,427 @@ class AdsListViewTests(TestCase):
         self.assertContains(response, 'No ads available')
 
 
+class UniqueSlugTests(TestCase):
+    """Tests for slug allocation of ads and categories with clashing titles."""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='seller')
+        self.category = Category.objects.create(name='Phones')
+
+    def create_ad(self, title='iPhone 12 for sale', **kwargs):
+        return Ads.objects.create(user=self.user, title=title, category=self.category, price=1, **kwargs)
+
+    def test_duplicate_titles_get_numbered_slugs(self):
+        slugs = [self.create_ad().slug for _ in range(12)]
+
+        self.assertEqual(slugs[:3], ['iphone-12-for-sale', 'iphone-12-for-sale-2', 'iphone-12-for-sale-3'])
+        self.assertEqual(slugs[-1], 'iphone-12-for-sale-12')
+
+    def test_other_slugs_with_the_same_prefix_are_ignored(self):
+        self.create_ad()
+        self.create_ad(slug='iphone-12-for-sale-cheap')
+        self.create_ad(slug='iphone-12-for-sale-099')
+
+        self.assertEqual(self.create_ad().slug, 'iphone-12-for-sale-2')
+
+    def test_free_base_is_reused(self):
+        self.create_ad(slug='iphone-12-for-sale-9')
+
+        self.assertEqual(self.create_ad().slug, 'iphone-12-for-sale')
+
+    def test_cold_cache_scans_for_the_highest_number(self):
+        self.create_ad()
+        self.create_ad(slug='iphone-12-for-sale-9')
+        cache.clear()
+
+        with self.assertNumQueries(2):
+            self.assertEqual(allocate_slug(Ads, 'iPhone 12 for sale'), 'iphone-12-for-sale-10')
+
+    def test_stale_counter_is_corrected_by_the_unique_index(self):
+        self.create_ad()
+        self.create_ad(slug='iphone-12-for-sale-2')
+        self.create_ad(slug='iphone-12-for-sale-3')
+
+        self.assertEqual(self.create_ad().slug, 'iphone-12-for-sale-4')
+
+    def test_allocation_is_one_query(self):
+        for _ in range(5):
+            self.create_ad()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(allocate_slug(Ads, 'iPhone 12 for sale'), 'iphone-12-for-sale-6')
+
+    def test_category_slugs_are_unique(self):
+        self.assertEqual(Category.objects.create(name='C').slug, 'c')
+        self.assertEqual(Category.objects.create(name='C++').slug, 'c-2')
+
+    def test_long_and_empty_titles(self):
+        long_ad = self.create_ad(title='word ' * 100)
+        self.assertLessEqual(len(self.create_ad(title='word ' * 100).slug), 255)
+        self.assertTrue(long_ad.slug.startswith('word-word'))
+
+        self.assertEqual(self.create_ad(title='!!!').slug, 'ads')
+        self.assertEqual(self.create_ad(title='???').slug, 'ads-2')
+
+    def test_conflicting_insert_is_retried(self):
+        self.create_ad()
+        stale = iter(['iphone-12-for-sale'])
+        real_allocate = allocate_slug
+
+        def racing_allocate(*args, **kwargs):
+            # The first attempt returns the slug another request just took.
+            return next(stale, None) or real_allocate(*args, **kwargs)
+
+        with mock.patch('classifieds.slugs.allocate_slug', side_effect=racing_allocate) as allocate:
+            ad = self.create_ad()
+
+        self.assertEqual(ad.slug, 'iphone-12-for-sale-2')
+        self.assertEqual(allocate.call_count, 2)
+
+    def test_other_integrity_errors_are_not_retried(self):
+        with self.assertRaises(IntegrityError):
+            Ads.objects.create(title='No seller', category=self.category, price=1)
+
+    def test_ten_thousand_identical_titles(self):
+        for _ in range(10000):
+            ad = Ads(user=self.user, title='Same title', category=self.category, price=1)
+            ad.save()
+
+        self.assertEqual(ad.slug, 'same-title-10000')
+        self.assertEqual(Ads.objects.filter(slug__startswith='same-title').values('slug').distinct().count(), 10000)
+        with self.assertNumQueries(1):
+            self.assertEqual(allocate_slug(Ads, 'Same title'), 'same-title-10001')
+
+    def test_batch_allocation(self):
+        self.create_ad()
+        self.create_ad(title='Bike', slug='bike-4')
+
+        with self.assertNumQueries(2):
+            slugs = allocate_slugs(Ads, ['iPhone 12 for sale', 'Sofa', 'Bike', 'Bike', 'Lamp'])
+        self.assertEqual(slugs, ['iphone-12-for-sale-2', 'sofa', 'bike-5', 'bike-6', 'lamp'])
+        # Counters carry on from the batch, like single allocations.
+        self.assertEqual(allocate_slug(Ads, 'Bike'), 'bike')
+
+    def test_batch_allocation_uses_the_callers_counters(self):
+        self.create_ad()
+        counters = {}
+        allocate_slugs(Ads, ['iPhone 12 for sale'], counters=counters)
+        cache.clear()
+
+        with self.assertNumQueries(1):
+            self.assertEqual(allocate_slugs(Ads, ['iPhone 12 for sale'], counters=counters), ['iphone-12-for-sale-3'])
+
+
+class AdsListFilterTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='filterer')
+        self.category = Category.objects.create(name='Filter Category', slug='filter-category')
+        self.url = reverse('ads:ads_by_category', args=[self.category.slug])
+        self.cheap = self.create_ad('Cheap lamp', 500, '560001', 'Bengaluru')
+        self.mid = self.create_ad('Desk', 3000, '560034', 'Bengaluru')
+        self.pricey = self.create_ad('Piano', 150000, '600001', 'Chennai')
+        self.cheap.tags.add('lighting', 'home')
+        self.mid.tags.add('home')
+
+    def create_ad(self, title, price, postal_code, location, **kwargs):
+        return Ads.objects.create(user=self.user, title=title, slug=slugify(title), category=self.category,
+                                  price=price, postal_code=postal_code, location=location, **kwargs)
+
+    def listed(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return response, {ad.id for ad in response.context['ads']}
+
+    def test_price_range(self):
+        _, ids = self.listed(min_price=1000, max_price=200000)
+        self.assertEqual(ids, {self.mid.id, self.pricey.id})
+
+    def test_postal_code_prefix_and_location(self):
+        _, ids = self.listed(postal_code='5600')
+        self.assertEqual(ids, {self.cheap.id, self.mid.id})
+        _, ids = self.listed(location='chennai')
+        self.assertEqual(ids, {self.pricey.id})
+
+    def test_tags_must_all_match(self):
+        _, ids = self.listed(tags='home')
+        self.assertEqual(ids, {self.cheap.id, self.mid.id})
+        _, ids = self.listed(tags='home, lighting')
+        self.assertEqual(ids, {self.cheap.id})
+
+    def test_event_window(self):
+        event = self.create_ad('Concert', 800, '560001', 'Bengaluru',
+                               event_start_date='2030-05-10T18:00:00Z', event_end_date='2030-05-10T22:00:00Z')
+        _, ids = self.listed(event_from='2030-05-01', event_to='2030-05-10')
+        self.assertEqual(ids, {event.id})
+        _, ids = self.listed(event_from='2030-05-11')
+        self.assertEqual(ids, set())
+
+    def test_invalid_filters_are_ignored(self):
+        response, ids = self.listed(min_price='abc', max_price=10)
+        self.assertEqual(ids, {self.cheap.id, self.mid.id, self.pricey.id})
+        self.assertTrue(response.context['filter_form'].errors)
+
+    def test_facets_follow_current_filters(self):
+        response, _ = self.listed(location='Bengaluru')
+        facets = response.context['facets']
+
+        prices = {(bucket['low'], bucket['high']): bucket['count'] for bucket in facets['prices']}
+        self.assertEqual(prices[(None, 1000)], 1)
+        self.assertEqual(prices[(1000, 5000)], 1)
+        self.assertEqual(prices[(100000, None)], 0)
+        self.assertEqual([(tag['name'], tag['count']) for tag in facets['tags']], [('home', 2), ('lighting', 1)])
+
+    def test_price_facet_ignores_price_filter(self):
+        response, _ = self.listed(min_price=100000)
+        prices = {(bucket['low'], bucket['high']): bucket['count'] for bucket in response.context['facets']['prices']}
+        self.assertEqual(prices[(None, 1000)], 1)
+
+    def test_location_facet_ignores_location_filter(self):
+        response, _ = self.listed(location='Bengaluru', max_price=5000)
+        locations = [(loc['name'], loc['count']) for loc in response.context['facets']['locations']]
+        self.assertEqual(locations, [('Bengaluru', 2)])
+
+        response, _ = self.listed(location='Bengaluru')
+        locations = {loc['name']: loc for loc in response.context['facets']['locations']}
+        self.assertEqual(locations['Chennai']['count'], 1)
+        self.assertEqual(locations['Chennai']['querystring'], 'location=Chennai')
+
+    def test_max_price_is_inclusive(self):
+        _, ids = self.listed(max_price=3000)
+        self.assertEqual(ids, {self.cheap.id, self.mid.id})
+
+    def test_price_bucket_links_match_their_counts(self):
+        response, _ = self.listed()
+        for bucket in response.context['facets']['prices']:
+            with self.subTest(bucket=(bucket['low'], bucket['high'])):
+                response = self.client.get(self.url + '?' + bucket['querystring'])
+                self.assertEqual(len(response.context['ads']), bucket['count'])
+
+    def test_facet_links_keep_filters_and_drop_cursor(self):
+        response, _ = self.listed(location='Bengaluru')
+        tag = response.context['facets']['tags'][0]
+        self.assertEqual(tag['querystring'], 'location=Bengaluru&tags=home')
+
+    def test_cursor_links_keep_filters(self):
+        for i in range(8):
+            self.create_ad(f'Lamp {i}', 100 + i, '560001', 'Bengaluru')
+        response, _ = self.listed(location='Bengaluru')
+        self.assertContains(response, f'href="?location=Bengaluru&cursor={response.context["page_obj"].next_cursor}"')
+
+
+class AdsListingQueryTests(TestCase):
+    """The listing queryset must not issue per-card queries for the seller or cover image."""
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Listing Category', slug='listing-category')
+
+    def create_ads(self, count):
+        for i in range(count):
+            user = User.objects.create(username=f'seller{Ads.objects.count()}')
+            ad = Ads.objects.create(user=user, title=f'Listing Ad {i}', slug=f'listing-ad-{Ads.objects.count()}',
+                                    category=self.category, price=10 + i)
+            AdImage.objects.create(ad=ad, image=f'ads/cover-{ad.id}.jpg')
+            AdImage.objects.create(ad=ad, image=f'ads/other-{ad.id}.jpg')
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('ads:ads_by_category', args=[self.category.slug]))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_query_count_independent_of_page_size(self):
+        self.create_ads(1)
+        single, _ = self.count_queries()
+
+        self.create_ads(5)
+        full_page, response = self.count_queries()
+
+        self.assertEqual(len(response.context['ads']), 6)
+        self.assertEqual(single, full_page)
+
+    def test_cover_image_is_first_image(self):
+        self.create_ads(1)
+        ad = Ads.objects.for_listing().get()
+        self.assertEqual(ad.cover_image.image.name, f'ads/cover-{ad.id}.jpg')
+        self.assertEqual(ad.cover_image, Ads.objects.get(pk=ad.pk).cover_image)
+
+    def test_cover_image_missing(self):
+        user = User.objects.create(username='imageless')
+        Ads.objects.create(user=user, title='No Image', slug='no-image', category=self.category, price=1)
+        self.assertIsNone(Ads.objects.for_listing().get().cover_image)
+
+
+class AdSearchTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='searcher')
+        self.category = Category.objects.create(name='Search Category', slug='search-category')
+        self.bike = self.create_ad('Mountain bike', 'Barely used, 21 gears.', 'Bengaluru')
+        self.bike.tags.add('cycling')
+        self.car = self.create_ad('Hatchback car', 'Comes with a bike rack.', 'Chennai')
+        self.flat = self.create_ad('2BHK flat', 'Close to the metro.', 'Bengaluru')
+
+    def create_ad(self, title, description, location):
+        return Ads.objects.create(user=self.user, title=title, slug=slugify(title), category=self.category,
+                                  description=description, location=location, price=100)
+
+    def search(self, query):
+        return get_search_backend().search(query)
+
+    def test_title_matches_rank_above_description_matches(self):
+        self.assertEqual(self.search('bike'), [self.bike.id, self.car.id])
+
+    def test_matches_location_and_tags(self):
+        self.assertEqual(sorted(self.search('bengaluru')), sorted([self.bike.id, self.flat.id]))
+        self.assertEqual(self.search('cycling'), [self.bike.id])
+
+    def test_prefix_and_multiple_terms(self):
+        self.assertEqual(self.search('moun'), [self.bike.id])
+        self.assertEqual(self.search('bike chennai'), [self.car.id])
+
+    def test_index_follows_edits_tags_and_deletes(self):
+        self.flat.title = 'Studio apartment'
+        self.flat.save()
+        self.assertEqual(self.search('studio'), [self.flat.id])
+        self.assertEqual(self.search('2bhk'), [])
+
+        self.bike.tags.remove('cycling')
+        self.assertEqual(self.search('cycling'), [])
+
+        self.car.delete()
+        self.assertEqual(self.search('bike'), [self.bike.id])
+
+    def test_query_syntax_is_escaped(self):
+        self.assertEqual(self.search('bike" OR title:*'), [])
+        self.assertEqual(self.search('   '), [])
+
+    def test_rebuild_command(self):
+        with connection.cursor() as cursor:
+            cursor.execute("DELETE FROM ads_search")
+        self.assertEqual(self.search('bike'), [])
+
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(self.search('bike'), [self.bike.id, self.car.id])
+
+    def test_search_view(self):
+        response = self.client.get(reverse('ads:search'), {'q': 'bike'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTemplateUsed(response, 'ads/search_results.html')
+        self.assertEqual(list(response.context['ads']), [self.bike, self.car])
+        self.assertContains(response, 'Mountain bike')
+
+    def test_search_view_paginates_with_query(self):
+        for i in range(7):
+            self.create_ad(f'Road bike {i}', 'Fast.', 'Mumbai')
+        response = self.client.get(reverse('ads:search'), {'q': 'bike'})
+        self.assertEqual(len(response.context['ads']), 6)
+        self.assertContains(response, 'href="?q=bike&page=2"')
+
+    def test_empty_search(self):
+        response = self.client.get(reverse('ads:search'))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Type something to search for.')
+
+
+class AutocompleteTests(TestCase):
+
+    def setUp(self):
+        autocomplete.reset()
+        self.addCleanup(autocomplete.reset)
+        self.user = User.objects.create(username='typist')
+        self.category = Category.objects.create(name='Autocomplete', slug='autocomplete')
+        for number, (location, tags) in enumerate([
+            ('Bengaluru', ['bike', 'bicycle']),
+            ('Bengaluru', ['bike']),
+            ('bangalore ', ['Bike', 'bags']),
+            ('Bangalore', []),
+            ('Bangalore', []),
+            ('Belagavi', ['bicycle']),
+            ('Chennai', ['car']),
+        ]):
+            ad = Ads.objects.create(user=self.user, title=f'Ad {number}', slug=f'ad-{number}', category=self.category,
+                                    location=location, price=1)
+            ad.tags.add(*tags)
+
+    def suggest(self, field, query, **params):
+        response = self.client.get(reverse('ads:autocomplete', args=[field]), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [(result['value'], result['count']) for result in response.json()['results']]
+
+    def test_locations_by_usage_ignoring_case_and_spacing(self):
+        self.assertEqual(self.suggest('location', 'b'), [('Bangalore', 3), ('Bengaluru', 2), ('Belagavi', 1)])
+        self.assertEqual(self.suggest('location', '  BAN'), [('Bangalore', 3)])
+        self.assertEqual(self.suggest('location', 'b', limit=2), [('Bangalore', 3), ('Bengaluru', 2)])
+        self.assertEqual(self.suggest('location', 'x'), [])
+
+    def test_tags(self):
+        self.assertEqual(self.suggest('tags', 'bi'), [('bike', 3), ('bicycle', 2)])
+
+    def test_unknown_field(self):
+        response = self.client.get(reverse('ads:autocomplete', args=['title']), {'q': 'a'})
+        self.assertEqual(response.status_code, 404)
+
+    @override_settings(AUTOCOMPLETE_REFRESH=0)
+    def test_new_values_are_read_without_a_reload(self):
+        self.assertEqual(self.suggest('tags', 'ca'), [('car', 1)])
+        ad = Ads.objects.create(user=self.user, title='Ad', slug='ad', category=self.category, location='Kochi', price=1)
+        ad.tags.add('camera', 'car')
+
+        source = autocomplete.get_source('tags')
+        # Only the assignments above the last one seen.
+        with self.assertNumQueries(1):
+            self.assertEqual(source.lookup('ca'), [('car', 2), ('camera', 1)])
+
+    def test_deletes_are_subtracted(self):
+        self.assertEqual(self.suggest('tags', 'bag'), [('bags', 1)])
+        self.assertEqual(self.suggest('location', 'che'), [('Chennai', 1)])
+        Ads.objects.get(location='Chennai').delete()
+        ad = Ads.objects.get(location='bangalore ')
+        ad.tags.remove('bags')
+        self.assertEqual(self.suggest('tags', 'bag'), [])
+        self.assertEqual(self.suggest('location', 'che'), [])
+        self.assertEqual(self.suggest('tags', 'b'), [('bike', 3), ('bicycle', 2)])
+
+    def test_location_edits_move_the_count(self):
+        self.assertEqual(self.suggest('location', 'che'), [('Chennai', 1)])
+        ad = Ads.objects.get(location='Chennai')
+        ad.location = 'Bengaluru'
+        ad.save()
+        ad.title = 'Renamed'
+        ad.save()
+        self.assertEqual(self.suggest('location', 'che'), [])
+        self.assertEqual(self.suggest('location', 'ben'), [('Bengaluru', 3)])
+
+    def test_deleted_tag_uses_are_subtracted_without_reading_the_tags(self):
+        self.assertEqual(self.suggest('tags', 'bi'), [('bike', 3), ('bicycle', 2)])
+        ad = Ads.objects.get(slug='ad-0')
+        with CaptureQueriesContext(connection) as queries:
+            ad.delete()
+        self.assertFalse([query for query in queries if 'FROM "taggit_tag"' in query['sql']])
+        self.assertEqual(self.suggest('tags', 'bi'), [('bike', 2), ('bicycle', 1)])
+
+    def test_changes_update_the_memos_of_their_prefixes(self):
+        index = autocomplete.PrefixIndex()
+        index.load([('bike', 2), ('car', 1)])
+        self.assertEqual(index.lookup('b'), [('bike', 2)])
+        self.assertEqual(index.lookup('c'), [('car', 1)])
+        index.add('Bus', 3)
+        self.assertEqual(index.memos, {'b': ['bus', 'bike'], 'c': ['car']})
+        index.add('bike', -2)
+        self.assertEqual(index.lookup('b'), [('Bus', 3)])
+        self.assertEqual(index.lookup(''), [])
+
+    def test_dropping_out_of_a_full_memo_forgets_it(self):
+        index = autocomplete.PrefixIndex()
+        index.load([(f'tag{number:02}', 100 - number) for number in range(autocomplete.MAX_RESULTS + 1)])
+        self.assertEqual(len(index.lookup('tag', 50)), autocomplete.MAX_RESULTS)
+        index.add('tag00', -99)
+        self.assertNotIn('tag', index.memos)
+        self.assertEqual(index.lookup('tag', 50)[-1], (f'tag{autocomplete.MAX_RESULTS:02}', 80))
+
+
 class AdDetailViewTests(TestCase):
 
     def setUp(self):
@@ -459,13 +923,619 @@ class AdDetailViewTests(TestCase):
 
     def test_redirect_to_existing_conversation(self):
         self.client.login(username='user1', password='password')
-        chat1=Chat.objects.create(ad=self.ad)
+        chat1=Chat.objects.create(ad=self.ad, buyer=self.user1, seller=self.user2)
         chat1.users.set([self.user1, self.user2])
         Message.objects.create(sender=self.user1, receiver=self.user2, chat=chat1, message="Existing Message",)
         response = self.client.post(reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug]))
         self.assertEqual(Message.objects.count(), 1)
         self.assertEqual(response.status_code, 302)
 
+    def test_conversation_is_found_by_buyer_and_seller(self):
+        self.client.login(username='user1', password='password')
+        url = reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug])
+        first = self.client.post(url)
+        with CaptureQueriesContext(connection) as queries:
+            second = self.client.post(url)
+
+        chat = Chat.objects.get()
+        self.assertEqual((chat.buyer, chat.seller), (self.user1, self.user2))
+        self.assertEqual(set(chat.users.all()), {self.user1, self.user2})
+        self.assertEqual(first['Location'], second['Location'])
+        self.assertEqual(Message.objects.count(), 1)
+        lookups = [query['sql'] for query in queries if 'FROM "chat_chat"' in query['sql']]
+        self.assertEqual(len(lookups), 1)
+        self.assertIn('"buyer_id"', lookups[0])
+        self.assertNotIn('chat_chat_users', lookups[0])
+
+    def test_seller_cannot_message_their_own_ad(self):
+        self.client.login(username='user2', password='password')
+        response = self.client.post(reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug]))
+        self.assertRedirects(response, self.ad.get_absolute_url(), fetch_redirect_response=False)
+        self.assertFalse(Chat.objects.exists())
+
+    def test_duplicate_conversations_are_rejected(self):
+        Chat.objects.create(ad=self.ad, buyer=self.user1, seller=self.user2)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                Chat.objects.create(ad=self.ad, buyer=self.user1, seller=self.user2)
+
+    def add_images_and_likes(self, count):
+        start = self.ad.images.count()
+        AdImage.objects.bulk_create([AdImage(ad=self.ad, image=f'ads/test/{i}.jpg') for i in range(start, start + count)])
+        likers = User.objects.bulk_create([User(username=f'fan{i}') for i in range(start, start + count)])
+        self.ad.users_like.add(*likers)
+
+    def test_query_count_is_fixed(self):
+        self.client.login(username='user1', password='password')
+        url = reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug])
+
+        # session, user, ad with category and seller joined, images, unread chat badge
+        for count in (1, 25):
+            self.add_images_and_likes(count)
+            with self.assertNumQueries(5):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+        self.assertContains(response, 'totalSlides: 26 }')
+        self.assertContains(response, '/media/ads/test/24.jpg')
+
+    def test_anonymous_query_count(self):
+        self.add_images_and_likes(5)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug]))
+
+    def test_user_has_liked(self):
+        self.client.login(username='user1', password='password')
+        url = reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug])
+        self.add_images_and_likes(3)
+        self.assertFalse(self.client.get(url).context['user_has_liked'])
+
+        self.ad.users_like.add(self.user1)
+        self.assertTrue(self.client.get(url).context['user_has_liked'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                           'sessions': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class AnonymousPageCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='seller', password='password')
+        self.category = Category.objects.create(name='Cached', slug='cached')
+        self.ad = Ads.objects.create(user=self.user, title='Cached Ad', slug='cached-ad', category=self.category,
+                                     price=10, description='Original', location='Chennai', postal_code='600001')
+        self.detail_url = reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug])
+        self.list_url = reverse('ads:ads_by_category', args=[self.category.slug])
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_repeat_anonymous_hits_skip_the_database(self):
+        for url in (reverse('ads:home'), self.list_url, self.detail_url):
+            self.client.get(url)
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    @override_settings(ADS_PAGE_CACHE_ENABLED=False)
+    def test_disabled_without_a_shared_cache(self):
+        self.client.get(self.detail_url)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get(self.detail_url).status_code, 200)
+        self.assertTrue(queries)
+
+    def test_query_string_is_part_of_the_key(self):
+        self.client.get(self.list_url)
+        response = self.client.get(self.list_url, {'location': 'Madurai'})
+        self.assertNotContains(response, 'Cached Ad')
+
+    def test_ad_edit_expires_detail_and_list(self):
+        self.client.get(self.detail_url)
+        self.client.get(self.list_url)
+
+        self.ad.title = 'Renamed Ad'
+        self.ad.save()
+
+        self.assertContains(self.client.get(self.detail_url), 'Renamed Ad')
+        self.assertContains(self.client.get(self.list_url), 'Renamed Ad')
+
+    def test_ad_delete_expires_list(self):
+        self.client.get(self.list_url)
+        self.ad.delete()
+        self.assertNotContains(self.client.get(self.list_url), 'Cached Ad')
+
+    def test_cascaded_ad_deletes_expire_each_scope_once(self):
+        for number in range(3):
+            Ads.objects.create(user=self.user, title=f'More {number}', slug=f'more-{number}', category=self.category,
+                               price=1, location='Chennai', postal_code='600001')
+        self.client.get(self.list_url)
+
+        with mock.patch('ads.cache.bump', wraps=ads_cache.bump) as bump, \
+                CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+
+        bumped = [scope for call in bump.call_args_list for scope in call.args]
+        self.assertEqual(bumped.count('category:cached'), 2)
+        self.assertEqual(bumped.count('ad:more-0'), 2)
+        self.assertEqual(len([query for query in queries if 'FROM "ads_category"' in query['sql']]), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.list_url)
+        self.assertTrue(queries)
+
+    def test_moving_ad_expires_old_category(self):
+        other = Category.objects.create(name='Other', slug='other')
+        self.client.get(self.list_url)
+
+        self.ad.category = other
+        self.ad.save()
+
+        self.assertNotContains(self.client.get(self.list_url), 'Cached Ad')
+
+    def test_images_and_tags_expire_the_ad(self):
+        self.client.get(self.detail_url)
+        AdImage.objects.create(ad=self.ad, image='ads/test/new.jpg')
+        self.assertContains(self.client.get(self.detail_url), 'ads/test/new.jpg')
+
+        self.client.get(self.list_url)
+        self.ad.tags.add('vintage')
+        self.assertContains(self.client.get(self.list_url), 'vintage')
+
+    def test_category_change_expires_home(self):
+        self.client.get(reverse('ads:home'))
+        self.category.name = 'Renamed Category'
+        self.category.save()
+        self.assertContains(self.client.get(reverse('ads:home')), 'Renamed Category')
+
+    def test_logged_in_pages_are_never_shared(self):
+        self.client.login(username='seller', password='password')
+        response = self.client.get(self.detail_url)
+        self.assertContains(response, 'likeComponent(')
+        self.assertContains(response, 'Edit Ad')
+
+        self.client.logout()
+        response = self.client.get(self.detail_url)
+        self.assertNotContains(response, 'likeComponent(')
+        self.assertNotContains(response, 'Edit Ad')
+
+    def test_logged_in_users_are_not_served_the_anonymous_page(self):
+        self.client.get(self.detail_url)
+        self.client.login(username='seller', password='password')
+        self.assertContains(self.client.get(self.detail_url), 'likeComponent(')
+
+    def test_missing_pages_are_not_cached(self):
+        url = reverse('ads:ad_detail', args=[self.category.slug, 'coming-soon'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        Ads.objects.create(user=self.user, title='Coming soon', slug='coming-soon', category=self.category, price=1)
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': os.path.join(tempfile.gettempdir(), 'classifieds-test-page-cache'),
+}, 'sessions': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class FileBasedPageCacheTests(AnonymousPageCacheTests):
+
+    def test_backend(self):
+        self.assertEqual(type(get_page_cache()).__name__, 'FileBasedCache')
+
+
+class RequestMetricsTests(TestCase):
+
+    def setUp(self):
+        get_page_cache().clear()
+        self.user = User.objects.create_user(username='seller', password='password')
+        Category.objects.create(name='Bikes')
+
+    @override_settings(METRICS_SERVER_TIMING=True)
+    def test_server_timing_header(self):
+        first = self.client.get(reverse('ads:home'))
+        second = self.client.get(reverse('ads:home'))
+
+        self.assertRegex(first['Server-Timing'], r'^db;dur=[0-9.]+;desc="2 queries", render;dur=[0-9.]+, ')
+        self.assertIn('cache;desc="0 hits, 1 misses"', first['Server-Timing'])
+        self.assertIn('cache;desc="1 hits, 0 misses"', second['Server-Timing'])
+        self.assertIn('db;dur=0.0;desc="0 queries"', second['Server-Timing'])
+        self.assertRegex(second['Server-Timing'], r'total;dur=[0-9.]+$')
+
+    @override_settings(METRICS_SERVER_TIMING=False)
+    def test_server_timing_can_be_turned_off(self):
+        self.assertNotIn('Server-Timing', self.client.get(reverse('ads:home')))
+
+    def test_log_line(self):
+        self.client.force_login(self.user)
+
+        with self.assertLogs('classifieds.metrics', 'INFO') as logs:
+            self.client.get(reverse('ads:home'))
+
+        record = logs.records[-1]
+        self.assertIn('method=GET path=/ view=ads:home status=200', record.getMessage())
+        self.assertEqual(record.metrics['queries'], 5)
+        self.assertGreater(record.metrics['render_ms'], 0)
+
+    @override_settings(QUERY_BUDGETS={'ads:home': 4})
+    def test_query_budget_raises_in_tests(self):
+        self.client.force_login(self.user)
+
+        with self.assertRaisesMessage(QueryBudgetExceeded, 'ads:home ran 5 queries, over its budget of 4.'):
+            self.client.get(reverse('ads:home'))
+
+    @override_settings(QUERY_BUDGETS={'ads:home': 4}, QUERY_BUDGET_RAISE=False)
+    def test_query_budget_logs_otherwise(self):
+        self.client.force_login(self.user)
+
+        with self.assertLogs('classifieds.metrics', 'WARNING') as logs:
+            response = self.client.get(reverse('ads:home'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(logs.records[-1].getMessage(), 'ads:home ran 5 queries, over its budget of 4.')
+
+    @override_settings(QUERY_BUDGETS={'ads:home': {'POST': 0}})
+    def test_query_budget_by_method(self):
+        self.client.force_login(self.user)
+
+        self.assertEqual(self.client.get(reverse('ads:home')).status_code, 200)
+
+    @override_settings(METRICS_SERVER_TIMING=True)
+    async def test_async_requests(self):
+        async def get_response(request):
+            pass
+
+        self.assertTrue(iscoroutinefunction(RequestMetricsMiddleware(get_response)))
+        with self.assertLogs('classifieds.metrics', 'INFO') as logs:
+            response = await self.async_client.get(reverse('ads:home'))
+
+        self.assertIn('desc="2 queries"', response['Server-Timing'])
+        self.assertEqual(logs.records[-1].metrics['queries'], 2)
+
+
+
+class SQLiteOptionsTests(TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(sqlite.options({}), {
+            'init_command': 'PRAGMA journal_mode=WAL;PRAGMA synchronous=NORMAL;'
+                            'PRAGMA mmap_size=268435456;PRAGMA cache_size=-65536',
+            'timeout': 20.0,
+            'transaction_mode': 'IMMEDIATE',
+        })
+
+    def test_environment(self):
+        options = sqlite.options({'SQLITE_JOURNAL_MODE': 'delete', 'SQLITE_SYNCHRONOUS': '', 'SQLITE_MMAP_SIZE': '0',
+                                  'SQLITE_CACHE_SIZE': '', 'SQLITE_BUSY_TIMEOUT': '', 'SQLITE_TRANSACTION_MODE': ''})
+        self.assertEqual(options, {'init_command': 'PRAGMA journal_mode=DELETE;PRAGMA mmap_size=0'})
+
+    def test_invalid_values(self):
+        with self.assertRaisesMessage(ImproperlyConfigured, "SQLITE_SYNCHRONOUS must be one of EXTRA, FULL, NORMAL, OFF, not 'FAST'."):
+            sqlite.options({'SQLITE_SYNCHRONOUS': 'fast'})
+        with self.assertRaisesMessage(ImproperlyConfigured, "SQLITE_CACHE_SIZE must be a number, not '1; DROP TABLE'."):
+            sqlite.options({'SQLITE_CACHE_SIZE': '1; DROP TABLE'})
+
+    def test_new_connections_run_the_pragmas(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        wrapper = type(connections['default'])({**connection.settings_dict, 'NAME': os.path.join(directory.name, 'db.sqlite3'),
+                                    'OPTIONS': sqlite.options({})})
+        self.addCleanup(wrapper.close)
+        with wrapper.cursor() as cursor:
+            pragmas = {}
+            for pragma in ('journal_mode', 'synchronous', 'cache_size', 'busy_timeout'):
+                cursor.execute(f'PRAGMA {pragma}')
+                pragmas[pragma] = cursor.fetchone()[0]
+        # synchronous=NORMAL is 1.
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'cache_size': -65536, 'busy_timeout': 20000})
+        self.assertEqual(wrapper.transaction_mode, 'IMMEDIATE')
+
+
+class ReplicaRoutingTests(TestCase):
+
+    def setUp(self):
+        get_page_cache().clear()
+        self.user = User.objects.create_user(username='reader', password='password')
+        self.category = Category.objects.create(name='Replicated', slug='replicated')
+        self.ad = Ads.objects.create(user=self.user, title='Replicated ad', slug='replicated-ad', category=self.category, price=1)
+        # The tests have no replica to read from: route to the primary and watch the choice.
+        self.enterContext(override_settings(DATABASE_REPLICAS=['replica1']))
+        self.choose = self.enterContext(mock.patch.object(replicas, 'choose_replica', return_value='default'))
+
+    def test_router_outside_requests(self):
+        router = replicas.ReplicaRouter()
+        self.assertIsNone(router.db_for_read(Ads))
+        self.assertEqual(router.db_for_write(Ads), 'default')
+        self.assertFalse(router.allow_migrate('replica1', 'ads'))
+        self.assertTrue(router.allow_migrate('default', 'ads'))
+
+    def test_reads_go_to_the_replica_until_the_request_writes(self):
+        router = replicas.ReplicaRouter()
+        state = replicas.RoutingState(pinned=False)
+        state.replica = 'replica1'
+        token = replicas.current.set(state)
+        self.addCleanup(replicas.current.reset, token)
+
+        self.assertEqual(router.db_for_read(Ads), 'replica1')
+        router.db_for_write(Ads)
+        self.assertEqual(router.db_for_read(Ads), 'default')
+
+    def test_views_opt_in(self):
+        self.client.get(reverse('ads:home'))
+        self.client.get(reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug]))
+        self.assertEqual(self.choose.call_count, 2)
+
+        self.client.force_login(self.user)
+        self.choose.reset_mock()
+        self.client.get(reverse('ads:ad_create'))
+        self.client.post(reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug]))
+        self.choose.assert_not_called()
+
+    @override_settings(REPLICA_PIN_SECONDS=7)
+    def test_writes_pin_the_client_to_the_primary(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('ads:ad_like', args=[self.category.slug, self.ad.slug]))
+        self.assertEqual(response.cookies[replicas.PIN_COOKIE]['max-age'], 7)
+
+        self.client.get(reverse('chat:conversation_list'))
+        self.choose.assert_not_called()
+
+        del self.client.cookies[replicas.PIN_COOKIE]
+        response = self.client.get(reverse('chat:conversation_list'))
+        self.choose.assert_called_once()
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+    async def test_async_requests_route_and_pin(self):
+        async def get_response(request):
+            pass
+
+        self.assertTrue(iscoroutinefunction(replicas.ReplicaRoutingMiddleware(get_response)))
+        await self.async_client.get(reverse('ads:home'))
+        self.choose.assert_called_once()
+
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.post(reverse('ads:ad_like', args=[self.category.slug, self.ad.slug]))
+        # The write happened in a thread; the state it marked is the request's.
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+
+    @override_settings(REPLICA_PIN_SECONDS=7, ADS_PAGE_CACHE_TIMEOUT=300)
+    def test_pages_read_from_a_replica_are_cached_briefly(self):
+        page_cache = get_page_cache()
+        with mock.patch.object(page_cache, 'set', wraps=page_cache.set) as store:
+            self.client.get(reverse('ads:ad_detail', args=[self.category.slug, self.ad.slug]))
+            with override_settings(DATABASE_REPLICAS=[]):
+                self.client.get(reverse('ads:home'))
+        self.assertEqual([call.args[2] for call in store.call_args_list], [7, 300])
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_nothing_to_do_without_replicas(self):
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('ads:ad_like', args=[self.category.slug, self.ad.slug]))
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+        self.client.get(reverse('ads:home'))
+        self.choose.assert_not_called()
+
+
+class StaticFilesTests(TestCase):
+
+    def setUp(self):
+        source, self.root = tempfile.TemporaryDirectory(), tempfile.TemporaryDirectory()
+        self.addCleanup(source.cleanup)
+        self.addCleanup(self.root.cleanup)
+        os.makedirs(os.path.join(source.name, 'css'))
+        self.css = b'.card { margin: 0 auto; padding: 1rem; }\n' * 200
+        with open(os.path.join(source.name, 'css', 'site.css'), 'wb') as file:
+            file.write(self.css)
+        self.enterContext(override_settings(
+            DEBUG=False, STATIC_ROOT=self.root.name, STATICFILES_DIRS=[source.name],
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+            STORAGES={**settings.STORAGES, 'staticfiles': {'BACKEND': 'whitenoise.storage.CompressedManifestStaticFilesStorage'}},
+        ))
+        call_command('collectstatic', interactive=False, verbosity=0)
+        self.url = staticfiles_storage.url('css/site.css')
+
+    def get(self, url, encoding=None):
+        headers = {'HTTP_ACCEPT_ENCODING': encoding} if encoding else {}
+        response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 200)
+        return response, b''.join(response.streaming_content)
+
+    def test_collectstatic_fingerprints_and_precompresses(self):
+        self.assertRegex(self.url, r'^/static/css/site\.[0-9a-f]{12}\.css$')
+        path = os.path.join(self.root.name, self.url[len('/static/'):])
+        self.assertTrue(os.path.exists(path + '.gz'))
+        self.assertTrue(os.path.exists(path + '.br'))
+
+    def test_fingerprinted_files_are_cached_forever(self):
+        response, _ = self.get(self.url)
+        self.assertEqual(response['Cache-Control'], 'max-age=315360000, public, immutable')
+
+        response, _ = self.get('/static/css/site.css')
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    def test_encoding_negotiation(self):
+        response, body = self.get(self.url, 'gzip, deflate, br')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(brotli.decompress(body), self.css)
+
+        response, body = self.get(self.url, 'gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), self.css)
+
+        response, body = self.get(self.url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(body, self.css)
+
+    async def test_served_under_asgi(self):
+        response = await self.async_client.get(self.url, headers={'Accept-Encoding': 'br'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(b''.join(response.streaming_content)), self.css)
+
+
+class MediaServingTests(TestCase):
+
+    def setUp(self):
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=root.name))
+        os.makedirs(os.path.join(root.name, 'ad_images'))
+        self.data = bytes(range(256)) * 4
+        with open(os.path.join(root.name, 'ad_images', 'photo.jpg'), 'wb') as file:
+            file.write(self.data)
+        self.url = settings.MEDIA_URL + 'ad_images/photo.jpg'
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_serves_the_file_with_validators(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertRegex(response['ETag'], r'^"[0-9a-f]+-400-[0-9a-f]+"$')
+        self.assertTrue(response.has_header('Last-Modified'))
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_conditional_get(self):
+        first = self.client.get(self.url)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], first['ETag'])
+
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=first['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_byte_ranges(self):
+        for header, start, end in (('bytes=2-5', 2, 5), ('bytes=1000-', 1000, 1023),
+                                   ('bytes=-10', 1014, 1023), ('bytes=1020-5000', 1020, 1023)):
+            with self.subTest(header):
+                response = self.client.get(self.url, HTTP_RANGE=header)
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(self.body(response), self.data[start:end + 1])
+                self.assertEqual(response['Content-Range'], f'bytes {start}-{end}/1024')
+                self.assertEqual(response['Content-Length'], str(end - start + 1))
+
+    def test_unsatisfiable_and_ignored_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1024')
+
+        # Several ranges: the whole file.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+
+    def test_if_range(self):
+        tag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=tag)
+        self.assertEqual(response.status_code, 206)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"changed"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.data)
+
+    def test_head_has_headers_but_no_body(self):
+        response = self.client.head(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(self.body(response), b'')
+
+    def test_missing_files_and_paths_outside_media_root(self):
+        for path in ('ad_images/missing.jpg', 'ad_images/', '../settings.py', 'ad_images/../../etc/passwd'):
+            with self.subTest(path):
+                self.assertEqual(self.client.get(settings.MEDIA_URL + path).status_code, 404)
+        self.assertEqual(self.client.post(self.url).status_code, 405)
+
+    @override_settings(MEDIA_ACCEL_REDIRECT='/protected-media/')
+    def test_accel_redirect(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/ad_images/photo.jpg')
+        self.assertFalse(response.has_header('Content-Type'))
+        self.assertEqual(response.content, b'')
+
+        self.assertEqual(self.client.get(settings.MEDIA_URL + 'ad_images/missing.jpg').status_code, 404)
+
+
+class ImageRenditionTests(TestCase):
+
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.enterContext(override_settings(MEDIA_ROOT=self.media.name, IMAGE_RENDITIONS={'card': 40, 'detail': 100, 'zoom': 400},
+                                            IMAGE_RENDITIONS_IN_BACKGROUND=False))
+        self.addCleanup(self.media.cleanup)
+        self.user = User.objects.create(username='photographer')
+        self.category = Category.objects.create(name='Photos', slug='photos')
+        self.ad = Ads.objects.create(user=self.user, title='Camera', slug='camera', category=self.category, price=1)
+
+    def upload(self, name='photo.jpg', size=(300, 150)):
+        buffer = BytesIO()
+        Image.new('RGB', size, 'red').save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def test_renditions_are_built_on_upload(self):
+        image = AdImage.objects.create(ad=self.ad, image=self.upload())
+
+        renditions = AdImage.objects.get(pk=image.pk).renditions
+        self.assertEqual(renditions['source'], image.image.name)
+        self.assertEqual((renditions['card']['width'], renditions['card']['height']), (40, 20))
+        self.assertEqual(renditions['detail']['width'], 100)
+        # Never upscaled past the original.
+        self.assertEqual(renditions['zoom']['width'], 300)
+        for name in ('card', 'detail', 'zoom'):
+            for extension, format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                path = os.path.join(self.media.name, renditions[name][extension])
+                with Image.open(path) as rendition:
+                    self.assertEqual(rendition.format, format)
+                    self.assertEqual(rendition.width, renditions[name]['width'])
+
+    def test_unreadable_image_falls_back_to_original(self):
+        image = AdImage.objects.create(ad=self.ad, image='ads/missing.jpg')
+
+        self.assertEqual(image.renditions, {'source': 'ads/missing.jpg'})
+        self.assertEqual(image.rendition_url('card'), '/media/ads/missing.jpg')
+        self.assertEqual(image.srcset(), '')
+
+    def test_card_and_detail_emit_srcset(self):
+        image = AdImage.objects.create(ad=self.ad, image=self.upload())
+        card = image.renditions['card']
+
+        response = self.client.get(reverse('ads:ads_by_category', args=[self.category.slug]))
+        self.assertContains(response, f'<source type="image/webp" srcset="/media/{card["webp"]} 40w, ')
+        self.assertContains(response, f'src="/media/{card["jpeg"]}" srcset="/media/{card["jpeg"]} 40w, ')
+        self.assertContains(response, 'sizes="(min-width: 1024px) 33vw, (min-width: 768px) 50vw, 100vw"')
+
+        response = self.client.get(self.ad.get_absolute_url())
+        self.assertContains(response, f'src="/media/{image.renditions["detail"]["jpeg"]}"')
+        self.assertContains(response, '300w"')
+
+    @override_settings(IMAGE_RENDITIONS_IN_BACKGROUND=True)
+    def test_renditions_are_built_by_a_job_when_in_background(self):
+        image = AdImage.objects.create(ad=self.ad, image=self.upload())
+        self.assertEqual(image.renditions, {})
+        job = Job.objects.get(task='classifieds.images.build_renditions')
+        self.assertEqual(job.kwargs, {'model': 'ads.adimage', 'pk': image.pk})
+
+        self.assertEqual(list(claim_many(10, lease=60)), [job.pk])
+        self.assertEqual(execute(job.pk), Job.SUCCEEDED)
+        image.refresh_from_db()
+        self.assertEqual(image.renditions['card']['width'], 40)
+
+    def test_build_renditions_backfills_in_workers(self):
+        image = AdImage.objects.create(ad=self.ad, image=self.upload())
+        AdImage.objects.filter(pk=image.pk).update(renditions={})
+        fresh = AdImage.objects.create(ad=self.ad, image=self.upload('fresh.jpg'))
+
+        out = io.StringIO()
+        call_command('build_renditions', workers=2, batch_size=1, stdout=out)
+
+        self.assertIn('ad images: 1 rebuilt', out.getvalue())
+        image.refresh_from_db()
+        self.assertEqual(image.renditions['card']['width'], 40)
+        self.assertEqual(AdImage.objects.get(pk=fresh.pk).renditions, fresh.renditions)
+
 
 class AdCreateViewTests(TestCase):
     def setUp(self):
@@ -1102,6 +2172,453 @@ class AdLikeViewTests(TestCase):
         self.assertEqual(response.status_code, 404)
 
 
+    def test_toggle_only_touches_like_counter(self):
+        updated_at = self.ad.updated_at
+        self.ad.title = 'Unsaved title'
+
+        liked, total_likes = self.ad.toggle_like(self.user)
+
+        self.assertEqual((liked, total_likes), (True, 1))
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.title, 'Original Title')
+        self.assertEqual(self.ad.updated_at, updated_at)
+
+    def test_toggle_does_not_load_likers(self):
+        others = [User(username=f'liker{i}') for i in range(5)]
+        User.objects.bulk_create(others)
+        self.ad.users_like.add(*User.objects.filter(username__startswith='liker'))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.ad.toggle_like(self.user)
+        self.assertFalse([query for query in queries if 'auth_user' in query['sql']])
+
+    def test_counter_never_goes_negative(self):
+        self.ad.users_like.add(self.user)
+
+        liked, total_likes = self.ad.toggle_like(self.user)
+
+        self.assertEqual((liked, total_likes), (False, 0))
+
+
+class ReconcileLikesTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='seller')
+        self.category = Category.objects.create(name='Likes', slug='likes')
+        self.likers = [User.objects.create(username=f'fan{i}') for i in range(3)]
+
+    def create_ad(self, title, likers, total_likes):
+        ad = Ads.objects.create(user=self.user, title=title, slug=slugify(title), category=self.category,
+                                price=1, total_likes=total_likes)
+        ad.users_like.add(*likers)
+        return ad
+
+    def test_counters_are_recomputed(self):
+        self.create_ad('Drifted', self.likers, 7)
+        self.create_ad('Correct', self.likers[:1], 1)
+        self.create_ad('Unliked', [], 2)
+
+        call_command('reconcile_likes', batch_size=2, stdout=io.StringIO())
+
+        self.assertEqual(
+            dict(Ads.objects.values_list('title', 'total_likes')),
+            {'Drifted': 3, 'Correct': 1, 'Unliked': 0},
+        )
+
+    def test_only_drifted_ads_are_updated(self):
+        self.create_ad('Drifted', self.likers, 0)
+        self.create_ad('Correct', self.likers[:2], 2)
+
+        self.assertEqual(Ads.objects.reconcile_likes(), 1)
+        self.assertEqual(Ads.objects.reconcile_likes(), 0)
+
+
+class BulkImportExportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.workdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.workdir.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=os.path.join(self.workdir.name, 'media')))
+        self.user = User.objects.create(username='seller')
+        self.other = User.objects.create(username='dealer')
+        self.category = Category.objects.create(name='Bikes')
+
+    def write(self, name, content):
+        path = os.path.join(self.workdir.name, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def import_ads(self, path, **options):
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_ads', path, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def test_csv_import(self):
+        path = self.write('ads.csv', (
+            'title,description,category,user,price,location,postal_code,contact_info,show_contact_info,tags\n'
+            'Road bike,Fast,bikes,,250.50,Chennai,600001,a@example.com,no,"road, ""carbon frame"""\n'
+            'Road bike,Faster,Bikes,dealer,300,Chennai,600001,9876543210,,road\n'
+        ))
+
+        out, err = self.import_ads(path, user='seller', batch_size=1)
+
+        self.assertIn('Imported 2 ads and 0 images', out)
+        self.assertIn('ads/s', out)
+        self.assertEqual(err, '')
+        first, second = Ads.objects.order_by('pk')
+        self.assertEqual((first.slug, first.user, first.price, first.show_contact_info), ('road-bike', self.user, 250.5, False))
+        self.assertEqual(sorted(first.tags.names()), ['carbon frame', 'road'])
+        self.assertEqual((second.slug, second.user, second.category, second.show_contact_info),
+                         ('road-bike-2', self.other, self.category, True))
+        self.assertEqual(get_search_backend().search('carbon'), [first.pk])
+
+    def test_jsonl_import_with_images(self):
+        Image.new('RGB', (20, 10), 'blue').save(os.path.join(self.workdir.name, 'bike.jpg'))
+        path = self.write('ads.jsonl', (
+            '{"title": "Bike", "description": "Red", "category": "Bikes", "price": 10, "location": "Pune", '
+            '"postal_code": "411001", "contact_info": "a@example.com", "tags": ["red", "city"], '
+            '"images": ["bike.jpg"], "event_start_date": "2024-05-01", "event_end_date": "2024-05-02T10:00:00"}\n'
+        ))
+
+        out, _ = self.import_ads(path, user='seller', image_root=self.workdir.name)
+
+        self.assertIn('Imported 1 ads and 1 images', out)
+        self.assertIn('build_renditions', out)
+        ad = Ads.objects.get()
+        self.assertEqual(sorted(ad.tags.names()), ['city', 'red'])
+        self.assertEqual(ad.event_start_date.isoformat(), '2024-05-01T00:00:00+00:00')
+        image = ad.images.get()
+        self.assertTrue(image.image.name.startswith('ads/'))
+        self.assertTrue(os.path.exists(image.image.path))
+
+    def test_images_of_a_rolled_back_batch_are_deleted(self):
+        Image.new('RGB', (20, 10), 'blue').save(os.path.join(self.workdir.name, 'bike.jpg'))
+        path = self.write('ads.jsonl', (
+            '{"title": "Bike", "description": "Red", "category": "Bikes", "price": 10, "location": "Pune", '
+            '"postal_code": "411001", "contact_info": "a@example.com", "images": ["bike.jpg"]}\n'
+        ))
+        bulk_create = AdImage.objects.bulk_create
+        calls = []
+
+        def clash_once(images):
+            calls.append(images)
+            if len(calls) == 1:
+                raise IntegrityError('UNIQUE constraint failed: ads_ads.slug')
+            return bulk_create(images)
+
+        with mock.patch.object(AdImage.objects, 'bulk_create', side_effect=clash_once):
+            out, _ = self.import_ads(path, user='seller', image_root=self.workdir.name)
+
+        self.assertIn('Imported 1 ads and 1 images', out)
+        self.assertEqual(len(calls), 2)
+        stored = [name for _, _, names in os.walk(settings.MEDIA_ROOT) for name in names]
+        self.assertEqual(stored, [os.path.basename(Ads.objects.get().images.get().image.name)])
+
+    def test_invalid_records_are_skipped(self):
+        path = self.write('ads.jsonl', '\n'.join([
+            '{"title": "Good", "description": "d", "category": "bikes", "price": 1, "location": "l", '
+            '"postal_code": "12345", "contact_info": "c"}',
+            '{"title": "", "description": "d", "category": "bikes", "price": 1, "location": "l", '
+            '"postal_code": "12345", "contact_info": "c"}',
+            '{"title": "No category", "description": "d", "category": "cars", "price": 1, "location": "l", '
+            '"postal_code": "12345", "contact_info": "c"}',
+            '{"title": "Bad price", "description": "d", "category": "bikes", "price": "cheap", "location": "l", '
+            '"postal_code": "12345", "contact_info": "c"}',
+            '{"title": "Unknown seller", "user": "nobody", "description": "d", "category": "bikes", "price": 1, '
+            '"location": "l", "postal_code": "12345", "contact_info": "c"}',
+            'not json',
+        ]))
+
+        out, err = self.import_ads(path, user='seller')
+
+        self.assertIn('Imported 1 ads', out)
+        self.assertIn('skipped 5 invalid records', out)
+        self.assertIn('Line 2: title: This field cannot be blank.', err)
+        self.assertIn("Line 3: category: No such category: 'cars'.", err)
+        self.assertIn("Line 4: price: Not a number: 'cheap'.", err)
+        self.assertIn("Line 5: user: No such user: 'nobody'.", err)
+        self.assertIn('Line 6: Invalid JSON', err)
+        self.assertEqual(list(Ads.objects.values_list('title', flat=True)), ['Good'])
+
+    def test_missing_categories_can_be_created(self):
+        path = self.write('ads.csv', (
+            'title,description,category,price,location,postal_code,contact_info\n'
+            'Car,d,Cars,1,l,12345,c\n'
+            'Van,d,cars,1,l,12345,c\n'
+        ))
+
+        self.import_ads(path, user='seller', create_categories=True)
+
+        self.assertEqual(Category.objects.get(slug='cars').ads_set.count(), 2)
+
+    def test_batch_falls_back_when_a_slug_was_taken_meanwhile(self):
+        path = self.write('ads.csv', (
+            'title,description,category,price,location,postal_code,contact_info\n'
+            'Bike,d,bikes,1,l,12345,c\n'
+        ))
+        with mock.patch('ads.bulk.allocate_slugs', return_value=['taken']):
+            Ads.objects.create(user=self.user, title='Other', slug='taken', category=self.category, price=1)
+            self.import_ads(path, user='seller')
+
+        self.assertEqual(Ads.objects.get(title='Bike').slug, 'bike')
+
+    def test_export_round_trip(self):
+        ad = Ads.objects.create(user=self.user, title='Bike', description='Red', category=self.category, price=10,
+                                location='Pune', postal_code='411001', contact_info='a@example.com')
+        ad.tags.add('red', 'two words')
+        paths = [os.path.join(self.workdir.name, name) for name in ('ads.csv', 'ads.jsonl')]
+        for path in paths:
+            call_command('export_ads', path, batch_size=1, stdout=io.StringIO())
+        for path in paths:
+            self.import_ads(path)
+
+        copies = Ads.objects.exclude(pk=ad.pk).order_by('pk')
+        self.assertEqual([copy.slug for copy in copies], ['bike-2', 'bike-3'])
+        for copy in copies:
+            self.assertEqual((copy.user, copy.category, copy.price, copy.description), (self.user, self.category, 10, 'Red'))
+            self.assertEqual(sorted(copy.tags.names()), ['red', 'two words'])
+
+    def test_export_to_standard_output(self):
+        Ads.objects.create(user=self.user, title='Bike', category=self.category, price=10)
+        out, err = io.StringIO(), io.StringIO()
+
+        call_command('export_ads', '-', format='jsonl', stdout=out, stderr=err)
+
+        record = json.loads(out.getvalue())
+        self.assertEqual((record['slug'], record['category'], record['user'], record['price']),
+                         ('bike', 'bikes', 'seller', '10.00'))
+        self.assertIn('Exported 1 ads', err.getvalue())
+
+
+class BenchmarkCommandTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=self.media.name))
+        call_command('seed_bench', users=4, ads=40, chats=3, messages=5, batch_size=7, stdout=io.StringIO())
+
+    def test_seeded_data(self):
+        self.assertEqual(User.objects.filter(username__startswith='bench-').count(), 4)
+        self.assertEqual(Ads.objects.count(), 40)
+        self.assertEqual(Ads.objects.values('slug').distinct().count(), 40)
+        self.assertEqual(Ads.objects.reconcile_likes(), 0)
+        self.assertTrue(AdImage.objects.exists())
+        self.assertTrue(os.path.exists(AdImage.objects.first().image.path))
+        ad = Ads.objects.first()
+        self.assertIn(ad.pk, get_search_backend().search(ad.title, limit=40))
+
+        for chat in Chat.objects.all():
+            self.assertEqual(chat.messages.count(), 5)
+            self.assertEqual(set(chat.users.values_list('pk', flat=True)), {chat.buyer_id, chat.seller_id})
+            last = chat.messages.order_by('-id').first()
+            self.assertEqual(chat.last_message_id, last.pk)
+            # Only the last message, sent by the buyer, is unread, by the seller.
+            self.assertEqual(
+                dict(chat.inbox_entries.values_list('user_id', 'unread_count')),
+                {chat.buyer_id: 0, chat.seller_id: 1},
+            )
+        self.assertEqual(Chat.objects.count(), 3)
+
+    def test_prefix_must_be_unused(self):
+        with self.assertRaises(CommandError):
+            call_command('seed_bench', users=1, ads=0, chats=0, stdout=io.StringIO())
+
+    def test_every_url_is_benchmarked(self):
+        user = Chat.objects.first().seller
+        out = io.StringIO()
+
+        call_command('run_bench', user=user.username, requests=2, warmup=0, stdout=out)
+
+        report = json.loads(out.getvalue())
+        self.assertEqual(report['mode'], 'test_client')
+        self.assertEqual(report['uncovered'], [])
+        self.assertIn('chat:conversation_detail [logged in]', report['results'])
+        for label, result in report['results'].items():
+            self.assertTrue(all(int(status) < 400 for status in result['status']), (label, result))
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertIsNotNone(result['queries'])
+
+    def data(self):
+        return (
+            list(Message.objects.order_by('pk').values_list('pk', flat=True)),
+            list(Chat.objects.order_by('pk').values_list('last_message_id', flat=True)),
+            list(ChatInbox.objects.order_by('pk').values_list('last_read_message_id', 'unread_count')),
+            list(Ads.objects.order_by('pk').values_list('show_contact_info', 'total_likes')),
+            list(Ads.users_like.through.objects.order_by('pk').values_list('ads_id', 'user_id')),
+        )
+
+    def test_writes_are_rolled_back(self):
+        user = Chat.objects.first().seller
+        before = self.data()
+
+        # An odd number of likes would leave the ad liked.
+        call_command('run_bench', user=user.username, requests=3, warmup=0, stdout=io.StringIO())
+
+        self.assertEqual(self.data(), before)
+
+    def test_checkpoints_undo_writes_made_over_http(self):
+        user = Chat.objects.first().seller
+        before = self.data()
+        writes = [scenario for scenario in run_bench.Command().scenarios(user) if scenario.writes]
+        self.assertEqual([scenario.name for scenario in writes],
+                         ['ads:ad_like', 'ads:toggle_contact_info', 'chat:mark_read', 'chat:send_message'])
+        restores = [scenario.checkpoint() for scenario in writes]
+
+        self.client.force_login(user)
+        for scenario in writes:
+            for _ in range(3):
+                self.assertLess(self.client.post(scenario.path, scenario.data).status_code, 400)
+        self.assertNotEqual(self.data(), before)
+        for restore in restores:
+            restore()
+
+        self.assertEqual(self.data(), before)
+
+
+@override_settings(ADS_LIKE_COUNTER='buffered', ADS_LIKE_COUNTER_SHARDS=4)
+class BufferedLikeCounterTests(TestCase):
+
+    def setUp(self):
+        self.seller = User.objects.create(username='seller')
+        self.category = Category.objects.create(name='Viral', slug='viral')
+        self.ad = Ads.objects.create(user=self.seller, title='Viral', slug='viral', category=self.category,
+                                     price=1, total_likes=10)
+        self.users = [User.objects.create(username=f'fan{i}') for i in range(6)]
+
+    def test_likes_are_buffered_not_written_to_the_ad(self):
+        for user in self.users:
+            liked, total_likes = self.ad.toggle_like(user)
+
+        self.assertTrue(liked)
+        self.assertEqual(total_likes, 16)
+        self.assertEqual(self.ad.users_like.count(), 6)
+        self.assertEqual(Ads.objects.get(pk=self.ad.pk).total_likes, 10)
+        self.assertEqual(LikeCounterShard.objects.pending(self.ad.pk), 6)
+        self.assertLessEqual(LikeCounterShard.objects.count(), 4)
+
+    def test_reads_merge_pending_delta(self):
+        self.ad.toggle_like(self.users[0])
+        self.ad.toggle_like(self.users[1])
+        self.ad.toggle_like(self.users[0])
+
+        self.assertEqual(Ads.objects.get(pk=self.ad.pk).like_count, 11)
+        self.assertEqual(Ads.objects.with_pending_likes().get(pk=self.ad.pk).pending_likes, 1)
+
+        self.client.force_login(self.users[0])
+        response = self.client.get(self.ad.get_absolute_url())
+        self.assertContains(response, "likeComponent(false, 11,")
+
+    def test_flush_folds_deltas_into_total_likes(self):
+        for user in self.users:
+            self.ad.toggle_like(user)
+        self.ad.toggle_like(self.users[0])
+
+        call_command('flush_like_counters', batch_size=1, stdout=io.StringIO())
+
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.total_likes, 15)
+        self.assertFalse(LikeCounterShard.objects.exists())
+        self.assertEqual(self.ad.like_count, 15)
+
+    def test_flush_never_goes_negative(self):
+        LikeCounterShard.objects.add(self.ad.pk, -25)
+
+        self.assertEqual(LikeCounterShard.objects.flush(), 1)
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.total_likes, 0)
+
+    def test_like_view_returns_merged_count(self):
+        self.client.force_login(self.users[0])
+        response = self.client.post(reverse('ads:ad_like', args=[self.category.slug, self.ad.slug]))
+
+        self.assertEqual(response.json(), {'liked': True, 'total_likes': 11})
+        self.assertEqual(Ads.objects.get(pk=self.ad.pk).total_likes, 10)
+
+    def test_likes_schedule_one_background_flush(self):
+        for user in self.users:
+            self.ad.toggle_like(user)
+
+        job = Job.objects.get()
+        self.assertEqual(job.task, 'ads.tasks.flush_like_counters')
+        self.assertGreater(job.run_at, timezone.now())
+
+        Job.objects.update(run_at=timezone.now())
+        claim_many(1, lease=60)
+        execute(job.pk)
+        self.assertEqual(Ads.objects.get(pk=self.ad.pk).total_likes, 16)
+
+    def test_reconcile_flushes_pending_deltas_first(self):
+        self.ad.toggle_like(self.users[0])
+
+        call_command('reconcile_likes', stdout=io.StringIO())
+
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.total_likes, 1)
+        self.assertEqual(self.ad.like_count, 1)
+
+
+class ConcurrentLikeTests(TransactionTestCase):
+    """Parallel likers, each on its own connection, must all be counted."""
+
+    likers = 8
+
+    def setUp(self):
+        seller = User.objects.create(username='seller')
+        category = Category.objects.create(name='Concurrent', slug='concurrent')
+        self.ad = Ads.objects.create(user=seller, title='Popular', slug='popular', category=category, price=1)
+        self.users = [User.objects.create(username=f'liker{i}') for i in range(self.likers)]
+
+    def toggle_in_parallel(self, users):
+        barrier = threading.Barrier(len(users))
+        errors = []
+
+        def like(user):
+            try:
+                barrier.wait()
+                for attempt in range(100):
+                    try:
+                        Ads.objects.get(pk=self.ad.pk).toggle_like(user)
+                        break
+                    except OperationalError:
+                        # SQLite allows one writer at a time; a locked database is
+                        # retried, it must never lose or double count a like.
+                        time.sleep(0.01)
+                else:
+                    errors.append(user)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=like, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def test_parallel_likes_are_exact(self):
+        self.toggle_in_parallel(self.users)
+
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.total_likes, self.likers)
+        self.assertEqual(self.ad.users_like.count(), self.likers)
+
+    def test_parallel_likes_and_unlikes_are_exact(self):
+        self.ad.users_like.add(*self.users[:4])
+        Ads.objects.filter(pk=self.ad.pk).update(total_likes=4)
+
+        self.toggle_in_parallel(self.users)
+
+        self.ad.refresh_from_db()
+        self.assertEqual(self.ad.total_likes, self.likers - 4)
+        self.assertEqual(set(self.ad.users_like.all()), set(self.users[4:]))
+
+
 class AdToggleContactInfoTests(TestCase):
     def setUp(self):
         self.user = User.objects.create_user(username='testuser', password='testpassword')
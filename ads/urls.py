@@ -13,6 +13,8 @@ urlpatterns = [
     path('category/<slug:category_slug>/ads/<slug:ad_slug>/like/', views.AdLikeView.as_view() , name='ad_like'),
     path('category/<slug:category_slug>/ads/<slug:ad_slug>/toggle_contact_info/', views.AdToggleContactInfo.as_view() , name='toggle_contact_info'),
 
+    path('search/', views.AdSearchView.as_view(), name='search'),
+    path('autocomplete/<str:field>/', views.AutocompleteView.as_view(), name='autocomplete'),
     path('ad/new/', views.AdCreateView.as_view(), name='ad_create') ,
 
 ]
@@ -1,51 +1,116 @@
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView
 from .models import Ads, Category
+from .search import SearchResults
+from .autocomplete import MAX_RESULTS, SOURCES, get_source
+from .cache import AnonymousPageCacheMixin
+from .filters import AdFilter
 from chat.models import Chat,Message
 from django.shortcuts import get_object_or_404,redirect
 from .forms import AdsForm, AdImageFormSet
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.urls import reverse_lazy
-from django.http import HttpResponseForbidden
+from django.http import Http404, HttpResponseForbidden
 from functools import wraps
+from urllib.parse import urlencode
 from django.views import View
 from django.http import JsonResponse,HttpResponseRedirect
+from django.db import transaction
+from classifieds.pagination import CursorPaginationMixin
 
 
-class HomeView(ListView):
+class HomeView(AnonymousPageCacheMixin, ListView):
     model = Category
     template_name = 'ads/home.html'
     context_object_name = 'categories'
     paginate_by = 6
+    query_budget = 5
+    read_replica = True
 
+    def get_cache_scopes(self):
+        return ['categories']
 
-class AdsListView(ListView):
+
+class AdsListView(AnonymousPageCacheMixin, CursorPaginationMixin, ListView):
     model = Ads
     template_name = 'ads/ads_list.html'
     context_object_name = 'ads'
     paginate_by = 6
+    query_budget = 9
+    read_replica = True
+
+    def get_cache_scopes(self):
+        return ['categories', f"category:{self.kwargs['category_slug']}"]
 
     def get_queryset(self):
         self.category = get_object_or_404(Category, slug=self.kwargs['category_slug'])
-        return Ads.objects.filter(category=self.category)
+        self.filter = AdFilter(self.request.GET, Ads.objects.filter(category=self.category))
+        return self.filter.qs.for_listing()
         
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['category'] = self.category
+        context['filter_form'] = self.filter.form
+        context['filter_active'] = self.filter.is_active
+        context['facets'] = self.filter.facets()
+        return context
+
+
+class AdSearchView(ListView):
+    template_name = 'ads/search_results.html'
+    context_object_name = 'ads'
+    paginate_by = 6
+    query_budget = 7
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()
+        return SearchResults(self.query)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.query
+        context['querystring'] = urlencode({'q': self.query})
         return context
 
 
-class AdDetailView(DetailView):
+class AutocompleteView(View):
+    """The most used tags or locations starting with ``?q=``, as JSON."""
+    # Loading an index takes up to three (content type, newest row, counts);
+    # after that, at most one.
+    query_budget = 3
+
+    def get(self, request, field):
+        if field not in SOURCES:
+            raise Http404('Unknown field.')
+        try:
+            limit = min(max(int(request.GET.get('limit', 8)), 1), MAX_RESULTS)
+        except ValueError:
+            limit = 8
+        results = get_source(field).lookup(request.GET.get('q', ''), limit)
+        response = JsonResponse({'results': [{'value': value, 'count': count} for value, count in results]})
+        response['Cache-Control'] = 'max-age=60'
+        return response
+
+
+class AdDetailView(AnonymousPageCacheMixin, DetailView):
     model = Ads
     template_name = 'ads/ad_detail.html'
     context_object_name = 'ad'
-
-    def get_object(self):
-        return get_object_or_404(Ads, slug=self.kwargs['ad_slug'], category__slug=self.kwargs['category_slug'])
+    # Starting a chat (POST) sends the first message and fills both inboxes.
+    query_budget = {'GET': 5}
+    read_replica = True
+
+    def get_cache_scopes(self):
+        return ['categories', f"ad:{self.kwargs['ad_slug']}"]
+
+    def get_object(self, queryset=None):
+        return get_object_or_404(
+            Ads.objects.for_detail(self.request.user),
+            slug=self.kwargs['ad_slug'], category__slug=self.kwargs['category_slug'],
+        )
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        ad = self.get_object()
-        context['user_has_liked'] = self.request.user in ad.users_like.all()
+        context['user_has_liked'] = self.object.user_has_liked
         return context
     
     def post(self, request, *args, **kwargs):
@@ -54,21 +119,22 @@ class AdDetailView(DetailView):
             return HttpResponseForbidden("You need to log in to start a conversation.")
         
         self.ad = self.get_object()
-        chat = Chat.objects.filter(ad=self.ad, users=request.user).filter(users=self.ad.user).first()
-        print('chat',chat)
-        if chat:
-            return redirect('chat:conversation_detail', chat_id=chat.id)
-        else:   
-            chat_obj = Chat.objects.create(ad=self.ad)
-            chat_obj.users.set([request.user, self.ad.user])
-            
-            Message.objects.create(
-                sender=request.user,
-                receiver=self.ad.user,
-                chat=chat_obj,
-                message=f"Hi, I am {request.user.username}. I am interested in your ad posting."
-            )
-            return redirect('chat:conversation_detail', chat_id=chat_obj.id)
+        if self.ad.user_id == request.user.id:
+            return redirect(self.ad.get_absolute_url())
+
+        # get_or_create retries the lookup if a concurrent click created the
+        # chat first; the unique (ad, buyer, seller) index makes that lookup one probe.
+        with transaction.atomic():
+            chat, created = Chat.objects.get_or_create(ad=self.ad, buyer=request.user, seller_id=self.ad.user_id)
+            if created:
+                chat.users.set([request.user.id, self.ad.user_id])
+                Message.objects.create(
+                    sender=request.user,
+                    receiver_id=self.ad.user_id,
+                    chat=chat,
+                    message=f"Hi, I am {request.user.username}. I am interested in your ad posting."
+                )
+        return redirect('chat:conversation_detail', chat_id=chat.id)
     
 
 class AdCreateView(LoginRequiredMixin, CreateView):
@@ -89,7 +155,6 @@ class AdCreateView(LoginRequiredMixin, CreateView):
         image_form = AdImageFormSet(self.request.POST,self.request.FILES, instance=self.object)
 
         if form.is_valid() and image_form.is_valid():
-            print("form.is_valid()")
             self.object = form.save()
             image_form.instance = self.object
             image_form.save()
@@ -178,20 +243,11 @@ class AdLikeView(LoginRequiredMixin, View):
     def post(self, request, category_slug, ad_slug, *args, **kwargs):
         ad = get_object_or_404(Ads, category__slug=category_slug, slug=ad_slug)
 
-        if request.user in ad.users_like.all():
-            ad.users_like.remove(request.user)
-            ad.total_likes -= 1
-            ad.save()
-            liked = False
-        else:
-            ad.users_like.add(request.user)
-            liked = True
-            ad.total_likes += 1
-            ad.save()
+        liked, total_likes = ad.toggle_like(request.user)
 
         return JsonResponse({
             'liked': liked,
-            'total_likes': ad.total_likes,
+            'total_likes': total_likes,
         })
 
 
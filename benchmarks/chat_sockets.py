@@ -0,0 +1,227 @@
+"""
+Load test of live chat delivery: thousands of concurrent WebSockets on one node.
+
+Creates a throwaway SQLite database (or uses --database-url, which must be
+empty), migrates it and creates one two-person chat per pair of sockets,
+with a logged-in session for every participant. It then opens all sockets
+concurrently against ``chat.realtime.websocket_app``, the same ASGI
+callable ``classifieds.asgi`` mounts, and drives it in-process the way an
+ASGI server would, so the figures cover authentication, the broker fan-out
+and per-user rendering but not the server's WebSocket framing.
+
+Messages are saved through the ORM, so the full path from the post_save
+signal to every participant's socket is timed. Results are printed as JSON.
+
+    python benchmarks/chat_sockets.py --sockets 5000
+    CHAT_BROKER_URL=redis://localhost:6379/0 python benchmarks/chat_sockets.py --sockets 5000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifieds.bench import scratch_database, setup_django, summary  # noqa: E402
+
+
+def load_chats(total_chats, batch_size):
+    """Create the chats and return ``[(chat_id, user_id, session_key), ...]``, two per chat."""
+    from django.conf import settings
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+    from django.contrib.auth.models import User
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.contrib.sessions.models import Session
+    from django.db import transaction
+    from django.utils import timezone
+    from django.utils.crypto import get_random_string
+    from ads.models import Ads, Category
+    from chat.models import Chat
+
+    seller = User.objects.create(username='bench-seller')
+    category = Category.objects.create(name='Bench')
+    ad = Ads.objects.create(
+        user=seller, category=category, title='Bench ad', description='Bench', location='Bench',
+        postal_code='560001', contact_info='bench@example.com', price=1,
+    )
+    backend = settings.AUTHENTICATION_BACKENDS[0]
+    expire_date = timezone.now() + timezone.timedelta(days=1)
+    encoder = SessionStore()
+
+    sockets = []
+    for start in range(0, total_chats, batch_size):
+        count = min(batch_size, total_chats - start)
+        with transaction.atomic():
+            users = User.objects.bulk_create([
+                User(username=f'bench-{start * 2 + number}', password='!') for number in range(count * 2)
+            ])
+            chats = Chat.objects.bulk_create([Chat(ad=ad) for _ in range(count)])
+            Chat.users.through.objects.bulk_create([
+                Chat.users.through(chat_id=chat.id, user_id=user.id)
+                for number, chat in enumerate(chats)
+                for user in users[number * 2:number * 2 + 2]
+            ])
+            sessions = []
+            for number, user in enumerate(users):
+                key = get_random_string(32, 'abcdefghijklmnopqrstuvwxyz0123456789')
+                data = {SESSION_KEY: str(user.pk), BACKEND_SESSION_KEY: backend, HASH_SESSION_KEY: user.get_session_auth_hash()}
+                sessions.append(Session(session_key=key, session_data=encoder.encode(data), expire_date=expire_date))
+                sockets.append((chats[number // 2].id, user.id, key))
+            Session.objects.bulk_create(sessions)
+    return sockets
+
+
+class Socket:
+    """One client: feeds the ASGI app its receive() events and records what it sends."""
+
+    def __init__(self, chat_id, user_id, session_key, received):
+        from django.conf import settings
+        from django.utils.crypto import get_random_string
+        from chat.realtime import websocket_path
+
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.inbox = asyncio.Queue()
+        self.accepted = asyncio.get_running_loop().create_future()
+        self.received = received
+        self.scope = {
+            'type': 'websocket',
+            'path': websocket_path(chat_id),
+            'query_string': b'',
+            'headers': [
+                (b'host', b'testserver'),
+                (b'cookie', f'{settings.SESSION_COOKIE_NAME}={session_key}; {settings.CSRF_COOKIE_NAME}={get_random_string(32)}'.encode()),
+            ],
+        }
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def send(self, message):
+        if message['type'] == 'websocket.accept':
+            self.accepted.set_result(True)
+        elif message['type'] == 'websocket.close':
+            self.accepted.set_exception(ConnectionRefusedError(self.scope['path']))
+        elif message['type'] == 'websocket.send':
+            json.loads(message['text'])
+            self.received(self.chat_id, time.perf_counter())
+
+
+async def run(sockets, messages, burst, seed):
+    from asgiref.sync import sync_to_async
+    from chat.models import Message
+    from chat.realtime import websocket_app
+
+    rng = random.Random(seed)
+    loop = asyncio.get_running_loop()
+    # Keyed by chat: a chat never has more than one message in flight.
+    sent_at = {}
+    pending = {}
+    done = {}
+    latencies = []
+
+    def received(chat_id, now):
+        if chat_id in pending:
+            latencies.append((now - sent_at[chat_id]) * 1000)
+            pending[chat_id] -= 1
+            if not pending[chat_id]:
+                del pending[chat_id]
+                done.pop(chat_id).set_result(True)
+
+    clients = [Socket(chat_id, user_id, key, received) for chat_id, user_id, key in sockets]
+
+    started = time.perf_counter()
+    tasks = [loop.create_task(websocket_app(client.scope, client.receive, client.send)) for client in clients]
+    for client in clients:
+        client.inbox.put_nowait({'type': 'websocket.connect'})
+    await asyncio.gather(*(client.accepted for client in clients))
+    connect_seconds = time.perf_counter() - started
+
+    participants = {}
+    for client in clients:
+        participants.setdefault(client.chat_id, []).append(client.user_id)
+    chat_ids = list(participants)
+
+    @sync_to_async
+    def send_message(chat_id):
+        sender, receiver = participants[chat_id]
+        # Published to the broker by the post_save signal.
+        Message.objects.create(sender_id=sender, receiver_id=receiver, chat_id=chat_id, message='Is this still available?')
+
+    async def deliver(chat_ids):
+        futures = []
+        for chat_id in chat_ids:
+            # Both participants have a socket open on the chat.
+            pending[chat_id] = len(participants[chat_id])
+            done[chat_id] = future = loop.create_future()
+            futures.append(future)
+            sent_at[chat_id] = time.perf_counter()
+            await send_message(chat_id)
+        await asyncio.wait_for(asyncio.gather(*futures), 60)
+
+    # Paced: one message at a time, for latency.
+    for _ in range(messages):
+        await deliver([rng.choice(chat_ids)])
+    paced = list(latencies)
+
+    # Burst: many chats at once, for throughput.
+    latencies.clear()
+    started = time.perf_counter()
+    await deliver(rng.sample(chat_ids, min(burst, len(chat_ids))))
+    burst_seconds = time.perf_counter() - started
+
+    for client in clients:
+        client.inbox.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+    await asyncio.gather(*tasks)
+
+    return {
+        'sockets': len(clients),
+        'chats': len(chat_ids),
+        'connect_seconds': round(connect_seconds, 2),
+        'connects_per_second': round(len(clients) / connect_seconds, 1),
+        'paced_messages': messages,
+        'paced_delivery': summary(paced),
+        'burst_messages': min(burst, len(chat_ids)),
+        'burst_seconds': round(burst_seconds, 3),
+        'burst_deliveries_per_second': round(len(latencies) / burst_seconds, 1) if burst_seconds else None,
+        'burst_delivery': summary(latencies),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sockets', type=int, default=5000, help='Concurrent sockets, two per chat.')
+    parser.add_argument('--messages', type=int, default=200, help='Messages sent one at a time.')
+    parser.add_argument('--burst', type=int, default=1000, help='Messages sent at once, one per chat.')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--database-url')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with scratch_database('classifieds-chat-bench-', args.database_url):
+        setup_django()
+
+        from django.core.management import call_command
+        from chat.broker import get_broker
+
+        call_command('migrate', verbosity=0)
+
+        started = time.perf_counter()
+        sockets = load_chats(max(args.sockets // 2, 1), args.batch_size)
+        load_seconds = time.perf_counter() - started
+
+        results = asyncio.run(run(sockets, args.messages, args.burst, args.seed))
+        print(json.dumps({
+            'broker': type(get_broker()).__name__,
+            'load_seconds': round(load_seconds, 2),
+            **results,
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Check read replica routing with two SQLite files standing in for a primary
+and a replica.
+
+Migrates and seeds the primary, copies it to the replica, then changes an ad
+on the primary only, so the replica lags behind the way a real one can. It
+then makes requests with the test client and counts the queries each
+database alias served:
+
+* anonymous and logged-in reads of the replica-enabled views go to the
+  replica and show the stale title;
+* a like (a write) goes to the primary and pins the client to it, so its
+  next read shows the fresh title;
+* once the pin expires, the client reads from the replica again;
+* views without ``read_replica`` read from the primary.
+
+Prints the steps as JSON and exits with status 1 if any check fails.
+
+    python benchmarks/replica_routing.py
+"""
+import json
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifieds.bench import scratch_directory, setup_django  # noqa: E402
+
+STALE_TITLE = 'Title on the replica'
+FRESH_TITLE = 'Title on the primary'
+
+
+def main():
+    with scratch_directory('classifieds-replica-check-') as workdir:
+        return check(workdir)
+
+
+def check(workdir):
+    primary = os.path.join(workdir, 'primary.sqlite3')
+    replica = os.path.join(workdir, 'replica.sqlite3')
+    os.environ['DATABASE_URL'] = f'sqlite:///{primary}'
+    os.environ['DATABASE_REPLICA_URLS'] = f'sqlite:///{replica}'
+    os.environ.setdefault('METRICS_LOG_LEVEL', 'WARNING')
+    setup_django()
+
+    from contextlib import ExitStack
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connections
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+    from django.urls import reverse
+    from ads.models import Ads
+    from classifieds.replicas import PIN_COOKIE
+
+    try:
+        call_command('migrate', verbosity=0)
+        call_command('seed_bench', users=10, ads=50, chats=10, messages=5, max_images=0, verbosity=0,
+                     stdout=open(os.devnull, 'w'))
+        ad = Ads.objects.select_related('category').filter(user__username='bench-1').first()
+        Ads.objects.filter(pk=ad.pk).update(title=STALE_TITLE)
+
+        host = next((host for host in settings.ALLOWED_HOSTS if host != '*' and not host.startswith('.')), 'localhost')
+        anonymous = Client(HTTP_HOST=host)
+        user = Client(HTTP_HOST=host)
+        # Before the copy, so the session is on both.
+        user.login(username='bench-0', password='bench-password')
+
+        connections.close_all()
+        with sqlite3.connect(primary) as source, sqlite3.connect(replica) as target:
+            source.backup(target)
+        # Only on the primary: the replica has not caught up yet.
+        ad.title = FRESH_TITLE
+        ad.save()
+
+        detail = reverse('ads:ad_detail', args=[ad.category.slug, ad.slug])
+        steps, failures = [], []
+
+        def request(name, client, method, path, expected_alias, expected_title=None):
+            with ExitStack() as stack:
+                captured = {alias: stack.enter_context(CaptureQueriesContext(connections[alias]))
+                            for alias in settings.DATABASES}
+                response = getattr(client, method)(path)
+            queries = {alias: len(queries) for alias, queries in captured.items()}
+            content = response.content.decode() if method == 'get' else ''
+            step = {
+                'step': name,
+                'status': response.status_code,
+                'queries': queries,
+                'pinned': PIN_COOKIE in client.cookies and client.cookies[PIN_COOKIE].value != '',
+            }
+            others = sum(count for alias, count in queries.items() if alias != expected_alias)
+            if not queries[expected_alias] or others:
+                failures.append(f'{name}: expected every query on {expected_alias}, got {queries}')
+            if expected_title:
+                step['title'] = expected_title if expected_title in content else 'other'
+                if expected_title not in content:
+                    failures.append(f'{name}: expected {expected_title!r} in the page')
+            steps.append(step)
+
+        request('anonymous ad detail', anonymous, 'get', detail, 'replica1', STALE_TITLE)
+        request('logged-in home', user, 'get', reverse('ads:home'), 'replica1')
+        request('logged-in conversations', user, 'get', reverse('chat:conversation_list'), 'replica1')
+        request('ad create form (not routed)', user, 'get', reverse('ads:ad_create'), 'default')
+        request('like (write)', user, 'post', reverse('ads:ad_like', args=[ad.category.slug, ad.slug]), 'default')
+        request('ad detail right after the like', user, 'get', detail, 'default', FRESH_TITLE)
+        # The cookie expiring, as it does REPLICA_PIN_SECONDS later.
+        del user.cookies[PIN_COOKIE]
+        request('ad detail once the pin expired', user, 'get', detail, 'replica1', STALE_TITLE)
+
+        print(json.dumps({'steps': steps, 'failures': failures}, indent=2))
+        return 1 if failures else 0
+    finally:
+        # Before the scratch directory and its database files go.
+        connections.close_all()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
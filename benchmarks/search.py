@@ -0,0 +1,123 @@
+"""
+Benchmark ad search on a large synthetic catalogue.
+
+Creates a throwaway SQLite database (or uses --database-url, e.g. a scratch
+Postgres, which must be empty), migrates it, loads synthetic ads with tags,
+rebuilds the search index and then times ranked full-text queries against an
+unindexed ``icontains`` scan of the same terms. Results are printed as JSON.
+
+    python benchmarks/search.py --ads 1000000
+    python benchmarks/search.py --ads 1000000 --database-url postgres://localhost/classifieds_bench
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from classifieds.bench import scratch_database, setup_django, timed  # noqa: E402
+
+WORDS = (
+    'bike car flat house sofa table phone laptop guitar piano camera lens watch shoes jacket bed '
+    'desk chair cooler fridge washer scooter helmet tent drone printer monitor keyboard speaker '
+    'vintage new used mint rare cheap premium compact large spacious wooden leather electric manual '
+    'blue red black white silver gold green family student office garden kitchen travel sports'
+).split()
+LOCATIONS = ['Bengaluru', 'Chennai', 'Mumbai', 'Delhi', 'Hyderabad', 'Pune', 'Kolkata', 'Kochi', 'Jaipur', 'Mysuru']
+QUERIES = ['bike', 'vintage guitar', 'leather sofa chennai', 'camera lens', 'electric scooter pune', 'prem', 'drone']
+
+
+def load_ads(total, batch_size, seed):
+    from django.contrib.auth.models import User
+    from django.contrib.contenttypes.models import ContentType
+    from taggit.models import Tag, TaggedItem
+    from ads.models import Ads, Category
+
+    rng = random.Random(seed)
+    user = User.objects.create(username='bench-seller')
+    categories = [Category.objects.create(name=f'Bench {i}') for i in range(8)]
+    tags = Tag.objects.bulk_create([Tag(name=f'tag-{word}', slug=f'tag-{word}') for word in WORDS])
+    content_type = ContentType.objects.get_for_model(Ads)
+
+    for start in range(0, total, batch_size):
+        ads = []
+        for number in range(start, min(start + batch_size, total)):
+            title = ' '.join(rng.sample(WORDS, 3)).capitalize()
+            ads.append(Ads(
+                user=user,
+                category=rng.choice(categories),
+                title=title,
+                slug=f'bench-{number}',
+                description=' '.join(rng.choices(WORDS, k=40)),
+                location=rng.choice(LOCATIONS),
+                postal_code='560001',
+                contact_info='bench@example.com',
+                price=rng.randint(100, 100000),
+            ))
+        ads = Ads.objects.bulk_create(ads)
+        TaggedItem.objects.bulk_create([
+            TaggedItem(content_type=content_type, object_id=ad.pk, tag=tag)
+            for ad in ads
+            for tag in rng.sample(tags, rng.randint(0, 3))
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ads', type=int, default=1_000_000)
+    parser.add_argument('--batch-size', type=int, default=20_000)
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs per full-text query.')
+    parser.add_argument('--scan-repeat', type=int, default=3, help='Timed runs per icontains scan.')
+    parser.add_argument('--database-url')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    with scratch_database('classifieds-search-bench-', args.database_url):
+        setup_django()
+
+        from django.core.management import call_command
+        from django.db import connection
+        from django.db.models import Q
+        from ads.models import Ads
+        from ads.search import get_search_backend
+
+        call_command('migrate', verbosity=0)
+
+        started = time.perf_counter()
+        load_ads(args.ads, args.batch_size, args.seed)
+        load_seconds = time.perf_counter() - started
+
+        backend = get_search_backend()
+        started = time.perf_counter()
+        backend.rebuild()
+        index_seconds = time.perf_counter() - started
+
+        queries = {}
+        for query in QUERIES:
+            def scan(query=query):
+                condition = Q()
+                for token in query.split():
+                    condition &= Q(title__icontains=token) | Q(description__icontains=token) | Q(location__icontains=token)
+                return list(Ads.objects.filter(condition).order_by('-created_at').values_list('pk', flat=True)[:20])
+
+            queries[query] = {
+                'matches': backend.count(query),
+                'fulltext': timed(lambda query=query: backend.search(query, limit=20), args.repeat),
+                'icontains_scan': timed(scan, args.scan_repeat),
+            }
+
+        print(json.dumps({
+            'vendor': connection.vendor,
+            'backend': type(backend).__name__,
+            'ads': args.ads,
+            'load_seconds': round(load_seconds, 2),
+            'index_seconds': round(index_seconds, 2),
+            'queries': queries,
+        }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
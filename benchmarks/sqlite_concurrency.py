@@ -0,0 +1,173 @@
+"""
+Mixed read/write throughput of SQLite under several worker processes, with
+SQLite's default settings and with the tuned ones of classifieds/sqlite.py.
+
+For each profile, a throwaway database is created, migrated and filled with
+``seed_bench``. Then ``--workers`` processes (the way gunicorn runs) hit it
+at the same time for ``--seconds``. Most operations are reads, a category
+page or an ad with its tags. The rest are writes: a like toggle or a chat
+message, through the same model methods and signals as the views.
+Operations that fail with "database is locked" are counted, not retried.
+Results are printed as JSON.
+
+    python benchmarks/sqlite_concurrency.py --workers 8 --seconds 20
+    python benchmarks/sqlite_concurrency.py --profile tuned --write-ratio 0.5
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from classifieds.bench import scratch_directory, setup_django, summary  # noqa: E402
+
+# SQLite's own defaults, spelled out, and an empty environment for the
+# defaults of classifieds/sqlite.py.
+PROFILES = {
+    'default': {
+        'SQLITE_JOURNAL_MODE': 'DELETE',
+        'SQLITE_SYNCHRONOUS': 'FULL',
+        'SQLITE_MMAP_SIZE': '0',
+        'SQLITE_CACHE_SIZE': '-2000',
+        'SQLITE_BUSY_TIMEOUT': '5',
+        'SQLITE_TRANSACTION_MODE': 'DEFERRED',
+    },
+    'tuned': {},
+}
+
+
+def setup(database, profile):
+    """Point Django at ``database`` with the settings of ``profile``, in this process."""
+    for name in PROFILES['default']:
+        os.environ.pop(name, None)
+    os.environ.update(PROFILES[profile])
+    os.environ['DATABASE_URL'] = f'sqlite:///{database}'
+    setup_django()
+
+
+def prepare(database, profile, args):
+    setup(database, profile)
+    from django.core.management import call_command
+
+    call_command('migrate', verbosity=0)
+    call_command('seed_bench', users=args.users, ads=args.ads, chats=args.chats, messages=10,
+                 max_images=0, seed=args.seed, verbosity=0, stdout=open(os.devnull, 'w'))
+
+
+def work(database, profile, args, number, start, results):
+    setup(database, profile)
+    from django.contrib.auth.models import User
+    from django.db import OperationalError, connection
+    from ads.models import Ads, Category
+    from chat.models import Chat, Message
+
+    rng = random.Random(args.seed + number)
+    users = list(User.objects.values_list('pk', flat=True))
+    ads = list(Ads.objects.values_list('pk', flat=True))
+    chats = list(Chat.objects.values_list('pk', 'buyer_id', 'seller_id'))
+    categories = list(Category.objects.values_list('pk', flat=True))
+
+    def read():
+        if rng.random() < 0.5:
+            # A category page, as AdsListView fetches it.
+            list(Ads.objects.filter(category_id=rng.choice(categories)).for_listing().order_by('-created_at', '-id')[:20])
+        else:
+            ad = Ads.objects.select_related('category').get(pk=rng.choice(ads))
+            list(ad.tags.all())
+
+    def write():
+        if rng.random() < 0.5:
+            Ads.objects.get(pk=rng.choice(ads)).toggle_like(User(pk=rng.choice(users)))
+        else:
+            chat, buyer, seller = rng.choice(chats)
+            sender, receiver = (buyer, seller) if rng.random() < 0.5 else (seller, buyer)
+            Message.objects.create(chat_id=chat, sender_id=sender, receiver_id=receiver, message='Still available?')
+
+    samples = {'read': [], 'write': []}
+    locked = {'read': 0, 'write': 0}
+    start.wait()
+    deadline = time.perf_counter() + args.seconds
+    while time.perf_counter() < deadline:
+        kind = 'write' if rng.random() < args.write_ratio else 'read'
+        started = time.perf_counter()
+        try:
+            (write if kind == 'write' else read)()
+        except OperationalError as error:
+            if 'locked' not in str(error):
+                raise
+            locked[kind] += 1
+        else:
+            samples[kind].append((time.perf_counter() - started) * 1000)
+    connection.close()
+    results.put((samples, locked))
+
+
+def run(profile, args):
+    with scratch_directory('classifieds-sqlite-bench-') as workdir:
+        database = os.path.join(workdir, 'bench.sqlite3')
+        context = multiprocessing.get_context('spawn')
+        started = time.perf_counter()
+        process = context.Process(target=prepare, args=(database, profile, args))
+        process.start()
+        process.join()
+        if process.exitcode:
+            raise SystemExit(f'Preparing the {profile} database failed.')
+        load_seconds = time.perf_counter() - started
+
+        start, results = context.Event(), context.Queue()
+        workers = [
+            context.Process(target=work, args=(database, profile, args, number, start, results))
+            for number in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+        # Let every worker set up Django before the clock starts.
+        time.sleep(args.startup)
+        start.set()
+        reports = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        samples = {kind: [sample for report, _ in reports for sample in report[kind]] for kind in ('read', 'write')}
+        locked = {kind: sum(report[kind] for _, report in reports) for kind in ('read', 'write')}
+        return {
+            'settings': PROFILES[profile] or 'classifieds/sqlite.py defaults',
+            'load_seconds': round(load_seconds, 2),
+            'ops_per_second': round(sum(map(len, samples.values())) / args.seconds, 1),
+            'reads_per_second': round(len(samples['read']) / args.seconds, 1),
+            'writes_per_second': round(len(samples['write']) / args.seconds, 1),
+            'locked_errors': locked,
+            'read_latency': summary(samples['read']),
+            'write_latency': summary(samples['write']),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--write-ratio', type=float, default=0.2, help='Share of operations that write.')
+    parser.add_argument('--profile', choices=sorted(PROFILES), action='append',
+                        help='Only these profiles (repeatable); both by default.')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ads', type=int, default=5000)
+    parser.add_argument('--chats', type=int, default=200)
+    parser.add_argument('--startup', type=float, default=3, help='Seconds the workers get to start.')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    print(json.dumps({
+        'workers': args.workers,
+        'seconds': args.seconds,
+        'write_ratio': args.write_ratio,
+        'profiles': {profile: run(profile, args) for profile in args.profile or ['default', 'tuned']},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,400 @@
+"""
+Publish/subscribe of chat events.
+
+Views and signals run in synchronous code and ``publish()`` an event to a
+channel; WebSocket connections and long-poll requests run in an event loop
+and ``subscribe()`` to it. Every event gets an increasing ``id`` per channel
+and the last ``CHAT_BROKER_HISTORY`` events are kept, so a client that was
+disconnected can ask for what it missed with ``recent(channel, after=id)``.
+
+``InProcessBroker`` is the default: it fans out inside one process, which is
+enough for a single ASGI server process. With several processes or hosts set
+``CHAT_BROKER_URL = 'redis://host:port/db'`` to relay events through Redis
+(or any server speaking the Redis protocol, such as a local Valkey or KeyDB)
+with ``RedisBroker``.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import socket
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def chat_channel(chat_id):
+    return f'chat.{chat_id}'
+
+
+def user_channel(user_id):
+    return f'user.{user_id}'
+
+
+class Broker:
+
+    def publish(self, channel, event):
+        """Send ``event`` (a JSON serializable dict) to the subscribers of ``channel``; returns it with its ``id``."""
+        raise NotImplementedError
+
+    def recent(self, channel, after=0):
+        """Kept events of ``channel`` with an id greater than ``after``, oldest first."""
+        raise NotImplementedError
+
+    def last_id(self, channel):
+        """The id of the latest event published to ``channel``, 0 if none."""
+        raise NotImplementedError
+
+    def subscribe(self, channel):
+        """Async context manager yielding an ``asyncio.Queue`` that receives the events of ``channel``."""
+        raise NotImplementedError
+
+
+class LocalFanout:
+    """Subscriber queues of this process, each bound to the event loop that created it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queues = defaultdict(set)
+
+    def add(self, channel, queue):
+        with self.lock:
+            first = not self.queues[channel]
+            self.queues[channel].add((asyncio.get_running_loop(), queue))
+        return first
+
+    def discard(self, channel, queue):
+        with self.lock:
+            subscribers = self.queues[channel]
+            subscribers.difference_update({entry for entry in subscribers if entry[1] is queue})
+            if not subscribers:
+                del self.queues[channel]
+                return True
+        return False
+
+    def deliver(self, channel, event):
+        with self.lock:
+            subscribers = list(self.queues.get(channel, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, event)
+            except RuntimeError:
+                # The subscriber's loop is closed; it is removed when its context exits.
+                pass
+
+
+class InProcessBroker(Broker):
+
+    def __init__(self, history=100):
+        self.lock = threading.Lock()
+        # Ids start from the clock rather than 1, so after a restart a client
+        # never mistakes new events for ones it has already seen.
+        self.ids = defaultdict(lambda: itertools.count(time.time_ns() // 1000))
+        self.history = defaultdict(lambda: deque(maxlen=history))
+        self.fanout = LocalFanout()
+
+    def publish(self, channel, event):
+        with self.lock:
+            event = {**event, 'id': next(self.ids[channel]) + 1}
+            self.history[channel].append(event)
+        self.fanout.deliver(channel, event)
+        return event
+
+    def recent(self, channel, after=0):
+        with self.lock:
+            return [event for event in self.history.get(channel, ()) if event['id'] > after]
+
+    def last_id(self, channel):
+        with self.lock:
+            history = self.history.get(channel)
+            return history[-1]['id'] if history else 0
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        queue = asyncio.Queue()
+        self.fanout.add(channel, queue)
+        try:
+            yield queue
+        finally:
+            self.fanout.discard(channel, queue)
+
+
+# Redis serialization protocol (RESP2), just enough for the commands below.
+
+def encode_command(*args):
+    parts = [f'*{len(args)}\r\n'.encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(b'$%d\r\n%s\r\n' % (len(data), data))
+    return b''.join(parts)
+
+
+class RedisError(Exception):
+    pass
+
+
+def parse_reply(readline, read):
+    line = readline()
+    if not line:
+        raise ConnectionError('Connection closed by the server.')
+    kind, value = line[:1], line[1:-2]
+    if kind == b'+':
+        return value.decode()
+    if kind == b'-':
+        raise RedisError(value.decode())
+    if kind == b':':
+        return int(value)
+    if kind == b'$':
+        return None if int(value) < 0 else read(int(value) + 2)[:-2]
+    if kind == b'*':
+        return None if int(value) < 0 else [parse_reply(readline, read) for _ in range(int(value))]
+    raise RedisError(f'Unexpected reply {line!r}')
+
+
+async def parse_reply_async(reader):
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError('Connection closed by the server.')
+    kind, value = line[:1], line[1:-2]
+    if kind == b'+':
+        return value.decode()
+    if kind == b'-':
+        raise RedisError(value.decode())
+    if kind == b':':
+        return int(value)
+    if kind == b'$':
+        return None if int(value) < 0 else (await reader.readexactly(int(value) + 2))[:-2]
+    if kind == b'*':
+        return None if int(value) < 0 else [await parse_reply_async(reader) for _ in range(int(value))]
+    raise RedisError(f'Unexpected reply {line!r}')
+
+
+# Numbers, stores and publishes an event in one step, so ids reach
+# subscribers in order. KEYS: the sequence and the history list; ARGV: the
+# event as JSON without its id, the history size and the pub/sub channel.
+PUBLISH_SCRIPT = """
+local id = redis.call('INCR', KEYS[1])
+local data = string.format('{"id": %d', id)
+if ARGV[1] == '{}' then
+    data = data .. '}'
+else
+    data = data .. ', ' .. string.sub(ARGV[1], 2)
+end
+redis.call('RPUSH', KEYS[2], data)
+redis.call('LTRIM', KEYS[2], -tonumber(ARGV[2]), -1)
+redis.call('PUBLISH', ARGV[3], data)
+return id
+"""
+
+
+class RedisBroker(Broker):
+    """
+    Relays events through Redis PUBLISH/SUBSCRIBE. Each event loop keeps one
+    subscriber connection (a ``RedisListener``), subscribed to the channels
+    its local listeners follow; history lives in a capped Redis list per
+    channel.
+    """
+    connect_timeout = 5
+
+    def __init__(self, url, history=100, prefix='classifieds'):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.history_size = history
+        self.prefix = prefix
+        self.local = threading.local()
+        self.listeners = {}
+        self.listeners_lock = threading.Lock()
+
+    def key(self, channel, suffix=''):
+        return f'{self.prefix}:{channel}{suffix}'
+
+    def handshake(self):
+        commands = []
+        if self.password:
+            commands.append(('AUTH', self.password))
+        if self.db:
+            commands.append(('SELECT', self.db))
+        return commands
+
+    # Synchronous side, used by publishers.
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+            conn = self.local.conn = (sock, sock.makefile('rb'))
+            for command in self.handshake():
+                self.execute(*command)
+        return conn
+
+    def execute(self, *commands):
+        """Send one command, or several as tuples in a pipeline, and return the replies."""
+        pipeline = commands if commands and isinstance(commands[0], tuple) else (commands,)
+        for attempt in range(2):
+            sock, stream = self.connection()
+            try:
+                sock.sendall(b''.join(encode_command(*command) for command in pipeline))
+                replies = [parse_reply(stream.readline, stream.read) for _ in pipeline]
+                return replies if pipeline is commands else replies[0]
+            except (ConnectionError, OSError):
+                sock.close()
+                self.local.conn = None
+                if attempt:
+                    raise
+
+    def publish(self, channel, event):
+        fields = {key: value for key, value in event.items() if key != 'id'}
+        event_id = self.execute(
+            'EVAL', PUBLISH_SCRIPT, 2, self.key(channel, ':seq'), self.key(channel, ':history'),
+            json.dumps(fields), self.history_size, self.key(channel),
+        )
+        return {**fields, 'id': event_id}
+
+    def recent(self, channel, after=0):
+        events = [json.loads(item) for item in self.execute('LRANGE', self.key(channel, ':history'), 0, -1)]
+        return [event for event in events if event['id'] > after]
+
+    def last_id(self, channel):
+        return int(self.execute('GET', self.key(channel, ':seq')) or 0)
+
+    # Asynchronous side, one listener connection per event loop.
+
+    def listener(self):
+        loop = asyncio.get_running_loop()
+        with self.listeners_lock:
+            for other in [other for other in self.listeners if other.is_closed()]:
+                del self.listeners[other]
+            listener = self.listeners.get(loop)
+            if listener is None:
+                listener = self.listeners[loop] = RedisListener(self)
+        return listener
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        listener = self.listener()
+        await asyncio.wait_for(listener.connected.wait(), self.connect_timeout)
+        queue = asyncio.Queue()
+        if listener.fanout.add(channel, queue):
+            listener.send('SUBSCRIBE', self.key(channel))
+        try:
+            yield queue
+        finally:
+            if listener.fanout.discard(channel, queue):
+                listener.last_ids.pop(channel, None)
+                listener.send('UNSUBSCRIBE', self.key(channel))
+
+
+class RedisListener:
+    """
+    The subscriber connection of one event loop. When the connection drops
+    it reconnects with backoff, subscribes again to the channels that still
+    have local listeners and hands them the events published meanwhile, from
+    the history.
+    """
+    min_delay = 0.5
+    max_delay = 30
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.fanout = LocalFanout()
+        # Id of the last event handed out per channel, to replay from after a reconnect.
+        self.last_ids = {}
+        self.writer = None
+        self.connected = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def send(self, *command):
+        # While disconnected there is nothing to do: run() subscribes to
+        # whatever the fanout holds once it is back.
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(encode_command(*command))
+
+    async def connect(self):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.broker.host, self.broker.port), self.broker.connect_timeout
+        )
+        try:
+            for command in self.broker.handshake():
+                writer.write(encode_command(*command))
+                await parse_reply_async(reader)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def run(self):
+        delay = self.min_delay
+        while True:
+            try:
+                reader, writer = await self.connect()
+            except (OSError, ConnectionError, RedisError, asyncio.TimeoutError) as exc:
+                logger.warning('Cannot connect to the chat broker (%s); retrying in %.1fs.', exc, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_delay)
+                continue
+
+            delay = self.min_delay
+            # No await from here to the SUBSCRIBE, so no subscribe() can slip in between.
+            self.writer = writer
+            channels = list(self.fanout.queues)
+            if channels:
+                self.send('SUBSCRIBE', *(self.broker.key(channel) for channel in channels))
+            self.connected.set()
+            try:
+                await self.catch_up(channels)
+                await self.read(reader)
+            except (OSError, ConnectionError, RedisError, asyncio.IncompleteReadError) as exc:
+                logger.warning('Lost the chat broker connection (%s); reconnecting.', exc)
+            finally:
+                self.connected.clear()
+                self.writer = None
+                writer.close()
+
+    async def catch_up(self, channels):
+        for channel in channels:
+            if channel in self.last_ids:
+                recent = await sync_to_async(self.broker.recent, thread_sensitive=False)(channel, self.last_ids[channel])
+                for event in recent:
+                    self.deliver(channel, event)
+
+    async def read(self, reader):
+        prefix = f'{self.broker.prefix}:'
+        while True:
+            reply = await parse_reply_async(reader)
+            if isinstance(reply, list) and reply[0] == b'message':
+                self.deliver(reply[1].decode()[len(prefix):], json.loads(reply[2]))
+
+    def deliver(self, channel, event):
+        if event['id'] > self.last_ids.get(channel, 0):
+            self.last_ids[channel] = event['id']
+        self.fanout.deliver(channel, event)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            url = getattr(settings, 'CHAT_BROKER_URL', '')
+            history = getattr(settings, 'CHAT_BROKER_HISTORY', 100)
+            _broker = RedisBroker(url, history=history) if url else InProcessBroker(history=history)
+        return _broker
+
+
+def reset_broker():
+    global _broker
+    with _broker_lock:
+        _broker = None
@@ -0,0 +1,19 @@
+from django.conf import settings
+
+from .models import ChatInbox
+
+
+def unread_messages(request):
+    """
+    ``unread_messages_count`` for the header badge, queried only if a template
+    uses it, and whether the badge can stream (``chat_realtime``) or polls.
+    """
+    def count():
+        user = request.user
+        return ChatInbox.unread_total(user.pk) if user.is_authenticated else 0
+
+    return {
+        'unread_messages_count': count,
+        'chat_realtime': getattr(settings, 'CHAT_ASGI', False),
+        'unread_poll_interval': getattr(settings, 'CHAT_UNREAD_POLL_INTERVAL', 30),
+    }
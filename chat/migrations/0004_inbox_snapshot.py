@@ -0,0 +1,80 @@
+# Generated by Django 5.1.1 on 2026-10-17 00:33
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_inbox(apps, schema_editor):
+    Chat = apps.get_model('chat', 'Chat')
+    ChatInbox = apps.get_model('chat', 'ChatInbox')
+    Message = apps.get_model('chat', 'Message')
+
+    entries = []
+    for chat in Chat.objects.prefetch_related('users').iterator(chunk_size=500):
+        last = Message.objects.filter(chat=chat).order_by('-created_on', '-id').first()
+        if last is not None:
+            chat.last_message = last
+            chat.last_message_text = last.message
+            chat.last_message_at = last.created_on
+            chat.last_message_sender_id = last.sender_id
+            chat.save(update_fields=['last_message', 'last_message_text', 'last_message_at', 'last_message_sender'])
+
+        users = list(chat.users.all())
+        for user in users:
+            counterpart = next((other for other in users if other.pk != user.pk), None)
+            entries.append(ChatInbox(
+                chat=chat,
+                user=user,
+                counterpart=counterpart,
+                last_activity_at=chat.last_message_at or chat.created_on,
+            ))
+
+    ChatInbox.objects.bulk_create(entries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_alter_chat_options_remove_chat_conversation_id_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='last_message_text',
+            field=models.TextField(blank=True),
+        ),
+        migrations.CreateModel(
+            name='ChatInbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_activity_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='chat.chat')),
+                ('counterpart', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chat_inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_activity_at'], name='chat_inbox_user_activity_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user', 'chat'), name='unique_chat_inbox_user')],
+            },
+        ),
+        migrations.RunPython(backfill_inbox, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-17 00:36
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_inbox_snapshot'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chat', 'created_on', 'id'], name='chat_message_window_idx'),
+        ),
+    ]
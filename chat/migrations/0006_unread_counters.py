@@ -0,0 +1,39 @@
+# Generated by Django 5.1.1 on 2026-10-17 01:06
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def start_read(apps, schema_editor):
+    # Existing conversations start out read: the cursor moves to each chat's latest message.
+    Chat = apps.get_model('chat', 'Chat')
+    ChatInbox = apps.get_model('chat', 'ChatInbox')
+    last_message = Chat.objects.filter(pk=models.OuterRef('chat_id')).values('last_message_id')[:1]
+    ChatInbox.objects.update(last_read_message_id=Coalesce(models.Subquery(last_message), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_message_window_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatinbox',
+            name='last_read_message_id',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatinbox',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='chatinbox',
+            index=models.Index(condition=models.Q(('unread_count__gt', 0)), fields=['user'], name='chat_inbox_unread_idx'),
+        ),
+        migrations.RunPython(start_read, migrations.RunPython.noop),
+    ]
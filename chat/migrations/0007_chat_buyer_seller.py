@@ -0,0 +1,63 @@
+# Generated by Django 5.1.1 on 2026-10-17 01:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill_parties(apps, schema_editor):
+    """
+    The ad's owner is the seller and the other participant the buyer. Chats
+    that don't fit (one participant, or neither is the owner) stay unset, as
+    do later duplicates of a buyer/seller pair, which keep only the oldest
+    chat findable while all of them stay reachable through ``users``.
+    """
+    Chat = apps.get_model('chat', 'Chat')
+    participants = {}
+    for chat_id, user_id in Chat.users.through.objects.values_list('chat_id', 'user_id').iterator(chunk_size=2000):
+        participants.setdefault(chat_id, set()).add(user_id)
+
+    seen = set()
+    batch = []
+    for chat in Chat.objects.only('id', 'ad_id', 'ad__user_id').select_related('ad').order_by('created_on', 'id').iterator(chunk_size=2000):
+        users = participants.get(chat.id, set())
+        seller_id = chat.ad.user_id
+        if len(users) != 2 or seller_id not in users:
+            continue
+        (buyer_id,) = users - {seller_id}
+        if (chat.ad_id, buyer_id, seller_id) in seen:
+            continue
+        seen.add((chat.ad_id, buyer_id, seller_id))
+        chat.buyer_id, chat.seller_id = buyer_id, seller_id
+        batch.append(chat)
+        if len(batch) >= 1000:
+            Chat.objects.bulk_update(batch, ['buyer', 'seller'])
+            batch = []
+    Chat.objects.bulk_update(batch, ['buyer', 'seller'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ads', '0010_adimage_renditions'),
+        ('chat', '0006_unread_counters'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='buyer',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='buyer_chats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='chat',
+            name='seller',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='seller_chats', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(backfill_parties, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='chat',
+            constraint=models.UniqueConstraint(fields=('ad', 'buyer', 'seller'), name='unique_chat_ad_buyer_seller'),
+        ),
+    ]
@@ -1,5 +1,8 @@
+import copy
+
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
+from django.dispatch import Signal
 from django.utils import timezone
 from ads.models import Ads
 
@@ -8,10 +11,188 @@ class Chat(models.Model):
     ad = models.ForeignKey(Ads, on_delete=models.CASCADE)  
     created_on = models.DateTimeField(auto_now_add=True)  
     users = models.ManyToManyField(User) 
+    # The two sides of a conversation about ``ad``, so finding it is one probe
+    # of the (ad, buyer, seller) unique index. Null only for chats whose
+    # participants could not be told apart when the columns were added.
+    buyer = models.ForeignKey(User, null=True, blank=True, related_name='buyer_chats', on_delete=models.CASCADE)
+    seller = models.ForeignKey(User, null=True, blank=True, related_name='seller_chats', on_delete=models.CASCADE)
+    # Snapshot of the latest message, maintained by chat.signals so the inbox
+    # never has to touch the Message table.
+    last_message = models.ForeignKey('Message', null=True, blank=True, related_name='+',
+                                     on_delete=models.DO_NOTHING, db_constraint=False)
+    last_message_text = models.TextField(blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_sender = models.ForeignKey(User, null=True, blank=True, related_name='+', on_delete=models.SET_NULL)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ad', 'buyer', 'seller'], name='unique_chat_ad_buyer_seller'),
+        ]
 
     def __str__(self):
         return f"Chat for {self.ad} with users {', '.join([user.username for user in self.users.all()])}"
 
+    @property
+    def last_activity_at(self):
+        return self.last_message_at or self.created_on
+
+    def record_message(self, message, new=False):
+        """
+        Store ``message`` as the latest message of this chat and its inbox
+        entries. A ``new`` message is also unread for everyone but its sender,
+        whose read cursor moves past it.
+        """
+        Chat.objects.filter(pk=self.pk).update(
+            last_message=message,
+            last_message_text=message.message,
+            last_message_at=message.created_on,
+            last_message_sender=message.sender_id,
+        )
+        counters = {}
+        if new:
+            is_sender = models.Q(user_id=message.sender_id)
+            counters = {
+                'unread_count': models.Case(
+                    models.When(is_sender, then=models.Value(0)), default=models.F('unread_count') + 1,
+                    output_field=models.PositiveIntegerField(),
+                ),
+                'last_read_message_id': models.Case(
+                    models.When(is_sender, then=models.Value(message.pk)), default=models.F('last_read_message_id'),
+                    output_field=models.PositiveBigIntegerField(),
+                ),
+            }
+        ChatInbox.objects.filter(chat_id=self.pk).update(last_activity_at=message.created_on, **counters)
+
+    def forget_message(self, message):
+        """Take a deleted ``message`` off the unread counts of those who had not read it; returns their ids."""
+        unread = ChatInbox.objects.filter(
+            chat_id=self.pk, last_read_message_id__lt=message.pk, unread_count__gt=0
+        ).exclude(user_id=message.sender_id)
+        user_ids = list(unread.values_list('user_id', flat=True))
+        unread.update(unread_count=models.F('unread_count') - 1)
+        return user_ids
+
+    def mark_read(self, user, message_id):
+        """
+        Move ``user``'s read cursor up to ``message_id``; returns whether it
+        moved. The unread count drops to zero unless newer messages than
+        ``message_id`` exist, in which case it is left as it is until those
+        are read too, so a message can never be counted read unseen.
+        ``message_id`` is capped at the chat's last message: a cursor past it
+        would skip the messages still to come.
+        """
+        last = models.functions.Coalesce(
+            models.Subquery(Chat.objects.filter(pk=self.pk).values('last_message_id')), 0
+        )
+        message_id = models.functions.Least(models.Value(message_id), last)
+        newer = Chat.objects.filter(pk=self.pk, last_message_id__gt=message_id)
+        return bool(ChatInbox.objects.filter(chat_id=self.pk, user=user, last_read_message_id__lt=message_id).update(
+            last_read_message_id=message_id,
+            unread_count=models.Case(
+                models.When(models.Exists(newer), then=models.F('unread_count')), default=models.Value(0),
+                output_field=models.PositiveIntegerField(),
+            ),
+        ))
+
+    def refresh_last_message(self):
+        """Recompute the snapshot from the newest remaining message."""
+        message = self.messages.order_by('-created_on', '-id').first()
+        if message is not None:
+            self.record_message(message)
+            return
+
+        Chat.objects.filter(pk=self.pk).update(
+            last_message=None,
+            last_message_text='',
+            last_message_at=None,
+            last_message_sender=None,
+        )
+        ChatInbox.objects.filter(chat_id=self.pk).update(last_activity_at=self.created_on)
+
+    def sync_inbox(self):
+        """Create, update or drop inbox entries so they match ``users``; returns the created entries."""
+        users = list(self.users.all())
+        ChatInbox.objects.filter(chat=self).exclude(user__in=users).delete()
+
+        created_entries = []
+        for user in users:
+            counterpart = next((other for other in users if other.pk != user.pk), None)
+            entry, created = ChatInbox.objects.update_or_create(
+                chat=self,
+                user=user,
+                defaults={'counterpart': counterpart},
+                create_defaults={
+                    'counterpart': counterpart,
+                    'last_activity_at': self.last_activity_at,
+                    # Joining a chat doesn't make its history unread.
+                    'last_read_message_id': self.last_message_id or 0,
+                },
+            )
+            if created:
+                created_entries.append(entry)
+        return created_entries
+
+
+class ChatInbox(models.Model):
+    """One row per participant of a chat, holding what the inbox page needs to render it."""
+    user = models.ForeignKey(User, related_name='chat_inbox', on_delete=models.CASCADE)
+    chat = models.ForeignKey(Chat, related_name='inbox_entries', on_delete=models.CASCADE)
+    counterpart = models.ForeignKey(User, null=True, blank=True, related_name='+', on_delete=models.SET_NULL)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    # Read cursor: messages with a greater id are unread. unread_count is kept
+    # in step on write (Chat.record_message, forget_message, mark_read), so
+    # badges never count Message rows.
+    last_read_message_id = models.PositiveBigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat'], name='unique_chat_inbox_user'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at'], name='chat_inbox_user_activity_idx'),
+            # Only the few entries with unread messages, for the header badge total.
+            models.Index(fields=['user'], condition=models.Q(unread_count__gt=0), name='chat_inbox_unread_idx'),
+        ]
+
+    @classmethod
+    def unread_total(cls, user_id):
+        return cls.objects.filter(user_id=user_id, unread_count__gt=0).aggregate(
+            total=models.Sum('unread_count', default=0)
+        )['total']
+
+
+MESSAGE_WINDOW = 50
+
+# Sent with the ``messages`` removed by Message.delete() or a Message queryset's
+# delete(), for chat.signals to update the chats. Not a post_delete receiver:
+# the messages going with a deleted chat, ad or user stay a fast delete.
+messages_deleted = Signal()
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def latest_window(self, before=None, limit=MESSAGE_WINDOW):
+        """
+        Return the newest ``limit`` messages, optionally only those older than
+        the message ``before``, in reading order, and whether older ones exist.
+        Served by the (chat, created_on, id) index without an OFFSET scan.
+        """
+        queryset = self
+        if before is not None:
+            queryset = queryset.filter(
+                models.Q(created_on__lt=before.created_on) | models.Q(created_on=before.created_on, id__lt=before.id)
+            )
+        rows = list(queryset.order_by('-created_on', '-id')[:limit + 1])
+        return rows[:limit][::-1], len(rows) > limit
+
+    def delete(self):
+        with transaction.atomic():
+            messages = list(self)
+            deleted = super().delete()
+            messages_deleted.send(sender=self.model, messages=messages)
+        return deleted
+
 
 class Message(models.Model):
     sender = models.ForeignKey(User, related_name='sent_messages', blank=False, null=False, on_delete=models.CASCADE)
@@ -20,5 +201,18 @@ class Message(models.Model):
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages', null=False, blank=False)
     created_on  = models.DateTimeField(auto_now_add=True)
 
+    objects = MessageQuerySet.as_manager()
+
     class Meta:
         ordering = ['created_on']
+        indexes = [
+            models.Index(fields=['chat', 'created_on', 'id'], name='chat_message_window_idx'),
+        ]
+
+    def delete(self, *args, **kwargs):
+        # Deleting clears the primary key; the receivers need it.
+        message = copy.copy(self)
+        with transaction.atomic():
+            deleted = super().delete(*args, **kwargs)
+            messages_deleted.send(sender=Message, messages=[message])
+        return deleted
@@ -0,0 +1,223 @@
+"""
+Live delivery of chat messages.
+
+Creating, editing or deleting a ``Message`` publishes an event on the chat's
+broker channel once the transaction commits (see ``chat.signals``).
+Participants receive it over a WebSocket at ``/ws/chat/<chat_id>/``, served
+by ``websocket_app`` next to Django in ``classifieds.asgi``, or, without
+WebSocket support, by long-polling ``ConversationEventsView``. Both accept
+``?after=<event id>`` and first replay what the client missed. Both hold a
+connection open, so they are only used with ``CHAT_ASGI``; under WSGI an
+open conversation short-polls ``ConversationNewMessagesView`` instead.
+
+Events look like::
+
+    {"id": 17, "type": "message.created", "chat_id": 3,
+     "message": {"id": 42, "sender_id": 5, "message": "Hi", "created_on": "..."},
+     "html": "<div id=\\"message-42\\" ...>"}
+
+where ``html`` is the message rendered for the receiving user and is left
+out of ``message.deleted`` events.
+
+Each user also has a channel of their own carrying ``unread`` events (the
+new unread count of one chat and the user's total) and ``chat.created``
+events, streamed to the header badge by ``NotificationStreamView`` as
+Server-Sent Events.
+"""
+import asyncio
+import json
+import re
+from functools import partial
+from http.cookies import SimpleCookie
+from importlib import import_module
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.db import close_old_connections, transaction
+from django.db.models import Q, Sum
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.dateparse import parse_datetime
+
+from .broker import chat_channel, get_broker, user_channel
+from .models import Chat, ChatInbox
+
+WEBSOCKET_PATH = re.compile(r'^/ws/chat/(?P<chat_id>[0-9]+)/$')
+EVENT_TYPES = {'created': 'message.created', 'edited': 'message.edited', 'deleted': 'message.deleted'}
+
+
+def websocket_path(chat_id):
+    return f'/ws/chat/{chat_id}/'
+
+
+def message_event(message, action):
+    return {
+        'type': EVENT_TYPES[action],
+        'chat_id': message.chat_id,
+        'message': {
+            'id': message.pk,
+            'sender_id': message.sender_id,
+            'message': message.message,
+            'created_on': message.created_on.isoformat() if message.created_on else None,
+        },
+    }
+
+
+def publish_message_event(message, action):
+    """Publish ``action`` on ``message`` to its chat once the current transaction commits."""
+    event = message_event(message, action)
+    # robust: a broker outage must not fail a request whose data is already committed.
+    transaction.on_commit(partial(get_broker().publish, chat_channel(message.chat_id), event), robust=True)
+
+
+def unread_event(user_id, chat_id):
+    counts = ChatInbox.objects.filter(user_id=user_id, unread_count__gt=0).aggregate(
+        total=Sum('unread_count', default=0),
+        chat=Sum('unread_count', default=0, filter=Q(chat_id=chat_id)),
+    )
+    return {'type': 'unread', 'chat_id': chat_id, 'unread_count': counts['chat'], 'total': counts['total']}
+
+
+def publish_unread(chat_id, user_ids):
+    """Send the users in ``user_ids`` their new unread counts once the current transaction commits."""
+    def publish():
+        broker = get_broker()
+        for user_id in user_ids:
+            broker.publish(user_channel(user_id), unread_event(user_id, chat_id))
+
+    if user_ids:
+        transaction.on_commit(publish, robust=True)
+
+
+def publish_new_chat(entry):
+    """Tell the owner of the inbox ``entry`` about their new chat once the current transaction commits."""
+    event = {
+        'type': 'chat.created',
+        'chat_id': entry.chat_id,
+        'counterpart': entry.counterpart.username if entry.counterpart else None,
+        'url': reverse('chat:conversation_detail', args=[entry.chat_id]),
+    }
+    transaction.on_commit(partial(get_broker().publish, user_channel(entry.user_id), event), robust=True)
+
+
+def unread_snapshot(user_id):
+    """The ``unread.snapshot`` event a notification stream starts with: the total and the per-chat counts."""
+    chats = dict(ChatInbox.objects.filter(user_id=user_id, unread_count__gt=0).values_list('chat_id', 'unread_count'))
+    return {'type': 'unread.snapshot', 'total': sum(chats.values()), 'chats': chats}
+
+
+def format_sse(event, event_id=None):
+    lines = [f'id: {event_id}'] if event_id else []
+    lines += [f'event: {event["type"]}', f'data: {json.dumps(event)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+def render_event(event, user, csrf_token=None):
+    """``event`` with the ``html`` of its message as seen by ``user``."""
+    if event['type'] == EVENT_TYPES['deleted']:
+        return event
+    data = event['message']
+    message = SimpleNamespace(
+        id=data['id'], sender_id=data['sender_id'], message=data['message'],
+        created_on=parse_datetime(data['created_on']) if data['created_on'] else None,
+    )
+    context = {'object_list': [message], 'chat_id': event['chat_id'], 'user': user, 'csrf_token': csrf_token}
+    return {**event, 'html': render_to_string('chat/message_list.html', context)}
+
+
+def parse_after(value):
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+# WebSocket endpoint.
+
+def header(scope, name):
+    for key, value in scope.get('headers', ()):
+        if key == name:
+            return value.decode('latin1')
+    return None
+
+
+def same_origin(scope):
+    """Browsers always send Origin on WebSocket handshakes; refuse pages from other sites."""
+    origin = header(scope, b'origin')
+    if origin is None:
+        return True
+    return urlparse(origin).netloc == header(scope, b'host')
+
+
+def authorize(scope, chat_id):
+    """The participant of ``chat_id`` whose session cookie came with the handshake, or None."""
+    cookies = SimpleCookie(header(scope, b'cookie') or '')
+    session_key = cookies[settings.SESSION_COOKIE_NAME].value if settings.SESSION_COOKIE_NAME in cookies else None
+    if not session_key:
+        return None
+
+    close_old_connections()
+    try:
+        session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        user = get_user(SimpleNamespace(session=session))
+        if not user.is_authenticated or not Chat.objects.filter(pk=chat_id, users=user).exists():
+            return None
+        csrf_token = cookies[settings.CSRF_COOKIE_NAME].value if settings.CSRF_COOKIE_NAME in cookies else None
+        return user, csrf_token
+    finally:
+        close_old_connections()
+
+
+async def websocket_app(scope, receive, send):
+    """ASGI application for ``websocket`` connections."""
+    if (await receive())['type'] != 'websocket.connect':
+        return
+
+    match = WEBSOCKET_PATH.match(scope['path'])
+    participant = None
+    if match and same_origin(scope):
+        participant = await sync_to_async(authorize)(scope, int(match['chat_id']))
+    if participant is None:
+        # Closing before accepting rejects the handshake (HTTP 403).
+        await send({'type': 'websocket.close'})
+        return
+
+    user, csrf_token = participant
+    chat_id = int(match['chat_id'])
+    broker = get_broker()
+    channel = chat_channel(chat_id)
+    last_sent = parse_after(parse_qs(scope.get('query_string', b'').decode()).get('after', [None])[0])
+
+    async def deliver(event):
+        nonlocal last_sent
+        if event['id'] > last_sent:
+            last_sent = event['id']
+            await send({'type': 'websocket.send', 'text': json.dumps(render_event(event, user, csrf_token))})
+
+    await send({'type': 'websocket.accept'})
+    # Subscribe before replaying, so nothing published in between is lost;
+    # anything received twice is skipped by its id.
+    async with broker.subscribe(channel) as queue:
+        if last_sent:
+            for event in await sync_to_async(broker.recent, thread_sensitive=False)(channel, last_sent):
+                await deliver(event)
+
+        incoming = asyncio.ensure_future(receive())
+        published = asyncio.ensure_future(queue.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait({incoming, published}, return_when=asyncio.FIRST_COMPLETED)
+                if published in done:
+                    await deliver(published.result())
+                    published = asyncio.ensure_future(queue.get())
+                if incoming in done:
+                    if incoming.result()['type'] == 'websocket.disconnect':
+                        break
+                    # Messages from the client are not used; sending goes through the form.
+                    incoming = asyncio.ensure_future(receive())
+        finally:
+            incoming.cancel()
+            published.cancel()
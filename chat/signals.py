@@ -0,0 +1,46 @@
+from django.db.models.signals import m2m_changed, post_save
+from django.dispatch import receiver
+from .models import Chat, Message, messages_deleted
+from .realtime import publish_message_event, publish_new_chat, publish_unread
+
+
+@receiver(m2m_changed, sender=Chat.users.through)
+def sync_chat_inbox(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+
+    if not reverse:
+        chats = [instance]
+    else:
+        # user.chat_set.add(...) style calls: instance is the user.
+        chats = Chat.objects.filter(pk__in=pk_set) if pk_set else Chat.objects.filter(inbox_entries__user=instance)
+    for chat in chats:
+        for entry in chat.sync_inbox():
+            publish_new_chat(entry)
+
+
+@receiver(post_save, sender=Message)
+def update_last_message(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    if created:
+        instance.chat.record_message(instance, new=True)
+        publish_unread(instance.chat_id, [instance.receiver_id])
+    else:
+        Chat.objects.filter(pk=instance.chat_id, last_message=instance).update(last_message_text=instance.message)
+    publish_message_event(instance, 'created' if created else 'edited')
+
+
+@receiver(messages_deleted)
+def clear_last_message(sender, messages, **kwargs):
+    chats = Chat.objects.in_bulk({message.chat_id for message in messages})
+    deleted = {message.pk for message in messages}
+    for chat in chats.values():
+        if chat.last_message_id in deleted:
+            chat.refresh_last_message()
+    for message in messages:
+        chat = chats.get(message.chat_id)
+        if chat is not None:
+            publish_unread(chat.pk, chat.forget_message(message))
+        publish_message_event(message, 'deleted')
@@ -1,8 +1,27 @@
+import asyncio
+import io
+import json
+import os
+import socket
+import socketserver
+import threading
+import unittest
+from collections import defaultdict
+from unittest import mock
+
+from asgiref.sync import async_to_sync, iscoroutinefunction, sync_to_async
+from asgiref.testing import ApplicationCommunicator
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.handlers.asgi import ASGIHandler
+from django.test import SimpleTestCase, TestCase, override_settings
 from ads.models import Category, Ads
-from .models import User, Chat, Message
+from .models import User, Chat, ChatInbox, Message
 from django.urls import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from .broker import (PUBLISH_SCRIPT, InProcessBroker, RedisBroker, RedisListener, chat_channel, encode_command,
+                     get_broker, parse_reply, reset_broker, user_channel)
+from .realtime import message_event, websocket_app, websocket_path
 
 
 class ChatMessageModelTest(TestCase):
@@ -128,6 +147,81 @@ class ConversationListViewTest(TestCase):
         self.assertRedirects(response, f"{reverse('login')}?next={reverse('chat:conversation_list')}")
 
 
+class ConversationInboxTests(TestCase):
+
+    def setUp(self):
+        self.category = Category.objects.create(name="Inbox Category")
+        self.seller = User.objects.create_user(username='seller', password='testpass')
+        self.client.login(username='seller', password='testpass')
+
+    def create_chat(self, index):
+        buyer = User.objects.create(username=f'buyer{index}')
+        ad = Ads.objects.create(user=self.seller, title=f"Inbox Ad {index}", slug=f'inbox-ad-{index}',
+                                category=self.category, price=10)
+        chat = Chat.objects.create(ad=ad)
+        chat.users.set([self.seller, buyer])
+        Message.objects.create(chat=chat, sender=buyer, receiver=self.seller, message=f"Offer {index}")
+        Message.objects.create(chat=chat, sender=self.seller, receiver=buyer, message=f"Reply {index}")
+        return chat
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('chat:conversation_list'))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_inbox_entries_follow_chat_users(self):
+        chat = self.create_chat(1)
+        entry = ChatInbox.objects.get(chat=chat, user=self.seller)
+        self.assertEqual(entry.counterpart.username, 'buyer1')
+
+        chat.users.remove(self.seller)
+        self.assertFalse(ChatInbox.objects.filter(chat=chat, user=self.seller).exists())
+
+    def test_snapshot_tracks_created_edited_and_deleted_messages(self):
+        chat = self.create_chat(1)
+        chat.refresh_from_db()
+        self.assertEqual(chat.last_message_text, "Reply 1")
+        self.assertEqual(chat.last_message_sender, self.seller)
+
+        last = chat.last_message
+        last.message = "Edited reply"
+        last.save()
+        chat.refresh_from_db()
+        self.assertEqual(chat.last_message_text, "Edited reply")
+
+        last.delete()
+        chat.refresh_from_db()
+        self.assertEqual(chat.last_message_text, "Offer 1")
+
+        chat.messages.all().delete()
+        chat.refresh_from_db()
+        self.assertIsNone(chat.last_message_at)
+        self.assertEqual(chat.last_message_text, "")
+
+    def test_inbox_sorted_by_recent_activity(self):
+        first = self.create_chat(1)
+        second = self.create_chat(2)
+        Message.objects.create(chat=first, sender=self.seller, receiver=first.users.exclude(pk=self.seller.pk).get(),
+                               message="Bump")
+
+        _, response = self.count_queries()
+        chat_ids = [entry.chat_id for entry in response.context['conversations']]
+        self.assertEqual(chat_ids, [first.id, second.id])
+        self.assertContains(response, "Bump")
+
+    def test_query_count_independent_of_chat_count(self):
+        self.create_chat(1)
+        few, _ = self.count_queries()
+
+        for index in range(2, 12):
+            self.create_chat(index)
+        many, response = self.count_queries()
+
+        self.assertEqual(len(response.context['conversations']), 11)
+        self.assertEqual(few, many)
+
+
 class ConversationDetailViewTests(TestCase):
     
     def setUp(self):
@@ -162,6 +256,57 @@ class ConversationDetailViewTests(TestCase):
         self.assertIn('messages', response.context) 
         self.assertEqual(len(response.context['messages']), 1)  
 
+    def test_latest_messages_window(self):
+        for i in range(60):
+            Message.objects.create(sender=self.user, receiver=self.user2, chat=self.chat, message=f'Message {i}')
+
+        url = reverse('chat:conversation_detail', args=[self.chat.id])
+        response = self.client.get(url)
+        messages = response.context['messages']
+        self.assertEqual(len(messages), 50)
+        self.assertEqual(messages[-1].message, 'Message 59')
+        self.assertEqual(messages[0].message, 'Message 10')
+
+        response = self.client.get(url, {'cursor': response.context['page_obj'].next_cursor})
+        messages = response.context['messages']
+        self.assertEqual([m.message for m in messages], ['Initial Message'] + [f'Message {i}' for i in range(10)])
+
+    def test_load_older_messages(self):
+        messages = [
+            Message.objects.create(sender=self.user, receiver=self.user2, chat=self.chat, message=f'Message {i}')
+            for i in range(60)
+        ]
+        url = reverse('chat:older_messages', args=[self.chat.id])
+
+        response = self.client.get(url, {'before': messages[10].id})
+        data = response.json()
+        self.assertFalse(data['has_more'])
+        self.assertEqual(data['oldest_id'], self.chat_message.id)
+        self.assertIn('Message 9', data['html'])
+        self.assertNotIn('Message 10', data['html'])
+
+        response = self.client.get(url, {'before': messages[-1].id})
+        data = response.json()
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['oldest_id'], messages[9].id)
+
+    def test_load_older_messages_unknown_message(self):
+        url = reverse('chat:older_messages', args=[self.chat.id])
+        self.assertEqual(self.client.get(url, {'before': 'x'}).status_code, 404)
+        self.assertEqual(self.client.get(url, {'before': 999}).status_code, 404)
+
+    def test_query_count_independent_of_history_length(self):
+        url = reverse('chat:conversation_detail', args=[self.chat.id])
+        with CaptureQueriesContext(connection) as short:
+            self.client.get(url)
+
+        for i in range(80):
+            Message.objects.create(sender=self.user, receiver=self.user2, chat=self.chat, message=f'Message {i}')
+        with CaptureQueriesContext(connection) as long:
+            self.client.get(url)
+
+        self.assertEqual(len(short), len(long))
+
     def test_get_queryset_invalid(self):
         response = self.client.get(reverse('chat:conversation_detail', args=[999]))  
         self.assertEqual(response.status_code, 404)  
@@ -250,6 +395,13 @@ class ConversationMessageEditViewTests(TestCase):
         self.chat_message.refresh_from_db()
         self.assertEqual(self.chat_message.message, 'Edited Message')
 
+    def test_edit_form_shows_latest_window(self):
+        for i in range(60):
+            Message.objects.create(sender=self.user, receiver=self.user2, chat=self.chat, message=f'Message {i}')
+        response = self.client.get(reverse('chat:edit_message', args=[self.chat.id, self.chat_message.id]))
+        self.assertEqual(len(response.context['object_list']), 50)
+        self.assertTrue(response.context['has_older_messages'])
+
     def test_edit_message_not_belonging_to_user(self):
         self.client.logout() 
         self.client.login(username='user2', password='password')  
@@ -395,3 +547,619 @@ class ConversationDetailTemplateTests(TestCase):
         self.assertEqual(response.status_code, 200)  
         self.assertTemplateUsed(response, 'chat/conversationlist.html') 
 
+
+class InProcessBrokerTests(SimpleTestCase):
+
+    def test_publish_numbers_events_and_keeps_history(self):
+        broker = InProcessBroker(history=2)
+        first = broker.publish('chat.1', {'type': 'a'})
+        second = broker.publish('chat.1', {'type': 'b'})
+        third = broker.publish('chat.1', {'type': 'c'})
+
+        self.assertLess(first['id'], second['id'])
+        self.assertLess(second['id'], third['id'])
+        self.assertEqual(broker.last_id('chat.1'), third['id'])
+        self.assertEqual(broker.last_id('chat.2'), 0)
+        self.assertEqual([event['type'] for event in broker.recent('chat.1')], ['b', 'c'])
+        self.assertEqual(broker.recent('chat.1', after=second['id']), [third])
+
+    def test_subscribers_receive_events_of_their_channel(self):
+        broker = InProcessBroker()
+
+        async def listen():
+            async with broker.subscribe('chat.1') as queue:
+                broker.publish('chat.2', {'type': 'other'})
+                broker.publish('chat.1', {'type': 'mine'})
+                event = await queue.get()
+                self.assertTrue(queue.empty())
+                return event
+
+        self.assertEqual(async_to_sync(listen)()['type'], 'mine')
+        self.assertNotIn('chat.1', broker.fanout.queues)
+
+    def test_redis_protocol(self):
+        self.assertEqual(encode_command('PUBLISH', 'chat.1', b'{}'), b'*3\r\n$7\r\nPUBLISH\r\n$6\r\nchat.1\r\n$2\r\n{}\r\n')
+        stream = io.BytesIO(b'*3\r\n$7\r\nmessage\r\n$-1\r\n:42\r\n')
+        self.assertEqual(parse_reply(stream.readline, stream.read), [b'message', None, 42])
+
+
+def encode_reply(value):
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode_reply(item) for item in value)
+    data = value if isinstance(value, bytes) else str(value).encode()
+    return b'$%d\r\n%s\r\n' % (len(data), data)
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        self.write_lock = threading.Lock()
+        self.channels = set()
+        with server.lock:
+            server.handlers.add(self)
+        try:
+            while True:
+                name, *args = [arg.decode() for arg in parse_reply(self.rfile.readline, self.rfile.read)]
+                server.commands.append(name)
+                for reply in getattr(self, name.lower())(*args):
+                    self.send(reply)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with server.lock:
+                server.handlers.discard(self)
+                for channel in self.channels:
+                    server.subscribers[channel].discard(self)
+
+    def send(self, reply):
+        with self.write_lock:
+            self.wfile.write(reply if isinstance(reply, bytes) else encode_reply(reply))
+
+    def auth(self, password):
+        yield b'+OK\r\n'
+
+    select = auth
+
+    def get(self, key):
+        yield self.server.data.get(key)
+
+    def lrange(self, key, start, stop):
+        yield list(self.server.data.get(key, []))
+
+    def eval(self, script, numkeys, seq_key, history_key, fields, size, channel):
+        # What PUBLISH_SCRIPT does, atomically as in Redis.
+        assert script == PUBLISH_SCRIPT
+        with self.server.lock:
+            event_id = self.server.data[seq_key] = self.server.data.get(seq_key, 0) + 1
+            data = f'{{"id": {event_id}' + ('}' if fields == '{}' else ', ' + fields[1:])
+            history = self.server.data.setdefault(history_key, [])
+            history.append(data)
+            del history[:-int(size)]
+            subscribers = list(self.server.subscribers[channel])
+        for handler in subscribers:
+            handler.send([b'message', channel, data])
+        yield event_id
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            with self.server.lock:
+                self.channels.add(channel)
+                self.server.subscribers[channel].add(self)
+            yield [b'subscribe', channel, len(self.channels)]
+
+    def unsubscribe(self, *channels):
+        for channel in channels:
+            with self.server.lock:
+                self.channels.discard(channel)
+                self.server.subscribers[channel].discard(self)
+            yield [b'unsubscribe', channel, len(self.channels)]
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    """Just enough of a Redis server for RedisBroker, in a thread."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeRedisHandler)
+        self.lock = threading.Lock()
+        self.data = {}
+        self.subscribers = defaultdict(set)
+        self.handlers = set()
+        self.commands = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f'redis://127.0.0.1:{self.server_address[1]}/1'
+
+    def subscribed(self):
+        with self.lock:
+            return {channel for channel, handlers in self.subscribers.items() if handlers}
+
+    def drop_connections(self):
+        with self.lock:
+            handlers = list(self.handlers)
+        for handler in handlers:
+            handler.connection.shutdown(socket.SHUT_RDWR)
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+
+async def eventually(condition, timeout=5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not condition():
+        if loop.time() > deadline:
+            raise AssertionError('Condition not met in time.')
+        await asyncio.sleep(0.01)
+
+
+class RedisBrokerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.server = FakeRedis()
+        self.addCleanup(self.server.stop)
+        self.broker = RedisBroker(self.server.url, history=3)
+
+    def test_publish_numbers_stores_and_relays_in_one_command(self):
+        events = [self.broker.publish('chat.1', {'type': 'message.created', 'n': n}) for n in range(5)]
+
+        self.assertEqual([event['id'] for event in events], [1, 2, 3, 4, 5])
+        self.assertEqual(self.server.commands, ['SELECT'] + ['EVAL'] * 5)
+        self.assertEqual(self.broker.recent('chat.1'), events[2:])
+        self.assertEqual(self.broker.recent('chat.1', after=4), events[4:])
+        self.assertEqual(self.broker.last_id('chat.1'), 5)
+        self.assertEqual(self.broker.publish('chat.2', {})['id'], 1)
+
+    def test_concurrent_publishers_get_distinct_ordered_ids(self):
+        threads = [threading.Thread(target=lambda: [self.broker.publish('chat.1', {'type': 'x'}) for _ in range(10)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        history = [json.loads(item)['id'] for item in self.server.data['classifieds:chat.1:history']]
+        self.assertEqual(history, [38, 39, 40])
+
+    def test_publisher_reconnects(self):
+        self.broker.publish('chat.1', {'type': 'a'})
+        self.server.drop_connections()
+        self.assertEqual(self.broker.publish('chat.1', {'type': 'b'})['id'], 2)
+
+    def test_listener_delivers_and_resubscribes_after_a_lost_connection(self):
+        connects = []
+        connect = RedisListener.connect
+
+        async def gated_connect(listener):
+            # Hold the reconnection until the test has published while the listener was away.
+            connects.append(listener)
+            if len(connects) > 1:
+                await reconnect.wait()
+            return await connect(listener)
+
+        async def listen():
+            publish = sync_to_async(self.broker.publish, thread_sensitive=False)
+            async with self.broker.subscribe('chat.1') as queue:
+                await eventually(lambda: 'classifieds:chat.1' in self.server.subscribed())
+                first = await publish('chat.1', {'type': 'a'})
+                self.assertEqual(await asyncio.wait_for(queue.get(), 5), first)
+
+                self.server.drop_connections()
+                await eventually(lambda: len(connects) > 1)
+                missed = await publish('chat.1', {'type': 'b'})
+                reconnect.set()
+                # Replayed from the history once the listener is back.
+                self.assertEqual(await asyncio.wait_for(queue.get(), 5), missed)
+
+                await eventually(lambda: 'classifieds:chat.1' in self.server.subscribed())
+                live = await publish('chat.1', {'type': 'c'})
+                self.assertEqual(await asyncio.wait_for(queue.get(), 5), live)
+            await eventually(lambda: not self.server.subscribed())
+            self.broker.listener().task.cancel()
+
+        reconnect = asyncio.Event()
+        with mock.patch.object(RedisListener, 'connect', gated_connect), self.assertLogs('chat.broker', 'WARNING'):
+            async_to_sync(listen)()
+
+
+@unittest.skipUnless(os.environ.get('CHAT_TEST_REDIS_URL'), 'Set CHAT_TEST_REDIS_URL to test against a Redis server.')
+class RedisServerTests(SimpleTestCase):
+
+    def test_round_trip(self):
+        broker = RedisBroker(os.environ['CHAT_TEST_REDIS_URL'], history=2, prefix=f'classifieds-test-{os.getpid()}')
+
+        async def listen():
+            async with broker.subscribe('chat.1') as queue:
+                event = await sync_to_async(broker.publish, thread_sensitive=False)('chat.1', {'type': 'a', 'n': 1})
+                self.assertEqual(await asyncio.wait_for(queue.get(), 5), event)
+            broker.listener().task.cancel()
+            return event
+
+        event = async_to_sync(listen)()
+        second = broker.publish('chat.1', {})
+        third = broker.publish('chat.1', {'type': 'c'})
+        self.assertEqual(second['id'], event['id'] + 1)
+        self.assertEqual(broker.recent('chat.1'), [second, third])
+        self.assertEqual(broker.last_id('chat.1'), third['id'])
+
+
+@override_settings(CHAT_ASGI=True)
+class ChatRealtimeTests(TestCase):
+
+    def setUp(self):
+        reset_broker()
+        self.addCleanup(reset_broker)
+        self.user1 = User.objects.create_user(username='user1', password='pass')
+        self.user2 = User.objects.create_user(username='user2', password='pass')
+        self.outsider = User.objects.create_user(username='user3', password='pass')
+        self.category = Category.objects.create(name='Test Category')
+        self.ad = Ads.objects.create(
+            user=self.user1, title="Test Ad", category=self.category, description="Test Description",
+            location="Test Location", postal_code="12345", contact_info="test@example.com", price=99.99
+        )
+        self.chat = Chat.objects.create(ad=self.ad)
+        self.chat.users.set([self.user1, self.user2])
+        self.channel = chat_channel(self.chat.id)
+        self.events_url = reverse('chat:conversation_events', args=[self.chat.id])
+
+    def send(self, text):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Message.objects.create(sender=self.user1, receiver=self.user2, chat=self.chat, message=text)
+
+    def test_message_changes_are_published_on_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            message = Message.objects.create(sender=self.user1, receiver=self.user2, chat=self.chat, message='Hi')
+        self.assertEqual(get_broker().recent(self.channel), [])
+        for callback in callbacks:
+            callback()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            message.message = 'Hi there'
+            message.save()
+        message_id = message.id
+        with self.captureOnCommitCallbacks(execute=True):
+            message.delete()
+
+        events = get_broker().recent(self.channel)
+        self.assertEqual([event['type'] for event in events], ['message.created', 'message.edited', 'message.deleted'])
+        self.assertEqual({event['message']['id'] for event in events}, {message_id})
+        self.assertEqual(events[1]['message']['message'], 'Hi there')
+
+    def test_long_poll_returns_missed_events_rendered_for_the_user(self):
+        self.client.force_login(self.user2)
+        after = get_broker().last_id(self.channel)
+        message = self.send('Hello!')
+
+        response = self.client.get(self.events_url, {'after': after})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['events']), 1)
+        self.assertEqual(data['last_event_id'], data['events'][0]['id'])
+        self.assertIn(f'id="message-{message.id}"', data['events'][0]['html'])
+        self.assertIn('Hello!', data['events'][0]['html'])
+        # Received, so no edit/delete controls.
+        self.assertNotIn('Edit', data['events'][0]['html'])
+
+        response = self.client.get(self.events_url, {'after': data['last_event_id'], 'timeout': 0})
+        self.assertEqual(response.json(), {'events': [], 'last_event_id': data['last_event_id']})
+
+    def test_long_poll_requires_a_participant(self):
+        response = self.client.get(self.events_url, {'timeout': 0})
+        self.assertEqual(response.status_code, 403)
+
+        self.client.force_login(self.outsider)
+        response = self.client.get(self.events_url, {'timeout': 0})
+        self.assertEqual(response.status_code, 404)
+
+    def test_detail_page_subscribes_from_the_latest_event(self):
+        self.send('Hello!')
+        self.client.force_login(self.user1)
+        response = self.client.get(reverse('chat:conversation_detail', args=[self.chat.id]))
+        self.assertTrue(response.context['live_updates'])
+        self.assertEqual(response.context['last_event_id'], get_broker().last_id(self.channel))
+        self.assertContains(response, websocket_path(self.chat.id))
+        self.assertContains(response, self.events_url)
+
+    @override_settings(CHAT_ASGI=False)
+    def test_long_poll_is_off_without_asgi(self):
+        self.client.force_login(self.user2)
+        response = self.client.get(self.events_url, {'timeout': 0})
+        self.assertEqual(response.status_code, 404)
+
+    def test_every_middleware_runs_async_under_asgi(self):
+        # Django logs each sync middleware it has to adapt, and then runs the
+        # whole request, a waiting long poll too, in a thread.
+        with self.assertNoLogs('django.request', 'DEBUG'):
+            handler = ASGIHandler()
+        self.assertTrue(iscoroutinefunction(handler._middleware_chain))
+
+    async def test_waiting_long_poll_holds_no_thread(self):
+        await self.async_client.aforce_login(self.user2)
+        after = get_broker().last_id(self.channel)
+        poll = asyncio.create_task(self.async_client.get(self.events_url, {'after': after, 'timeout': 5}))
+        while self.channel not in get_broker().fanout.queues:
+            self.assertFalse(poll.done())
+            await asyncio.sleep(0.01)
+
+        # Through the whole ASGI stack the poll is only awaiting the broker,
+        # so sync code still gets the thread it runs in.
+        message = Message(id=99, sender=self.user1, receiver=self.user2, chat=self.chat, message='Live!')
+        await asyncio.wait_for(sync_to_async(get_broker().publish)(self.channel, message_event(message, 'created')), 1)
+        response = await asyncio.wait_for(poll, 1)
+        self.assertEqual([event['message']['id'] for event in response.json()['events']], [99])
+
+    def websocket(self, user, query=b'', origin=None):
+        """A communicator for ``user``'s WebSocket to the chat; logging in needs the database, so call it via sync_to_async."""
+        self.client.force_login(user)
+        headers = [
+            (b'host', b'testserver'),
+            (b'cookie', f'sessionid={self.client.cookies["sessionid"].value}; csrftoken={"a" * 32}'.encode()),
+        ]
+        if origin:
+            headers.append((b'origin', origin))
+        return ApplicationCommunicator(websocket_app, {
+            'type': 'websocket', 'path': websocket_path(self.chat.id), 'query_string': query, 'headers': headers,
+        })
+
+    async def test_websocket_pushes_events_to_participants(self):
+        communicator = await sync_to_async(self.websocket)(self.user1)
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(5), {'type': 'websocket.accept'})
+
+        message = Message(id=99, sender=self.user1, receiver=self.user2, chat=self.chat, message='Live!')
+        get_broker().publish(self.channel, message_event(message, 'created'))
+        output = await communicator.receive_output(5)
+        event = json.loads(output['text'])
+        self.assertEqual(event['type'], 'message.created')
+        self.assertIn('id="message-99"', event['html'])
+        # Sent by this user, so the delete form carries the CSRF cookie's token.
+        self.assertIn('a' * 32, event['html'])
+
+        get_broker().publish(self.channel, message_event(message, 'deleted'))
+        event = json.loads((await communicator.receive_output(5))['text'])
+        self.assertEqual((event['type'], event['message']['id']), ('message.deleted', 99))
+        self.assertNotIn('html', event)
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(5)
+        self.assertNotIn(self.channel, get_broker().fanout.queues)
+
+    async def test_websocket_replays_missed_events(self):
+        message = Message(id=99, sender=self.user2, receiver=self.user1, chat=self.chat, message='Missed')
+        first = get_broker().publish(self.channel, message_event(message, 'created'))
+        get_broker().publish(self.channel, message_event(message, 'edited'))
+
+        communicator = await sync_to_async(self.websocket)(self.user1, query=f'after={first["id"]}'.encode())
+        await communicator.send_input({'type': 'websocket.connect'})
+        self.assertEqual(await communicator.receive_output(5), {'type': 'websocket.accept'})
+        event = json.loads((await communicator.receive_output(5))['text'])
+        self.assertEqual(event['type'], 'message.edited')
+        self.assertTrue(await communicator.receive_nothing())
+
+        await communicator.send_input({'type': 'websocket.disconnect', 'code': 1000})
+        await communicator.wait(5)
+
+    async def test_websocket_rejects_outsiders_and_other_origins(self):
+        outsider = await sync_to_async(self.websocket)(self.outsider)
+        other_origin = await sync_to_async(self.websocket)(self.user1, origin=b'https://evil.example')
+        for communicator in (outsider, other_origin):
+            await communicator.send_input({'type': 'websocket.connect'})
+            self.assertEqual(await communicator.receive_output(5), {'type': 'websocket.close'})
+            await communicator.wait(5)
+
+
+@override_settings(CHAT_ASGI=False)
+class ShortPollTests(TestCase):
+
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass')
+        self.user2 = User.objects.create_user(username='user2', password='pass')
+        self.outsider = User.objects.create_user(username='user3', password='pass')
+        self.category = Category.objects.create(name='Test Category')
+        self.ad = Ads.objects.create(
+            user=self.user1, title="Test Ad", category=self.category, description="Test Description",
+            location="Test Location", postal_code="12345", contact_info="test@example.com", price=99.99
+        )
+        self.chat = Chat.objects.create(ad=self.ad)
+        self.chat.users.set([self.user1, self.user2])
+        self.first = Message.objects.create(sender=self.user1, receiver=self.user2, chat=self.chat, message='First')
+        self.url = reverse('chat:new_messages', args=[self.chat.id])
+
+    def test_detail_page_polls_from_the_newest_message(self):
+        self.client.force_login(self.user2)
+        response = self.client.get(reverse('chat:conversation_detail', args=[self.chat.id]))
+        self.assertFalse(response.context['chat_realtime'])
+        self.assertEqual(response.context['last_event_id'], self.first.id)
+        self.assertContains(response, self.url)
+        self.assertNotContains(response, websocket_path(self.chat.id))
+
+    def test_returns_the_messages_after_the_given_one(self):
+        second = Message.objects.create(sender=self.user1, receiver=self.user2, chat=self.chat, message='Second')
+        self.client.force_login(self.user2)
+
+        response = self.client.get(self.url, {'after': self.first.id})
+        data = response.json()
+        self.assertEqual([event['id'] for event in data['events']], [second.id])
+        self.assertEqual(data['events'][0]['type'], 'message.created')
+        self.assertIn(f'id="message-{second.id}"', data['events'][0]['html'])
+        self.assertEqual(data['last_event_id'], second.id)
+
+        response = self.client.get(self.url, {'after': second.id})
+        self.assertEqual(response.json(), {'events': [], 'last_event_id': second.id})
+
+    def test_requires_a_participant(self):
+        self.client.force_login(self.outsider)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+class UnreadCounterTests(TestCase):
+
+    def setUp(self):
+        reset_broker()
+        self.addCleanup(reset_broker)
+        self.seller = User.objects.create_user(username='seller', password='pass')
+        self.buyer = User.objects.create_user(username='buyer', password='pass')
+        self.category = Category.objects.create(name='Test Category')
+        self.ad = Ads.objects.create(
+            user=self.seller, title="Test Ad", category=self.category, description="Test Description",
+            location="Test Location", postal_code="12345", contact_info="test@example.com", price=99.99
+        )
+        self.chat = Chat.objects.create(ad=self.ad)
+        self.chat.users.set([self.seller, self.buyer])
+
+    def send(self, sender, receiver, text='Hello'):
+        return Message.objects.create(sender=sender, receiver=receiver, chat=self.chat, message=text)
+
+    def entry(self, user):
+        return ChatInbox.objects.get(chat=self.chat, user=user)
+
+    def test_new_messages_are_unread_for_the_receiver_only(self):
+        self.send(self.buyer, self.seller)
+        message = self.send(self.buyer, self.seller)
+
+        self.assertEqual(self.entry(self.seller).unread_count, 2)
+        buyer_entry = self.entry(self.buyer)
+        self.assertEqual((buyer_entry.unread_count, buyer_entry.last_read_message_id), (0, message.id))
+
+        # Replying means the seller has read the chat.
+        self.send(self.seller, self.buyer)
+        self.assertEqual(self.entry(self.seller).unread_count, 0)
+        self.assertEqual(self.entry(self.buyer).unread_count, 1)
+
+    def test_opening_the_chat_marks_it_read(self):
+        self.send(self.buyer, self.seller)
+        self.client.force_login(self.seller)
+        self.assertContains(self.client.get(reverse('chat:conversation_list')), 'bg-red-500 rounded-full">1</span>')
+
+        self.client.get(reverse('chat:conversation_detail', args=[self.chat.id]))
+        self.assertEqual(self.entry(self.seller).unread_count, 0)
+        response = self.client.get(reverse('chat:conversation_list'))
+        self.assertEqual(response.context['unread_messages_count'](), 0)
+
+    def test_mark_read_keeps_newer_messages_unread(self):
+        first = self.send(self.buyer, self.seller)
+        self.send(self.buyer, self.seller)
+
+        self.assertTrue(self.chat.mark_read(self.seller, first.id))
+        self.assertEqual(self.entry(self.seller).unread_count, 2)
+        self.assertFalse(self.chat.mark_read(self.seller, first.id))
+
+        self.client.force_login(self.seller)
+        latest = Chat.objects.get(pk=self.chat.pk).last_message_id
+        response = self.client.post(reverse('chat:mark_read', args=[self.chat.id]), {'message_id': latest})
+        self.assertEqual(response.json(), {'unread_total': 0})
+        self.assertEqual(self.entry(self.seller).last_read_message_id, latest)
+
+        response = self.client.post(reverse('chat:mark_read', args=[self.chat.id]), {'message_id': 'x'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_mark_read_stops_at_the_last_message(self):
+        first = self.send(self.buyer, self.seller)
+        self.client.force_login(self.seller)
+        response = self.client.post(reverse('chat:mark_read', args=[self.chat.id]), {'message_id': 10 ** 12})
+        self.assertEqual(response.json(), {'unread_total': 0})
+        self.assertEqual(self.entry(self.seller).last_read_message_id, first.id)
+
+        # Later messages are still counted and can still be read.
+        second = self.send(self.buyer, self.seller)
+        self.assertEqual(self.entry(self.seller).unread_count, 1)
+        self.assertTrue(self.chat.mark_read(self.seller, second.id))
+        self.assertEqual(self.entry(self.seller).unread_count, 0)
+
+    def test_deleting_an_unread_message_decrements_the_count(self):
+        read = self.send(self.buyer, self.seller)
+        self.chat.mark_read(self.seller, read.id)
+        unread = self.send(self.buyer, self.seller)
+        self.assertEqual(self.entry(self.seller).unread_count, 1)
+
+        read.delete()
+        self.assertEqual(self.entry(self.seller).unread_count, 1)
+        unread.delete()
+        self.assertEqual(self.entry(self.seller).unread_count, 0)
+
+    def test_messages_of_a_deleted_chat_go_in_one_query(self):
+        for number in range(5):
+            self.send(self.buyer, self.seller, f'Message {number}')
+
+        chat_id = self.chat.id
+        with CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            self.ad.delete()
+
+        message_queries = [query['sql'] for query in queries if '"chat_message"' in query['sql']]
+        self.assertEqual(len(message_queries), 1)
+        self.assertTrue(message_queries[0].startswith('DELETE'))
+        self.assertEqual(get_broker().recent(chat_channel(chat_id)), [])
+
+    def test_badge_total_never_counts_messages(self):
+        for _ in range(3):
+            self.send(self.buyer, self.seller)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(ChatInbox.unread_total(self.seller.id), 3)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('chat_message', queries[0]['sql'])
+
+    def test_changes_are_published_to_the_users_channel(self):
+        newcomer = User.objects.create_user(username='newcomer', password='pass')
+        with self.captureOnCommitCallbacks(execute=True):
+            chat = Chat.objects.create(ad=self.ad)
+            chat.users.set([self.seller, newcomer])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.send(self.buyer, self.seller)
+
+        events = get_broker().recent(user_channel(self.seller.id))
+        self.assertEqual([event['type'] for event in events], ['chat.created', 'unread'])
+        self.assertEqual(events[0]['counterpart'], 'newcomer')
+        self.assertEqual(
+            {key: events[1][key] for key in ('chat_id', 'unread_count', 'total')},
+            {'chat_id': self.chat.id, 'unread_count': 1, 'total': 1},
+        )
+
+    @override_settings(CHAT_ASGI=True, CHAT_SSE_TIMEOUT=0.5)
+    async def test_notification_stream(self):
+        await sync_to_async(self.send)(self.buyer, self.seller)
+        await self.async_client.aforce_login(self.seller)
+
+        response = await self.async_client.get(reverse('chat:notification_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertTrue((await anext(stream)).startswith(b'retry: '))
+        snapshot = (await anext(stream)).decode()
+        self.assertIn('event: unread.snapshot', snapshot)
+        self.assertEqual(json.loads(snapshot.split('data: ')[1])['chats'], {str(self.chat.id): 1})
+
+        event = get_broker().publish(user_channel(self.seller.id), {'type': 'unread', 'chat_id': self.chat.id,
+                                                                     'unread_count': 0, 'total': 0})
+        self.assertEqual(
+            (await anext(stream)).decode(),
+            f'id: {event["id"]}\nevent: unread\ndata: {json.dumps(event)}\n\n',
+        )
+        # The stream ends by itself after CHAT_SSE_TIMEOUT, for the browser to reconnect.
+        self.assertEqual([chunk async for chunk in stream], [])
+        self.assertNotIn(user_channel(self.seller.id), get_broker().fanout.queues)
+
+        await self.async_client.alogout()
+        response = await self.async_client.get(reverse('chat:notification_stream'))
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(CHAT_ASGI=False)
+    def test_badge_polls_without_asgi(self):
+        self.send(self.buyer, self.seller)
+        self.client.force_login(self.seller)
+
+        response = self.client.get(reverse('chat:conversation_list'))
+        self.assertContains(response, f"unreadBadge('', '{reverse('chat:unread_counts')}', 1, 30)")
+        self.assertEqual(self.client.get(reverse('chat:notification_stream')).status_code, 404)
+
+        response = self.client.get(reverse('chat:unread_counts'))
+        self.assertEqual(response.json(), {'type': 'unread.snapshot', 'total': 1, 'chats': {str(self.chat.id): 1}})
+
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('chat:unread_counts')).status_code, 302)
@@ -6,6 +6,12 @@ app_name = 'chat'
 urlpatterns = [
     path('all/', views.ConversationListView.as_view(), name='conversation_list'),
     path('all/conversations/<int:chat_id>/', views.ConversationDetailView.as_view(), name='conversation_detail'),
+    path('notifications/', views.NotificationStreamView.as_view(), name='notification_stream'),
+    path('notifications/unread/', views.UnreadCountsView.as_view(), name='unread_counts'),
+    path('all/conversations/<int:chat_id>/read/', views.ConversationMarkReadView.as_view(), name='mark_read'),
+    path('all/conversations/<int:chat_id>/events/', views.ConversationEventsView.as_view(), name='conversation_events'),
+    path('all/conversations/<int:chat_id>/messages/new/', views.ConversationNewMessagesView.as_view(), name='new_messages'),
+    path('all/conversations/<int:chat_id>/messages/older/', views.ConversationOlderMessagesView.as_view(), name='older_messages'),
     path('all/conversations/<int:chat_id>/message/send/', views.ConversationMesageSendView.as_view(), name='send_message'),
     path('all/conversations/<int:chat_id>/message/<int:message_id>/delete/', views.ConversationMesageDeleteView.as_view(), name='delete_message'),
     path('all/conversations/<int:chat_id>/message/<int:message_id>/edit/', views.ConversationMesageEditView.as_view(), name='edit_message'),
@@ -1,89 +1,302 @@
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.views.generic import ListView, DeleteView, UpdateView, CreateView
-from .models import Chat, Message
+from django.views import View
+from .models import MESSAGE_WINDOW, Chat, ChatInbox, Message
 from django.shortcuts import get_object_or_404,render
 from django.urls import reverse_lazy
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
 from .forms import MessageEditForm
-from django.db.models import Q
+from classifieds.pagination import CursorPaginationMixin
+from .broker import chat_channel, get_broker, user_channel
+from .realtime import (format_sse, message_event, parse_after, publish_unread, render_event, unread_snapshot,
+                       websocket_path)
+
+
+class ConversationMixin:
+    """Shared lookup of the current chat and the context of its message window."""
+
+    def get_chat(self):
+        if not hasattr(self, 'chat'):
+            self.chat = get_object_or_404(
+                Chat.objects.select_related('ad__category'), id=self.kwargs['chat_id'], users=self.request.user
+            )
+        return self.chat
+
+    def get_opposite_user(self):
+        return self.get_chat().users.exclude(id=self.request.user.id).first()
+
+    def get_conversation_context(self, **kwargs):
+        chat = self.get_chat()
+        messages, has_older = chat.messages.latest_window()
+        context = {
+            'object_list': messages,
+            'has_older_messages': has_older,
+            'opposite_user': self.get_opposite_user(),
+            'related_ad': chat.ad,
+            'chat_id': chat.id,
+        }
+        context.update(kwargs)
+        return context
+
 
 class ConversationListView(LoginRequiredMixin, ListView):
     model= Chat
     template_name = 'chat/conversationlist.html'
     context_object_name = 'conversations'
+    query_budget = 4
+    read_replica = True
 
     def get_queryset(self):
-        return Chat.objects.filter(users=self.request.user)
+        return ChatInbox.objects.filter(user=self.request.user).select_related(
+            'chat__ad', 'counterpart'
+        ).order_by('-last_activity_at', '-id')
             
 
-class ConversationDetailView(LoginRequiredMixin, ListView):
+class ConversationDetailView(LoginRequiredMixin, ConversationMixin, CursorPaginationMixin, ListView):
     model = Message
     template_name = 'chat/conversationdetail.html'
     context_object_name = 'messages'
+    paginate_by = MESSAGE_WINDOW
+    # Newest first, so the first page is the latest window of the chat;
+    # get_context_data flips it back to reading order.
+    cursor_ordering = ('-created_on', '-id')
+    query_budget = 6
 
     def get_queryset(self):
-        chat_id = self.kwargs['chat_id']
-        chat = get_object_or_404(Chat, id=chat_id, users=self.request.user)
-
-        return Message.objects.filter(
-                Q(chat=chat) & (Q(sender=self.request.user) | Q(receiver=self.request.user))
-            ).order_by('created_on')
+        return self.get_chat().messages.all()
          
     def get_context_data(self, **kwargs):
+        chat = self.get_chat()
+        realtime = getattr(settings, 'CHAT_ASGI', False)
+        # Read before the messages: live events from here on may repeat one
+        # already on the page, which the client skips, but none can be missed.
+        last_event_id = get_broker().last_id(chat_channel(chat.id)) if realtime else 0
         context = super().get_context_data(**kwargs)
-        chat_id = self.kwargs['chat_id']
-        chat = get_object_or_404(Chat, id=chat_id, users=self.request.user)
+        context['object_list'] = context[self.context_object_name] = context['object_list'][::-1]
 
-        opposite_user = chat.users.exclude(id=self.request.user.id).first()
-        context['opposite_user'] = opposite_user
+        context['has_older_messages'] = context['page_obj'].has_next()
+        context['opposite_user'] = self.get_opposite_user()
         context['related_ad'] = chat.ad  
-        context['chat_id'] = chat_id
+        context['chat_id'] = chat.id
+        # Live updates only make sense on the newest window.
+        context['live_updates'] = not context['page_obj'].has_previous()
+        context['chat_realtime'] = realtime
+        if realtime:
+            context['last_event_id'] = last_event_id
+            context['websocket_path'] = websocket_path(chat.id)
+        else:
+            # Short polls ask for the messages after the newest one on the page.
+            context['last_event_id'] = context['object_list'][-1].id if context['object_list'] else 0
+        context['poll_interval'] = getattr(settings, 'CHAT_POLL_INTERVAL', 5)
+
+        if context['live_updates'] and context['object_list']:
+            if chat.mark_read(self.request.user, context['object_list'][-1].id):
+                publish_unread(chat.id, [self.request.user.id])
 
         return context
 
 
-class ConversationMesageSendView(LoginRequiredMixin, CreateView):
+class ConversationMarkReadView(LoginRequiredMixin, ConversationMixin, View):
+    """Move the read cursor to ``message_id``, for messages that arrived while the chat was open."""
+
+    def post(self, request, *args, **kwargs):
+        chat = self.get_chat()
+        try:
+            message_id = int(request.POST.get('message_id', ''))
+        except ValueError:
+            return JsonResponse({'detail': 'message_id is required.'}, status=400)
+
+        if chat.mark_read(request.user, message_id):
+            publish_unread(chat.id, [request.user.id])
+        return JsonResponse({'unread_total': ChatInbox.unread_total(request.user.id)})
+
+
+class NotificationStreamView(View):
+    """
+    Server-Sent Events stream of the user's unread counts and new chats. It
+    starts with an ``unread.snapshot`` and then relays the user's broker
+    channel, replaying what a reconnecting EventSource missed (its
+    Last-Event-ID). The stream ends after ``CHAT_SSE_TIMEOUT`` seconds and the
+    browser reconnects, so no connection is held forever. Only on with
+    ``CHAT_ASGI``: under WSGI every open stream would hold a worker, and the
+    badge polls ``UnreadCountsView`` instead.
+    """
+
+    async def get(self, request):
+        if not getattr(settings, 'CHAT_ASGI', False):
+            raise Http404("Live chat is off.")
+        user = await request.auser()
+        if not user.is_authenticated:
+            return JsonResponse({'detail': 'Authentication required.'}, status=403)
+
+        response = StreamingHttpResponse(
+            self.stream(user.pk, parse_after(request.headers.get('Last-Event-ID'))),
+            content_type='text/event-stream',
+        )
+        response['Cache-Control'] = 'no-cache'
+        # Keep nginx from buffering the stream.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    async def stream(self, user_id, after):
+        broker = get_broker()
+        channel = user_channel(user_id)
+        keepalive = getattr(settings, 'CHAT_SSE_KEEPALIVE', 15)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + getattr(settings, 'CHAT_SSE_TIMEOUT', 300)
+
+        async with broker.subscribe(channel) as queue:
+            last_id = await sync_to_async(broker.last_id, thread_sensitive=False)(channel)
+            missed = await sync_to_async(broker.recent, thread_sensitive=False)(channel, after) if after else []
+            yield f'retry: {keepalive * 1000}\n\n'
+            yield format_sse(await sync_to_async(unread_snapshot)(user_id), last_id or None)
+            for event in missed:
+                if event['type'] != 'unread':
+                    yield format_sse(event, event['id'])
+
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    event = await asyncio.wait_for(queue.get(), min(keepalive, remaining))
+                except asyncio.TimeoutError:
+                    if loop.time() < deadline:
+                        yield ': keepalive\n\n'
+                    continue
+                if event['id'] > last_id:
+                    yield format_sse(event, event['id'])
+
+
+class UnreadCountsView(LoginRequiredMixin, View):
+    """The ``unread.snapshot`` of the notification stream as JSON, for the badge to poll without ``CHAT_ASGI``."""
+    query_budget = 3
+
+    def get(self, request):
+        response = JsonResponse(unread_snapshot(request.user.pk))
+        response['Cache-Control'] = 'no-cache'
+        return response
+
+
+class ConversationEventsView(View):
+    """
+    Long-poll fallback for the chat WebSocket: the events after ``?after=<event
+    id>``, waiting up to ``CHAT_LONG_POLL_TIMEOUT`` seconds (or ``?timeout=``,
+    if shorter) for one to be published. Async, like every middleware in
+    ``MIDDLEWARE``, so a waiting client holds no thread when served over ASGI.
+    """
+
+    async def get(self, request, chat_id):
+        if not getattr(settings, 'CHAT_ASGI', False):
+            # Under WSGI a waiting poll would hold a worker.
+            raise Http404("Live chat is off.")
+        user = await request.auser()
+        if not user.is_authenticated:
+            return JsonResponse({'detail': 'Authentication required.'}, status=403)
+        if not await Chat.objects.filter(id=chat_id, users=user).aexists():
+            raise Http404("No chat found.")
+
+        after = parse_after(request.GET.get('after'))
+        limit = getattr(settings, 'CHAT_LONG_POLL_TIMEOUT', 25)
+        try:
+            timeout = min(max(float(request.GET.get('timeout', limit)), 0), limit)
+        except ValueError:
+            timeout = limit
+
+        broker = get_broker()
+        channel = chat_channel(chat_id)
+        async with broker.subscribe(channel) as queue:
+            events = await sync_to_async(broker.recent, thread_sensitive=False)(channel, after)
+            if not events and timeout:
+                try:
+                    events.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    pass
+            while not queue.empty():
+                events.append(queue.get_nowait())
+
+        # An event may be both in the history and in the queue.
+        events = sorted({event['id']: event for event in events if event['id'] > after}.values(),
+                        key=lambda event: event['id'])
+        csrf_token = get_token(request)
+        return JsonResponse({
+            'events': [render_event(event, user, csrf_token) for event in events],
+            'last_event_id': events[-1]['id'] if events else after,
+        })
+
+
+class ConversationNewMessagesView(LoginRequiredMixin, ConversationMixin, View):
+    """
+    Short-poll fallback without ``CHAT_ASGI``: the messages after ``?after=<message
+    id>``, read from the database and answered at once, as ``message.created``
+    events numbered by message id. Works across any number of WSGI workers;
+    edits and deletions show on the next page load.
+    """
+    query_budget = 4
+
+    def get(self, request, *args, **kwargs):
+        chat = self.get_chat()
+        after = parse_after(request.GET.get('after'))
+        messages = list(chat.messages.filter(id__gt=after).order_by('id')[:MESSAGE_WINDOW])
+        csrf_token = get_token(request)
+        return JsonResponse({
+            'events': [render_event({**message_event(message, 'created'), 'id': message.id}, request.user, csrf_token)
+                       for message in messages],
+            'last_event_id': messages[-1].id if messages else after,
+        })
+
+
+class ConversationOlderMessagesView(LoginRequiredMixin, ConversationMixin, View):
+    """The window of messages before ``?before=<message id>``, as a rendered fragment inside JSON."""
+    query_budget = 5
+
+    def get(self, request, *args, **kwargs):
+        chat = self.get_chat()
+        try:
+            before = chat.messages.get(id=int(request.GET.get('before', '')))
+        except (ValueError, Message.DoesNotExist):
+            raise Http404("Unknown message.")
+
+        messages, has_more = chat.messages.latest_window(before=before)
+        html = render_to_string('chat/message_list.html', {'object_list': messages, 'chat_id': chat.id}, request=request)
+
+        return JsonResponse({
+            'html': html,
+            'has_more': has_more,
+            'oldest_id': messages[0].id if messages else None,
+        })
+
+
+class ConversationMesageSendView(LoginRequiredMixin, ConversationMixin, CreateView):
     model = Message
     fields = ['message']
     template_name = 'chat/conversationdetail.html'
 
     def form_valid(self, form):
-        chat_id = self.kwargs['chat_id']
-        chat = get_object_or_404(Chat, id=chat_id, users=self.request.user)
-        opposite_user = chat.users.exclude(id=self.request.user.id).first()
-        
         form.instance.sender = self.request.user
-        form.instance.receiver = opposite_user
-        form.instance.chat = chat
+        form.instance.receiver = self.get_opposite_user()
+        form.instance.chat = self.get_chat()
         
         return super().form_valid(form)
 
     def form_invalid(self, form):
-        chat_id = self.kwargs['chat_id']
-        chat = get_object_or_404(Chat, id=chat_id, users=self.request.user)
-        opposite_user = chat.users.exclude(id=self.request.user.id).first()
-
-        context = {
-            'object_list': Message.objects.filter(chat=chat).order_by('created_on'),
-            'message_send_form': form,
-            'opposite_user': opposite_user,
-            'related_ad': chat.ad,
-            'chat_id': chat_id,  
-        }
-
+        context = self.get_conversation_context(message_send_form=form)
         return render(self.request, self.template_name, context)
 
     def get_success_url(self):
         return reverse_lazy('chat:conversation_detail', args=[self.kwargs['chat_id']])    
 
 
-class ConversationMesageEditView(LoginRequiredMixin, UpdateView):
+class ConversationMesageEditView(LoginRequiredMixin, ConversationMixin, UpdateView):
     model = Message
     form_class = MessageEditForm
     template_name = 'chat/conversationdetail.html'
 
     def get_queryset(self):
-        chat = get_object_or_404(Chat, id=self.kwargs['chat_id'], users=self.request.user)
-        return Message.objects.filter(chat=chat, sender=self.request.user) 
+        return Message.objects.filter(chat=self.get_chat(), sender=self.request.user) 
 
     def get_object(self, queryset=None):
         queryset = self.get_queryset()  
@@ -91,20 +304,11 @@ class ConversationMesageEditView(LoginRequiredMixin, UpdateView):
         return obj
     
     def form_invalid(self, form):
-        chat_id = self.kwargs['chat_id']
-        chat = get_object_or_404(Chat, id=chat_id, users=self.request.user)
-        opposite_user = chat.users.exclude(id=self.request.user.id).first()
-
-        context = {
-            'object_list': Message.objects.filter(chat=chat).order_by('created_on'),
-            'message_edit_form': form,
-            'opposite_user': opposite_user,
-            'related_ad': chat.ad,
-            'editMessage': 'true',
-            'message_id': self.object.id,
-            'chat_id': chat_id,  
-        }
-
+        context = self.get_conversation_context(
+            message_edit_form=form,
+            editMessage='true',
+            message_id=self.object.id,
+        )
         return render(self.request, self.template_name, context)
 
     def get_success_url(self):
@@ -113,20 +317,11 @@ class ConversationMesageEditView(LoginRequiredMixin, UpdateView):
     def get(self, request, *args, **kwargs):
         self.object = self.get_object()  
         form = self.get_form()  
-        chat_id = self.kwargs['chat_id']
-        chat = get_object_or_404(Chat, id=chat_id, users=self.request.user)
-        opposite_user = chat.users.exclude(id=self.request.user.id).first()
-
-        context = {
-            'object_list': Message.objects.filter(chat=chat).order_by('created_on'),
-            'message_edit_form': form,
-            'opposite_user': opposite_user,
-            'related_ad': chat.ad,
-            'editMessage': 'true',
-            'message_id': self.object.id,
-            'chat_id': chat_id,  
-        }
-
+        context = self.get_conversation_context(
+            message_edit_form=form,
+            editMessage='true',
+            message_id=self.object.id,
+        )
         return render(self.request, self.template_name, context)
 
 
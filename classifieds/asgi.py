@@ -2,6 +2,8 @@
 ASGI config for classifieds project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django; WebSocket connections go to the live chat endpoint in
+``chat.realtime``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +15,13 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'classifieds.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up.
+from chat.realtime import websocket_app  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        return await websocket_app(scope, receive, send)
+    return await django_application(scope, receive, send)
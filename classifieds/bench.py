@@ -0,0 +1,71 @@
+"""
+Helpers shared by ``manage.py run_bench`` and the scripts in ``benchmarks/``:
+latency percentiles, and a throwaway database for a script to set Django up
+against. Nothing here imports Django until ``setup_django()``.
+"""
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summary(samples):
+    """p50/p95/p99/max of ``samples`` in milliseconds, rounded for the JSON reports."""
+    if not samples:
+        return {}
+    return {
+        'p50_ms': round(statistics.median(samples), 3),
+        'p95_ms': round(percentile(samples, 0.95), 3),
+        'p99_ms': round(percentile(samples, 0.99), 3),
+        'max_ms': round(max(samples), 3),
+    }
+
+
+def timed(function, repeat):
+    """Call ``function`` ``repeat`` times and summarize how long each call took."""
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append((time.perf_counter() - started) * 1000)
+    return summary(samples)
+
+
+@contextmanager
+def scratch_directory(prefix):
+    """A temporary directory for throwaway databases, removed afterwards."""
+    workdir = tempfile.mkdtemp(prefix=prefix)
+    try:
+        yield workdir
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+@contextmanager
+def scratch_database(prefix, database_url=None):
+    """
+    Point ``DATABASE_URL`` at ``database_url``, which must be an empty
+    database, or at a new SQLite file that is removed afterwards.
+    """
+    if database_url:
+        os.environ['DATABASE_URL'] = database_url
+        yield
+        return
+    with scratch_directory(prefix) as workdir:
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.sqlite3')}"
+        yield
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'classifieds.settings')
+    os.environ.setdefault('DJANGO_SECRET_KEY', 'benchmark')
+
+    import django
+    django.setup()
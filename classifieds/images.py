@@ -0,0 +1,136 @@
+"""
+Resized renditions of uploaded images.
+
+Every image is re-encoded at a few fixed widths (``IMAGE_RENDITIONS``), once
+as WebP and once as JPEG, next to the original under ``renditions/``. The
+paths are kept on the model in a JSON field shaped like::
+
+    {"source": "ads/2024/10/01/bike.jpg",
+     "card": {"width": 480, "height": 360, "webp": "...", "jpeg": "..."}, ...}
+
+so templates can build ``srcset`` without touching the storage, and
+``source`` tells whether the renditions still belong to the current file.
+
+With ``IMAGE_RENDITIONS_IN_BACKGROUND`` the work is queued as a job, and the
+original is shown until the renditions exist.
+"""
+import hashlib
+import os
+from io import BytesIO
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from jobs.queue import task
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+DEFAULT_RENDITIONS = {'card': 480, 'detail': 1280, 'zoom': 2048}
+FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+
+
+def get_renditions():
+    return getattr(settings, 'IMAGE_RENDITIONS', DEFAULT_RENDITIONS)
+
+
+def rendition_name(source, name, extension):
+    directory, filename = os.path.split(source)
+    stem = os.path.splitext(filename)[0]
+    return os.path.join(directory, 'renditions', f'{stem}-{name}.{extension}')
+
+
+def render(source, storage=default_storage):
+    """
+    Write the renditions of the stored file ``source`` and return their
+    description. An unreadable or missing file gets no renditions, so a bad
+    upload falls back to the original instead of failing the request.
+    """
+    quality = getattr(settings, 'IMAGE_RENDITION_QUALITY', 80)
+    renditions = {'source': source}
+    try:
+        with storage.open(source) as file:
+            original = ImageOps.exif_transpose(Image.open(file))
+            original.load()
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        return renditions
+
+    original = original.convert('RGB')
+    for name, width in sorted(get_renditions().items(), key=lambda item: item[1]):
+        # Never upscale: a small photo gets renditions at its own size.
+        width = min(width, original.width)
+        height = max(round(original.height * width / original.width), 1)
+        resized = original if width == original.width else original.resize((width, height), Image.LANCZOS)
+
+        rendition = {'width': width, 'height': height}
+        for extension, format in FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, format, quality=quality, optimize=True)
+            path = rendition_name(source, name, extension)
+            if storage.exists(path):
+                storage.delete(path)
+            rendition[extension] = storage.save(path, ContentFile(buffer.getvalue()))
+        renditions[name] = rendition
+    return renditions
+
+
+@task
+def build_renditions(model, pk):
+    obj = apps.get_model(model).objects.filter(pk=pk).first()
+    if obj is not None and obj.renditions_stale():
+        obj.refresh_renditions()
+
+
+class RenditionsMixin:
+    """
+    Model mixin keeping ``renditions_field`` (a JSONField) in step with the
+    image in ``renditions_source``. Renditions are rebuilt on save whenever the
+    image changed.
+    """
+    renditions_source = 'image'
+    renditions_field = 'renditions'
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if not self.renditions_stale():
+            return
+        source = self.source_file()
+        if source and getattr(settings, 'IMAGE_RENDITIONS_IN_BACKGROUND', False):
+            digest = hashlib.md5(source.name.encode()).hexdigest()
+            build_renditions.enqueue(
+                key=f'renditions:{self._meta.label_lower}:{self.pk}:{digest}',
+                model=self._meta.label_lower, pk=self.pk,
+            )
+        else:
+            self.refresh_renditions()
+
+    def source_file(self):
+        return getattr(self, self.renditions_source)
+
+    def get_renditions(self):
+        return getattr(self, self.renditions_field) or {}
+
+    def renditions_stale(self):
+        source = self.source_file()
+        return self.get_renditions().get('source') != (source.name if source else None)
+
+    def refresh_renditions(self, storage=None):
+        source = self.source_file()
+        renditions = render(source.name, storage or source.storage) if source else {}
+        setattr(self, self.renditions_field, renditions)
+        # Saved like any other change, so post_save listeners see the new renditions.
+        self.save(update_fields=[self.renditions_field])
+
+    def rendition_url(self, name, extension='jpeg'):
+        rendition = self.get_renditions().get(name)
+        if rendition:
+            return self.source_file().storage.url(rendition[extension])
+        source = self.source_file()
+        return source.url if source else ''
+
+    def srcset(self, extension='jpeg'):
+        storage = self.source_file().storage
+        renditions = [value for key, value in self.get_renditions().items() if key != 'source']
+        widths = {}
+        for rendition in sorted(renditions, key=lambda rendition: rendition['width']):
+            widths.setdefault(rendition['width'], storage.url(rendition[extension]))
+        return ', '.join(f'{url} {width}w' for width, url in widths.items())
@@ -0,0 +1,143 @@
+"""
+Serving uploaded media (``MEDIA_ROOT`` under ``MEDIA_URL``).
+
+``MediaView`` answers GET and HEAD with the validators browsers revalidate
+with: a strong ETag made from the file's modification time, size and inode,
+and Last-Modified. A matching ``If-None-Match`` or ``If-Modified-Since``
+gets a bodiless 304. A single byte range (``Range: bytes=...``, honoured
+only while ``If-Range`` still matches) gets a 206 of just those bytes.
+Files go out through ``FileResponse``, so a server with
+``wsgi.file_wrapper`` (gunicorn) sends them with ``sendfile()`` without
+copying them through Python.
+
+Behind nginx, set ``MEDIA_ACCEL_REDIRECT`` to the prefix of an
+``internal`` location aliased to MEDIA_ROOT. The view then only checks that
+the file exists and answers with ``X-Accel-Redirect``, and nginx sends the
+file, ranges and 304s included.
+"""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, parse_http_date_safe
+from django.views import View
+
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    """``length`` bytes of an open file from its current position, for FileResponse."""
+
+    def __init__(self, file, length):
+        self.file = file
+        self.name = file.name
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        # For sendfile(): the server starts at tell() and stops at Content-Length.
+        return self.file.fileno()
+
+    def tell(self):
+        return self.file.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.file.seek(offset, whence)
+
+    def seekable(self):
+        return False
+
+    def close(self):
+        self.file.close()
+
+
+def etag(stat):
+    return f'"{stat.st_mtime_ns:x}-{stat.st_size:x}-{stat.st_ino:x}"'
+
+
+def byte_range(request, size, tag, last_modified):
+    """
+    ``(start, end)`` of the requested range, inclusive; None to send the
+    whole file; ``()`` if the range can't be satisfied.
+    """
+    header = request.headers.get('Range', '')
+    match = RANGE.match(header.replace(' ', ''))
+    if not match or not any(match.groups()):
+        # No range, or several: the whole file is a valid answer.
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range and if_range != tag and parse_http_date_safe(if_range) != last_modified:
+        return None
+    first, last = match.groups()
+    if not first:
+        # The last ``last`` bytes.
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        return ()
+    return start, end
+
+
+class MediaView(View):
+    http_method_names = ['get', 'head']
+    query_budget = 0
+
+    def get(self, request, path):
+        try:
+            full_path = safe_join(settings.MEDIA_ROOT, path)
+            stat = os.stat(full_path)
+        except (SuspiciousFileOperation, OSError):
+            raise Http404('No such file.')
+        if not os.path.isfile(full_path):
+            raise Http404('No such file.')
+
+        accel = getattr(settings, 'MEDIA_ACCEL_REDIRECT', '')
+        if accel:
+            response = HttpResponse()
+            # nginx sets the type from the file name.
+            del response['Content-Type']
+            response['X-Accel-Redirect'] = accel.rstrip('/') + '/' + quote(path)
+            return response
+
+        tag, last_modified = etag(stat), int(stat.st_mtime)
+        response = get_conditional_response(request, etag=tag, last_modified=last_modified)
+        if response is None:
+            response = self.file_response(request, full_path, stat.st_size, tag, last_modified)
+        response['ETag'] = tag
+        response['Last-Modified'] = http_date(last_modified)
+        response['Accept-Ranges'] = 'bytes'
+        patch_cache_control(response, public=True, max_age=getattr(settings, 'MEDIA_CACHE_MAX_AGE', 86400))
+        return response
+
+    def file_response(self, request, full_path, size, tag, last_modified):
+        span = byte_range(request, size, tag, last_modified)
+        if span == ():
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        start, end = span or (0, size - 1)
+        length = max(end - start + 1, 0)
+
+        file = open(full_path, 'rb')
+        file.seek(start)
+        response = FileResponse(FileRange(file, length), status=206 if span else 200)
+        response['Content-Length'] = length
+        if span:
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        if request.method == 'HEAD':
+            # Same headers, no body.
+            file.close()
+            response.streaming_content = []
+        return response
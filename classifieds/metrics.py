@@ -0,0 +1,180 @@
+"""
+Per-request instrumentation.
+
+``RequestMetricsMiddleware`` counts the queries of every request and the
+time spent in the database, times template rendering and collects the cache
+hits and misses reported with ``record_cache``. The figures go out as a
+``Server-Timing`` header, which browsers show in the network panel, while
+``METRICS_SERVER_TIMING`` is on, and as one log line per request on the
+``classifieds.metrics`` logger, with the values also in the record's
+``metrics`` attribute for structured handlers.
+
+A view may declare a ``query_budget``, the number of queries a request to it
+may run, or a dict of them by HTTP method (``{'GET': 5}`` leaves the other
+methods unchecked); ``QUERY_BUDGETS`` maps URL names to budgets that
+override it. A request over budget logs a warning, or with
+``QUERY_BUDGET_RAISE`` (on under ``manage.py test``) raises
+``QueryBudgetExceeded``, so an N+1 regression fails the test that renders
+the page.
+"""
+import logging
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+current = ContextVar('request_metrics', default=None)
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class RequestMetrics:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total_time = 0.0
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # Called by count_query for the queries of the request.
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - started
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total_time * 1000, 2),
+            'db_ms': round(self.db_time * 1000, 2),
+            'queries': self.queries,
+            'render_ms': round(self.render_time * 1000, 2),
+            'cache_hits': self.cache_hits,
+            'cache_misses': self.cache_misses,
+        }
+
+    def server_timing(self):
+        return ', '.join([
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries"',
+            f'render;dur={self.render_time * 1000:.1f}',
+            f'cache;desc="{self.cache_hits} hits, {self.cache_misses} misses"',
+            f'total;dur={self.total_time * 1000:.1f}',
+        ])
+
+
+def count_query(execute, sql, params, many, context):
+    metrics = current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def measure_connection(sender, connection, **kwargs):
+    # Connections belong to threads, and under ASGI the ORM runs in the
+    # sync_to_async ones: a wrapper on every connection finds the request's
+    # metrics through the context, which those threads inherit.
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+def record_cache(hit):
+    """Count a cache hit or miss against the current request, if any."""
+    metrics = current.get()
+    if metrics is not None:
+        if hit:
+            metrics.cache_hits += 1
+        else:
+            metrics.cache_misses += 1
+
+
+def query_budget(request):
+    """The query budget of the view that served ``request``, or None."""
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    budgets = getattr(settings, 'QUERY_BUDGETS', {})
+    view = getattr(match.func, 'view_class', match.func)
+    budget = budgets.get(match.view_name, getattr(view, 'query_budget', None))
+    if isinstance(budget, dict):
+        return budget.get(request.method)
+    return budget
+
+
+class RequestMetricsMiddleware:
+    """Measures each request; goes first in MIDDLEWARE so the others' queries count too."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+        # Any opened before this module was imported.
+        for connection in connections.all(initialized_only=True):
+            measure_connection(None, connection)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.report(request, response, metrics)
+
+    async def __acall__(self, request):
+        # Async views such as the chat long poll: no thread is held while waiting.
+        metrics = RequestMetrics()
+        token = current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.report(request, response, metrics)
+
+    def report(self, request, response, metrics):
+        metrics.total_time = time.perf_counter() - metrics.started
+
+        if getattr(settings, 'METRICS_SERVER_TIMING', False):
+            response['Server-Timing'] = metrics.server_timing()
+        match = getattr(request, 'resolver_match', None)
+        view_name = match.view_name if match else None
+        data = {'method': request.method, 'path': request.path, 'view': view_name,
+                'status': response.status_code, **metrics.as_dict()}
+        logger.info(' '.join(f'{key}={value}' for key, value in data.items()), extra={'metrics': data})
+
+        budget = query_budget(request)
+        if budget is not None and metrics.queries > budget:
+            message = f'{view_name} ran {metrics.queries} queries, over its budget of {budget}.'
+            if getattr(settings, 'QUERY_BUDGET_RAISE', False):
+                raise QueryBudgetExceeded(message)
+            logger.warning(message, extra={'metrics': data})
+        return response
+
+    def process_template_response(self, request, response):
+        # Template responses render after the view returns, once every
+        # middleware has had them: time from here to the post-render callback.
+        metrics = current.get()
+        if metrics is not None:
+            started = time.perf_counter()
+
+            def rendered(response):
+                metrics.render_time += time.perf_counter() - started
+
+            response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,143 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are addressed by an opaque token holding the sort key of the row at the
+edge of the previous page, so fetching a page is a single indexed range query:
+no ``COUNT(*)`` and no ``OFFSET`` scan however deep the user goes.
+"""
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorPage:
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Paginate ``queryset`` on ``ordering``, a tuple of field names that all sort
+    in the same direction and whose last entry is unique (usually ``id``).
+    """
+
+    def __init__(self, queryset, per_page, ordering=('-created_at', '-id')):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = tuple(ordering)
+        self.descending = self.ordering[0].startswith('-')
+        self.fields = [name.lstrip('-') for name in self.ordering]
+
+    def encode_cursor(self, obj, direction):
+        values = [self._field(name).value_to_string(obj) for name in self.fields]
+        payload = json.dumps([direction] + values, separators=(',', ':'))
+        return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            direction, *raw_values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+            if direction not in ('n', 'p') or len(raw_values) != len(self.fields):
+                raise ValueError(cursor)
+            values = [self._field(name).to_python(value) for name, value in zip(self.fields, raw_values)]
+        except (ValueError, TypeError, ValidationError) as exc:
+            raise InvalidCursor(cursor) from exc
+        return direction, values
+
+    def page(self, cursor=None):
+        direction, values = ('n', None) if not cursor else self.decode_cursor(cursor)
+        backwards = direction == 'p'
+
+        queryset = self.queryset
+        if values is not None:
+            queryset = queryset.filter(self._after(values, reverse=backwards))
+        ordering = self._reversed_ordering() if backwards else self.ordering
+        rows = list(queryset.order_by(*ordering)[:self.per_page + 1])
+
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+
+        if not rows:
+            return CursorPage(rows, self)
+
+        # Walking forward we only know there is something behind us if we
+        # arrived through a cursor, and vice versa.
+        has_next = has_more if not backwards else True
+        has_previous = has_more if backwards else values is not None
+        return CursorPage(
+            rows,
+            self,
+            next_cursor=self.encode_cursor(rows[-1], 'n') if has_next else None,
+            previous_cursor=self.encode_cursor(rows[0], 'p') if has_previous else None,
+        )
+
+    def _field(self, name):
+        return self.queryset.model._meta.get_field('id' if name == 'pk' else name)
+
+    def _reversed_ordering(self):
+        return tuple(name[1:] if name.startswith('-') else f'-{name}' for name in self.ordering)
+
+    def _after(self, values, reverse=False):
+        """Rows strictly after ``values`` in (possibly reversed) sort order."""
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        condition = Q()
+        for index, name in enumerate(self.fields):
+            equal = {field: value for field, value in zip(self.fields[:index], values[:index])}
+            condition |= Q(**equal, **{f'{name}__{lookup}': values[index]})
+        return condition
+
+
+class CursorPaginationMixin:
+    """
+    ``ListView`` mixin swapping Django's offset paginator for a
+    ``CursorPaginator``. Templates get ``page_obj`` with ``next_cursor`` and
+    ``previous_cursor`` and should include ``cursor_pagination.html``.
+    """
+    cursor_ordering = ('-created_at', '-id')
+    cursor_kwarg = 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = CursorPaginator(queryset, page_size, self.cursor_ordering)
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor:
+            raise Http404("Invalid cursor.")
+        return paginator, page, page.object_list, page.has_other_pages()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        params = self.request.GET.copy()
+        params.pop(self.cursor_kwarg, None)
+        context['cursor_kwarg'] = self.cursor_kwarg
+        context['cursor_querystring'] = params.urlencode()
+        return context
@@ -0,0 +1,112 @@
+"""
+Read replicas.
+
+``DATABASE_REPLICAS`` lists the aliases of read-only copies of the default
+database (settings builds them from ``DATABASE_REPLICA_URLS``). A view opts
+in with ``read_replica = True``. For a GET or HEAD request to it,
+``ReplicaRoutingMiddleware`` picks a random replica and ``ReplicaRouter``
+sends the request's reads there. Everything else reads from the primary:
+other views, management commands, jobs.
+
+Writes always go to the primary. Once a request asks the router where to
+write, its remaining reads go to the primary too, and the response sets a
+cookie that keeps the client on the primary for ``REPLICA_PIN_SECONDS``.
+A user who just liked an ad, sent a message or edited an ad never reads
+their own change from a replica that is still behind.
+
+Other visitors may still see the change late, by the replication lag.
+``REPLICA_PIN_SECONDS`` is taken as the bound on that lag: the anonymous
+page cache keeps pages rendered from a replica no longer than that.
+"""
+import random
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+PIN_COOKIE = 'pin_primary'
+current = ContextVar('replica_routing', default=None)
+
+
+class RoutingState:
+
+    def __init__(self, pinned):
+        self.pinned = pinned
+        # The alias reads go to, if not the primary.
+        self.replica = None
+        self.wrote = False
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def choose_replica():
+    return random.choice(replicas())
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = current.get()
+        if state is None or state.replica is None:
+            return None
+        return 'default' if state.wrote else state.replica
+
+    def db_for_write(self, model, **hints):
+        state = current.get()
+        if state is not None:
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Every alias holds the same data.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in replicas()
+
+
+class ReplicaRoutingMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = current.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.pin(state, response)
+
+    async def __acall__(self, request):
+        # The ORM runs in sync_to_async threads, which copy this context: the
+        # router there sees the same state and its writes mark it.
+        state = RoutingState(pinned=PIN_COOKIE in request.COOKIES)
+        token = current.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current.reset(token)
+        return self.pin(state, response)
+
+    def pin(self, state, response):
+        if state.wrote and replicas():
+            response.set_cookie(PIN_COOKIE, '1', max_age=getattr(settings, 'REPLICA_PIN_SECONDS', 10),
+                                httponly=True, samesite='Lax')
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view = getattr(view_func, 'view_class', view_func)
+        state = current.get()
+        if (state is not None and not state.pinned and request.method in ('GET', 'HEAD')
+                and getattr(view, 'read_replica', False) and replicas()):
+            state.replica = choose_replica()
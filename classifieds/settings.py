@@ -12,7 +12,9 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 
 from pathlib import Path
 import os
+import sys
 from dotenv import load_dotenv
+from classifieds import sqlite
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -29,6 +31,8 @@ SECRET_KEY = os.environ.get('DJANGO_SECRET_KEY')
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = os.environ.get('DJANGO_DEBUG', '') != 'False'
 
+TESTING = sys.argv[1:2] == ['test']
+
 ALLOWED_HOSTS = ['deepankumartpdev.pythonanywhere.com', '127.0.0.1']
 
 CSRF_TRUSTED_ORIGINS = ['https://deepankumartpdev.pythonanywhere.com']
@@ -46,13 +50,16 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'ads.apps.AdsConfig',
     'chat.apps.ChatConfig',
+    'jobs.apps.JobsConfig',
     'widget_tweaks',
     'taggit',
 ]
 
 MIDDLEWARE = [
+    'classifieds.metrics.RequestMetricsMiddleware',
+    'classifieds.replicas.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'classifieds.staticfiles.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -76,6 +83,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'chat.context_processors.unread_messages',
+                'accounts.context_processors.profile',
             ],
         },
     },
@@ -87,11 +96,13 @@ WSGI_APPLICATION = 'classifieds.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
+# SQLite connections run with WAL and tuned pragmas, configurable through
+# SQLITE_* environment variables; see classifieds/sqlite.py.
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-
+        'OPTIONS': sqlite.options(),
     }
 }
 
@@ -132,13 +143,38 @@ USE_TZ = True
 
 
 STATIC_URL = '/static/'
-STATIC_ROOT = os.path.join(BASE_DIR, '/staticfiles/')
+STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 
+# collectstatic gives every file a content hash in its name and writes gzip
+# and Brotli copies next to it; WhiteNoise serves the hashed names with
+# far-future immutable caching and picks the encoding the client accepts.
+# Tests run without collectstatic, so they use the plain storage.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage' if TESTING
+        else 'whitenoise.storage.CompressedManifestStaticFilesStorage',
+    },
+}
+
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media/')
+# Served by classifieds.media.MediaView; behind nginx, set MEDIA_ACCEL_REDIRECT
+# to an internal location aliased to MEDIA_ROOT and nginx sends the files.
+MEDIA_ACCEL_REDIRECT = os.getenv('MEDIA_ACCEL_REDIRECT', '')
+MEDIA_CACHE_MAX_AGE = 86400
+
+# Widths of the resized copies made of every uploaded ad image and profile
+# photo (classifieds.images); `manage.py build_renditions` backfills them.
+IMAGE_RENDITIONS = {'card': 480, 'detail': 1280, 'zoom': 2048}
+IMAGE_RENDITION_QUALITY = 80
+# Build renditions in a background job instead of during the upload request.
+IMAGE_RENDITIONS_IN_BACKGROUND = True
 
 LOGIN_REDIRECT_URL = 'ads:home'
 LOGOUT_REDIRECT_URL = 'ads:home'
@@ -153,6 +189,119 @@ EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD')
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
+# Caching: local memory by default; set CACHE_LOCATION to a directory to use
+# the file-based backend shared by all workers on the host.
+if os.getenv('CACHE_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('CACHE_LOCATION'),
+        },
+        'sessions': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(os.getenv('CACHE_LOCATION'), 'sessions'),
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+        'sessions': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'sessions',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        },
+    }
+
+# Sessions are read from their own cache and written through to the database
+# (cached_db); `manage.py sweep_sessions` deletes the expired rows. Every
+# worker has to share that cache, or a logout in one would leave the session
+# cached in the others: local memory caching is only used for sessions when a
+# single process serves the requests (runserver, tests).
+SESSION_CACHE_ALIAS = 'sessions'
+if os.getenv('CACHE_LOCATION') or DEBUG or TESTING:
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+
+# Seconds an anonymous home, category or ad page stays cached; edits expire it sooner.
+ADS_PAGE_CACHE_TIMEOUT = 300
+# Edits expire cached pages by bumping versions in the cache, which only the
+# workers sharing that cache see: like sessions, pages are only cached in
+# local memory when a single process serves the requests.
+ADS_PAGE_CACHE_ENABLED = bool(os.getenv('CACHE_LOCATION')) or DEBUG or TESTING
+
+# Tag and location suggestions (ads.autocomplete): new values are read at most
+# every AUTOCOMPLETE_REFRESH seconds, and the index is rebuilt every
+# AUTOCOMPLETE_RELOAD seconds to pick up edits and deletions made elsewhere.
+AUTOCOMPLETE_REFRESH = 5
+AUTOCOMPLETE_RELOAD = 600
+
+# Background jobs (jobs app), run by `manage.py runworker`. With JOBS_EAGER
+# they run inside the request instead, for development without a worker.
+# Password reset mail is sent by a job: without a worker running, or
+# JOBS_EAGER=1, it is queued but never goes out.
+JOBS_EAGER = os.getenv('JOBS_EAGER', '') == '1'
+JOBS_CONCURRENCY = 4
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_BACKOFF = 10
+JOBS_RETRY_BACKOFF_MAX = 3600
+JOBS_LEASE = 300
+
+# Like counters: 'direct' updates Ads.total_likes on every like; 'buffered'
+# collects deltas in LikeCounterShard rows that `manage.py flush_like_counters`
+# folds in periodically, for ads that take many likes at once.
+ADS_LIKE_COUNTER = os.getenv('ADS_LIKE_COUNTER', 'direct')
+ADS_LIKE_COUNTER_SHARDS = 16
+# Seconds between the background flushes scheduled by buffered likes.
+ADS_LIKE_FLUSH_INTERVAL = 60
+
+# Live chat (chat.realtime) needs an ASGI server (uvicorn or daphne running
+# classifieds.asgi): set CHAT_ASGI=1 only there. Under WSGI (gunicorn) a
+# WebSocket can't connect and a long poll would hold a worker, so an open
+# conversation asks the database for new messages every CHAT_POLL_INTERVAL
+# seconds instead.
+CHAT_ASGI = os.getenv('CHAT_ASGI', '') == '1'
+CHAT_POLL_INTERVAL = 5
+# With CHAT_ASGI, events fan out in-process unless CHAT_BROKER_URL points at
+# a Redis-compatible server, needed once there is more than one ASGI process.
+# The last CHAT_BROKER_HISTORY events per chat are replayed to reconnecting
+# clients; long-poll requests wait up to CHAT_LONG_POLL_TIMEOUT seconds.
+CHAT_BROKER_URL = os.getenv('CHAT_BROKER_URL', '')
+CHAT_BROKER_HISTORY = 100
+CHAT_LONG_POLL_TIMEOUT = 25
+# With CHAT_ASGI, the header badge follows the unread-count stream
+# (Server-Sent Events), which sends a keepalive every CHAT_SSE_KEEPALIVE
+# seconds and closes after CHAT_SSE_TIMEOUT for the browser to reconnect.
+# Without it, the badge fetches the counts every CHAT_UNREAD_POLL_INTERVAL seconds.
+CHAT_SSE_KEEPALIVE = 15
+CHAT_SSE_TIMEOUT = 300
+CHAT_UNREAD_POLL_INTERVAL = 30
+
+# Request metrics (classifieds.metrics): query count, database, render and
+# cache figures per request, as a Server-Timing header while
+# METRICS_SERVER_TIMING is on and as a log line on the classifieds.metrics
+# logger at INFO. A view over its query_budget, or its QUERY_BUDGETS entry
+# (by URL name), logs a warning, or raises with QUERY_BUDGET_RAISE.
+METRICS_SERVER_TIMING = DEBUG
+QUERY_BUDGETS = {}
+QUERY_BUDGET_RAISE = TESTING
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'classifieds.metrics': {
+            'handlers': ['console'],
+            'level': os.getenv('METRICS_LOG_LEVEL', 'WARNING' if TESTING else 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -166,3 +315,23 @@ if 'DATABASE_URL' in os.environ:
         conn_max_age=500,
         conn_health_checks=True,
     )
+    if DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3':
+        DATABASES['default']['OPTIONS'] = sqlite.options()
+
+# Read replicas of the default database, from a comma separated list of URLs
+# in $DATABASE_REPLICA_URLS. Views with read_replica = True read from them;
+# see classifieds/replicas.py.
+DATABASE_REPLICAS = []
+for number, url in enumerate(filter(None, os.getenv('DATABASE_REPLICA_URLS', '').split(',')), 1):
+    alias = f'replica{number}'
+    DATABASES[alias] = dj_database_url.parse(url.strip(), conn_max_age=500, conn_health_checks=True)
+    # Tests run against the primary only.
+    DATABASES[alias]['TEST'] = {'MIRROR': 'default'}
+    if DATABASES[alias]['ENGINE'] == 'django.db.backends.sqlite3':
+        DATABASES[alias]['OPTIONS'] = sqlite.options()
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['classifieds.replicas.ReplicaRouter']
+# After a request writes, its client reads from the primary for this long.
+# Also the longest anonymous pages read from a replica stay cached, so set it
+# above the replication lag.
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '10'))
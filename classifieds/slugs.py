@@ -0,0 +1,140 @@
+"""
+Unique slugs for models with a ``unique=True`` slug field.
+
+``allocate_slug`` returns ``base`` if it is free and otherwise ``base-<n>``
+with the next free number. Finding the highest number in use takes a range
+scan of the slug's unique index (``base-`` < slug < ``base.``, since ``.``
+sorts right after ``-``), which grows with the number of clashing titles.
+So that scan only seeds a counter kept in the cache; later allocations for
+the same base just increment it, and the database is asked one indexed
+question: is ``base`` itself taken?
+
+The counter is a hint, the unique index is the authority: if the slug was
+taken meanwhile (a concurrent request, a cleared or per-process cache, a
+hand-written slug), the INSERT fails and ``UniqueSlugMixin`` allocates again
+from a fresh scan.
+"""
+import hashlib
+import re
+from collections import Counter
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.db.models.functions import Length
+from django.utils.text import slugify
+
+# Room left after the base for "-" and the counter.
+SUFFIX_LENGTH = 11
+MAX_RETRIES = 10
+COUNTER_TIMEOUT = 24 * 60 * 60
+
+
+def slug_base(model, value, field='slug'):
+    max_length = model._meta.get_field(field).max_length
+    return slugify(value)[:max_length - SUFFIX_LENGTH].strip('-') or model._meta.model_name
+
+
+def counter_key(model, field, base):
+    digest = hashlib.md5(base.encode()).hexdigest()
+    return f'slugs:{model._meta.label_lower}:{field}:{digest}'
+
+
+def last_number(model, base, field='slug', exclude_pk=None):
+    """The highest number in use for ``base``: 0 if free, 1 for ``base`` itself, n for ``base-n``."""
+    numbered = Q(**{
+        f'{field}__gt': f'{base}-',
+        f'{field}__lt': f'{base}.',
+        f'{field}__regex': rf'^{re.escape(base)}-[1-9][0-9]*$',
+    })
+    taken = model._default_manager.filter(Q(**{field: base}) | numbered)
+    if exclude_pk is not None:
+        taken = taken.exclude(pk=exclude_pk)
+    # Numbers without leading zeros sort by length first, then text.
+    last = taken.order_by(Length(field).desc(), f'-{field}').values_list(field, flat=True).first()
+    if last is None:
+        return 0
+    return 1 if last == base else int(last.rsplit('-', 1)[1])
+
+
+def allocate_slug(model, value, field='slug', exclude_pk=None, fresh=False):
+    base = slug_base(model, value, field)
+    key = counter_key(model, field, base)
+    manager = model._default_manager
+
+    if not fresh:
+        taken = manager.filter(**{field: base})
+        if exclude_pk is not None:
+            taken = taken.exclude(pk=exclude_pk)
+        if not taken.exists():
+            cache.set(key, 1, COUNTER_TIMEOUT)
+            return base
+        try:
+            return f'{base}-{cache.incr(key)}'
+        except ValueError:
+            pass
+
+    number = last_number(model, base, field, exclude_pk) + 1
+    cache.set(key, number, COUNTER_TIMEOUT)
+    return base if number == 1 else f'{base}-{number}'
+
+
+def allocate_slugs(model, values, field='slug', fresh=False, counters=None):
+    """
+    Slugs for new rows made from ``values``, in order, unique among
+    themselves and the table. ``counters``, a dict the caller keeps across
+    batches, holds the counters in memory as well as in the cache.
+    """
+    counters = {} if counters is None else counters
+    bases = [slug_base(model, value, field) for value in values]
+    repeated = Counter(bases)
+    taken = set(model._default_manager.filter(**{f'{field}__in': set(bases)}).values_list(field, flat=True))
+    keys = {base: counter_key(model, field, base) for base in repeated}
+    hints = {}
+    if not fresh:
+        hints = cache.get_many([keys[base] for base in repeated if base not in counters])
+        hints.update((keys[base], counters[base]) for base in repeated if base in counters)
+
+    numbers = {}
+    for base, count in repeated.items():
+        if base not in taken and count == 1:
+            numbers[base] = 0
+        elif keys[base] in hints:
+            numbers[base] = hints[keys[base]]
+        else:
+            numbers[base] = last_number(model, base, field)
+
+    slugs = []
+    for base in bases:
+        numbers[base] += 1
+        slugs.append(base if numbers[base] == 1 else f'{base}-{numbers[base]}')
+    counters.update(numbers)
+    cache.set_many({keys[base]: number for base, number in numbers.items()}, COUNTER_TIMEOUT)
+    return slugs
+
+
+class UniqueSlugMixin:
+    """
+    Model mixin filling an empty ``slug_field`` from ``slug_source`` on save,
+    retrying with a freshly scanned slug when the chosen one turned out taken.
+    """
+    slug_source = 'title'
+    slug_field = 'slug'
+
+    def save(self, *args, **kwargs):
+        if getattr(self, self.slug_field):
+            return super().save(*args, **kwargs)
+
+        model = type(self)
+        for attempt in range(MAX_RETRIES):
+            slug = allocate_slug(model, getattr(self, self.slug_source), self.slug_field,
+                                 exclude_pk=self.pk, fresh=attempt > 0)
+            setattr(self, self.slug_field, slug)
+            try:
+                with transaction.atomic(using=kwargs.get('using')):
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                setattr(self, self.slug_field, '')
+                if not model._default_manager.filter(**{self.slug_field: slug}).exclude(pk=self.pk).exists():
+                    raise
+        raise IntegrityError(f'Could not allocate a unique {self.slug_field} for {model.__name__}.')
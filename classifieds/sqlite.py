@@ -0,0 +1,84 @@
+"""
+Connection settings for running on SQLite with several worker processes.
+
+``options()`` builds the ``OPTIONS`` of a SQLite entry in ``DATABASES``
+from the environment. Every new connection runs the pragmas as its
+``init_command``:
+
+* ``SQLITE_JOURNAL_MODE`` (``WAL``): readers no longer wait for writers,
+  and a commit only appends to the log instead of rewriting pages.
+* ``SQLITE_SYNCHRONOUS`` (``NORMAL``): with WAL, fsync at checkpoints
+  rather than at every commit. A power cut can lose the last commits but
+  never corrupts the database.
+* ``SQLITE_MMAP_SIZE`` (256 MiB) and ``SQLITE_CACHE_SIZE`` (64 MiB, in
+  KiB when negative, as SQLite takes it): read pages through memory
+  mapping and keep more of them per connection.
+
+``SQLITE_BUSY_TIMEOUT`` (seconds, 20) is how long a writer waits for the
+lock before giving up with "database is locked". ``SQLITE_TRANSACTION_MODE``
+(``IMMEDIATE``) makes ``transaction.atomic()`` take the write lock when it
+begins. A deferred transaction that reads and then writes cannot wait for
+the lock, because another writer may have changed what it read, so SQLite
+fails it at once, whatever the timeout.
+
+Set a variable to an empty string to leave that setting at SQLite's default.
+"""
+import os
+
+from django.core.exceptions import ImproperlyConfigured
+
+DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'WAL',
+    'SQLITE_SYNCHRONOUS': 'NORMAL',
+    'SQLITE_MMAP_SIZE': str(256 * 1024 * 1024),
+    'SQLITE_CACHE_SIZE': str(-64 * 1024),
+    'SQLITE_BUSY_TIMEOUT': '20',
+    'SQLITE_TRANSACTION_MODE': 'IMMEDIATE',
+}
+JOURNAL_MODES = {'DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'}
+SYNCHRONOUS = {'OFF', 'NORMAL', 'FULL', 'EXTRA'}
+TRANSACTION_MODES = {'DEFERRED', 'IMMEDIATE', 'EXCLUSIVE'}
+
+
+def setting(environ, name):
+    return environ.get(name, DEFAULTS[name]).strip()
+
+
+def choice(environ, name, choices):
+    value = setting(environ, name).upper()
+    if value and value not in choices:
+        raise ImproperlyConfigured(f'{name} must be one of {", ".join(sorted(choices))}, not {value!r}.')
+    return value
+
+
+def number(environ, name, type=int):
+    value = setting(environ, name)
+    try:
+        return type(value) if value else None
+    except ValueError:
+        raise ImproperlyConfigured(f'{name} must be a number, not {value!r}.')
+
+
+def options(environ=os.environ):
+    pragmas = []
+    journal_mode = choice(environ, 'SQLITE_JOURNAL_MODE', JOURNAL_MODES)
+    if journal_mode:
+        pragmas.append(f'PRAGMA journal_mode={journal_mode}')
+    synchronous = choice(environ, 'SQLITE_SYNCHRONOUS', SYNCHRONOUS)
+    if synchronous:
+        pragmas.append(f'PRAGMA synchronous={synchronous}')
+    for name, pragma in (('SQLITE_MMAP_SIZE', 'mmap_size'), ('SQLITE_CACHE_SIZE', 'cache_size')):
+        value = number(environ, name)
+        if value is not None:
+            pragmas.append(f'PRAGMA {pragma}={value}')
+
+    result = {}
+    if pragmas:
+        result['init_command'] = ';'.join(pragmas)
+    timeout = number(environ, 'SQLITE_BUSY_TIMEOUT', float)
+    if timeout is not None:
+        result['timeout'] = timeout
+    transaction_mode = choice(environ, 'SQLITE_TRANSACTION_MODE', TRANSACTION_MODES)
+    if transaction_mode:
+        result['transaction_mode'] = transaction_mode
+    return result
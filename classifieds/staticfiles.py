@@ -0,0 +1,35 @@
+"""
+Serving collected static files.
+
+WhiteNoise's middleware is sync-only, and a single sync middleware makes
+Django run every request of the ASGI stack in a thread, long polls waiting
+on the chat broker included. ``WhiteNoiseMiddleware`` here is the same
+middleware, async-capable: under ASGI only a request for a static file goes
+to a thread, everything else is awaited straight through.
+"""
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from whitenoise import middleware
+
+
+class WhiteNoiseMiddleware(middleware.WhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve)(static_file, request)
+        return await self.get_response(request)
@@ -18,6 +18,7 @@ from django.contrib import admin
 from django.urls import path,include
 from django.conf import settings
 from django.conf.urls.static import static
+from classifieds.media import MediaView
 
 
 urlpatterns = [
@@ -25,10 +26,9 @@ urlpatterns = [
     path('account/', include('accounts.urls')),
     path('', include('ads.urls', namespace='ads')),
     path('chats/', include('chat.urls', namespace='chat')),
+    # Uploads, in production too: conditional GETs, ranges, sendfile or X-Accel-Redirect.
+    path(f"{settings.MEDIA_URL.strip('/')}/<path:path>", MediaView.as_view(), name='media'),
 ]
 
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-
 if settings.DEBUG:
     urlpatterns += static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
\ No newline at end of file
@@ -0,0 +1,20 @@
+from django.contrib import admin
+from django.utils import timezone
+from .models import Job
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'task', 'status', 'attempts', 'max_attempts', 'run_at', 'finished_at')
+    list_filter = ('status', 'task')
+    search_fields = ('task', 'idempotency_key')
+    ordering = ('-created_at',)
+    readonly_fields = ('created_at', 'started_at', 'finished_at', 'locked_until', 'last_error')
+    actions = ['retry_jobs']
+
+    @admin.action(description='Retry selected jobs now')
+    def retry_jobs(self, request, queryset):
+        count = queryset.exclude(status=Job.RUNNING).update(
+            status=Job.QUEUED, attempts=0, run_at=timezone.now(), locked_until=None, finished_at=None
+        )
+        self.message_user(request, f'{count} jobs queued again.')
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from jobs.queue import Worker
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'JOBS_CONCURRENCY', 4),
+                            help='Number of jobs run at the same time.')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='Run jobs in threads (I/O bound work) or processes (CPU bound work).')
+        parser.add_argument('--lease', type=int, default=getattr(settings, 'JOBS_LEASE', 300),
+                            help='Seconds before a job whose worker died is handed to another one.')
+        parser.add_argument('--poll-interval', type=float, default=1.0)
+        parser.add_argument('--burst', action='store_true',
+                            help='Exit once no job is due instead of waiting for more.')
+
+    def handle(self, *args, **options):
+        worker = Worker(
+            concurrency=options['concurrency'],
+            pool=options['pool'],
+            lease=options['lease'],
+            poll_interval=options['poll_interval'],
+        )
+        self.stdout.write(f"Worker started: {options['concurrency']} {options['pool']}s.")
+        processed = worker.run(burst=options['burst'])
+        self.stdout.write(self.style.SUCCESS(f'Worker stopped after {processed} jobs.'))
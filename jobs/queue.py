@@ -0,0 +1,263 @@
+"""
+A small database-backed job queue.
+
+Slow work is wrapped in a function decorated with ``@task`` and queued with
+``enqueue()``, which stores a ``Job`` row, inside the caller's transaction
+if there is one, so a job never runs for data that was rolled back.
+``manage.py runworker`` claims due jobs and runs them in a thread or process
+pool. A failing job is retried with exponential backoff until it runs out
+of attempts. The worker renews the lease of every job it is running; a job
+whose worker died is picked up again once its lease expires, unless that
+was its last attempt. A claim is identified by the job's ``started_at``, so
+a worker that lost its claim can't overwrite the outcome of the new one.
+
+With ``JOBS_EAGER = True`` jobs run in-process as soon as the transaction
+that queued them commits, which suits development and tests.
+"""
+import logging
+import random
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import timedelta
+from functools import partial
+
+import django
+from django.apps import apps
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+
+def task(func):
+    """Mark ``func`` as runnable by the worker and give it an ``enqueue`` shortcut."""
+    func.job_name = f'{func.__module__}.{func.__qualname__}'
+
+    def enqueue_func(**kwargs):
+        return enqueue(func, **kwargs)
+
+    func.enqueue = enqueue_func
+    return func
+
+
+def enqueue(func, key=None, delay=0, max_attempts=None, **kwargs):
+    """
+    Queue ``func(**kwargs)``; ``kwargs`` must be JSON serializable. With a
+    ``key``, queueing is idempotent: while a job with that key exists, the
+    existing job is returned instead of adding another.
+    """
+    name = func if isinstance(func, str) else func.job_name
+    fields = {
+        'task': name,
+        'kwargs': kwargs,
+        'run_at': timezone.now() + timedelta(seconds=delay),
+        'max_attempts': max_attempts or getattr(settings, 'JOBS_MAX_ATTEMPTS', 5),
+    }
+    if key is None:
+        job = Job.objects.create(**fields)
+        created = True
+    else:
+        try:
+            with transaction.atomic():
+                job, created = Job.objects.get_or_create(idempotency_key=key, defaults=fields)
+        except IntegrityError:
+            job, created = Job.objects.get(idempotency_key=key), False
+
+    if created and getattr(settings, 'JOBS_EAGER', False) and not delay:
+        # Not before the rows the job reads are committed.
+        transaction.on_commit(partial(run_eagerly, job))
+    return job
+
+
+def run_eagerly(job):
+    started_at = claim_job(job.pk, getattr(settings, 'JOBS_LEASE', 300))
+    if started_at:
+        execute(job.pk, started_at)
+        job.refresh_from_db()
+
+
+def backoff(attempts):
+    """Seconds to wait before retry number ``attempts``: doubling, capped and jittered."""
+    base = getattr(settings, 'JOBS_RETRY_BACKOFF', 10)
+    limit = getattr(settings, 'JOBS_RETRY_BACKOFF_MAX', 3600)
+    delay = min(base * 2 ** (attempts - 1), limit)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def abandoned_jobs(now):
+    # Running jobs whose worker stopped renewing the lease.
+    return Job.objects.filter(status=Job.RUNNING, locked_until__lt=now)
+
+
+def due_jobs(now):
+    # Queued jobs whose time has come, and abandoned ones with attempts left.
+    return Job.objects.filter(
+        Q(status=Job.QUEUED, run_at__lte=now)
+        | Q(status=Job.RUNNING, locked_until__lt=now, attempts__lt=F('max_attempts'))
+    )
+
+
+def fail_abandoned(now):
+    """Give up on abandoned jobs that were on their last attempt."""
+    return abandoned_jobs(now).filter(attempts__gte=F('max_attempts')).update(
+        status=Job.FAILED,
+        locked_until=None,
+        finished_at=now,
+        last_error='The worker running the last attempt stopped renewing its lease.',
+    )
+
+
+def claim_job(pk, lease):
+    """
+    Atomically move one due job to running. Returns the claim's start time,
+    which identifies it, or None if another worker got the job first.
+    """
+    now = timezone.now()
+    claimed = due_jobs(now).filter(pk=pk).update(
+        status=Job.RUNNING,
+        attempts=F('attempts') + 1,
+        started_at=now,
+        locked_until=now + timedelta(seconds=lease),
+    )
+    return now if claimed else None
+
+
+def claim_many(limit, lease):
+    """Claim up to ``limit`` due jobs, oldest first; returns ``{id: start time}``."""
+    now = timezone.now()
+    fail_abandoned(now)
+    candidates = due_jobs(now).order_by('run_at', 'id').values_list('pk', flat=True)[:limit]
+    # The conditional UPDATE in claim_job is the lock: it works the same on
+    # SQLite and PostgreSQL and never hands a job to two workers.
+    claims = {pk: claim_job(pk, lease) for pk in list(candidates)}
+    return {pk: started_at for pk, started_at in claims.items() if started_at}
+
+
+def renew(claims, lease):
+    """Extend the lease of the claims in ``{id: start time}`` that are still held."""
+    locked_until = timezone.now() + timedelta(seconds=lease)
+    condition = Q()
+    for pk, started_at in claims.items():
+        condition |= Q(pk=pk, started_at=started_at)
+    if condition:
+        Job.objects.filter(condition, status=Job.RUNNING).update(locked_until=locked_until)
+
+
+def execute(pk, started_at=None):
+    """
+    Run a claimed job and record the outcome. Returns the job's new status,
+    or None if the job was claimed again meanwhile (its lease expired) and
+    the outcome was dropped. ``started_at`` identifies the claim; by default
+    the job's current one.
+    """
+    job = Job.objects.get(pk=pk)
+    if started_at is None:
+        started_at = job.started_at
+    if job.status != Job.RUNNING or job.started_at != started_at:
+        return None
+    try:
+        func = import_string(job.task)
+        if not hasattr(func, 'job_name'):
+            raise TypeError(f'{job.task} is not a task.')
+        func(**job.kwargs)
+    except Exception:
+        job.last_error = traceback.format_exc()
+        job.locked_until = None
+        if job.attempts >= job.max_attempts:
+            job.status = Job.FAILED
+            job.finished_at = timezone.now()
+        else:
+            job.status = Job.QUEUED
+            job.run_at = timezone.now() + timedelta(seconds=backoff(job.attempts))
+    else:
+        job.status = Job.SUCCEEDED
+        job.finished_at = timezone.now()
+        job.locked_until = None
+        job.last_error = ''
+    fields = ['status', 'run_at', 'locked_until', 'last_error', 'finished_at']
+    recorded = Job.objects.filter(pk=pk, status=Job.RUNNING, started_at=started_at).update(
+        **{field: getattr(job, field) for field in fields}
+    )
+    if not recorded:
+        logger.warning('Job %s ran past its lease and was claimed again; dropped its outcome.', pk)
+        return None
+    return job.status
+
+
+def run_in_worker(pk, started_at):
+    try:
+        return execute(pk, started_at)
+    finally:
+        close_old_connections()
+
+
+def setup_process():
+    # Spawned processes start from a bare interpreter; forked ones are already set up.
+    if not apps.ready:
+        django.setup()
+
+
+class Worker:
+    """Claims due jobs and keeps up to ``concurrency`` of them running in a pool."""
+
+    def __init__(self, concurrency=4, pool='thread', lease=300, poll_interval=1.0):
+        self.concurrency = concurrency
+        self.pool = pool
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.processed = 0
+
+    def executor(self):
+        if self.pool == 'process':
+            # Each process must open its own connections, not share the parent's sockets.
+            connections.close_all()
+            return ProcessPoolExecutor(max_workers=self.concurrency, initializer=setup_process)
+        return ThreadPoolExecutor(max_workers=self.concurrency)
+
+    def run(self, burst=False):
+        """Process jobs until interrupted, or until the queue is empty with ``burst``."""
+        # Future -> (job id, claim start time) of every job in the pool.
+        running = {}
+        # Renew well before the lease runs out, so a slow query can't lose it.
+        renew_every = self.lease / 3
+        renewed_at = time.monotonic()
+        with self.executor() as pool:
+            try:
+                while True:
+                    free = self.concurrency - len(running)
+                    claimed = claim_many(free, self.lease) if free else {}
+                    if running and time.monotonic() - renewed_at >= renew_every:
+                        renew(dict(running.values()), self.lease)
+                        renewed_at = time.monotonic()
+                    close_old_connections()
+                    for pk, started_at in claimed.items():
+                        running[pool.submit(run_in_worker, pk, started_at)] = (pk, started_at)
+
+                    if not running:
+                        if burst:
+                            return self.processed
+                        time.sleep(self.poll_interval)
+                        continue
+
+                    # Wake up for new jobs while a slot is free, otherwise when one
+                    # finishes or the leases are due for renewal.
+                    timeout = self.poll_interval if len(running) < self.concurrency else renew_every
+                    done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        del running[future]
+                        try:
+                            future.result()
+                        except Exception:
+                            # The job could not even be recorded; its lease expiring will retry it.
+                            logger.exception('Job bookkeeping failed')
+                        self.processed += 1
+            except KeyboardInterrupt:
+                # Let the running jobs finish; anything not started stays queued.
+                wait(running)
+                return self.processed
@@ -0,0 +1,8 @@
+from django.core.mail import send_mail
+
+from .queue import task
+
+
+@task
+def send_email(subject, message, from_email, recipient_list, html_message=None):
+    send_mail(subject, message, from_email, recipient_list, html_message=html_message)
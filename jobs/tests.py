@@ -0,0 +1,258 @@
+import io
+import json
+import re
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Job
+from .queue import Worker, claim_many, enqueue, execute, renew, task
+
+calls = []
+
+
+@task
+def record(value):
+    calls.append(value)
+
+
+@task
+def explode():
+    raise RuntimeError('boom')
+
+
+@task
+def nap(seconds):
+    time.sleep(seconds)
+    calls.append(seconds)
+
+
+@task
+def outlive_lease():
+    # Another worker takes the job over while this one is still running it.
+    job = Job.objects.get(task='jobs.tests.outlive_lease')
+    Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+    calls.append(list(claim_many(1, lease=60)))
+
+
+def not_a_task():
+    calls.append('ran')
+
+
+class EnqueueTests(TestCase):
+
+    def setUp(self):
+        calls.clear()
+
+    def test_enqueue_stores_a_due_job(self):
+        job = record.enqueue(value=1)
+
+        self.assertEqual(job.task, 'jobs.tests.record')
+        self.assertEqual(job.kwargs, {'value': 1})
+        self.assertEqual(job.status, Job.QUEUED)
+        self.assertLessEqual(job.run_at, timezone.now())
+        self.assertEqual(calls, [])
+
+    def test_idempotency_key_returns_the_existing_job(self):
+        first = record.enqueue(key='only-once', value=1)
+        second = record.enqueue(key='only-once', value=2)
+
+        self.assertEqual(first.pk, second.pk)
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_delay(self):
+        record.enqueue(delay=60, value=1)
+        self.assertEqual(list(claim_many(10, lease=60)), [])
+
+    @override_settings(JOBS_EAGER=True)
+    def test_eager_mode_runs_once_committed(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                job = enqueue('jobs.tests.record', value='now')
+                self.assertEqual(calls, [])
+
+        self.assertEqual(calls, ['now'])
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.attempts, 1)
+
+    @override_settings(JOBS_EAGER=True)
+    def test_eager_mode_skips_rolled_back_jobs(self):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    enqueue('jobs.tests.record', value='never')
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+
+        self.assertEqual(callbacks, [])
+        self.assertEqual(calls, [])
+
+
+class ExecuteTests(TestCase):
+
+    def setUp(self):
+        calls.clear()
+
+    def run_due(self):
+        return [execute(pk) for pk in claim_many(10, lease=60)]
+
+    def test_success(self):
+        job = record.enqueue(value='done')
+
+        self.assertEqual(self.run_due(), [Job.SUCCEEDED])
+        job.refresh_from_db()
+        self.assertEqual(calls, ['done'])
+        self.assertEqual(job.attempts, 1)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_a_job_is_claimed_once(self):
+        record.enqueue(value=1)
+        self.assertEqual(len(claim_many(10, lease=60)), 1)
+        self.assertEqual(list(claim_many(10, lease=60)), [])
+
+    @override_settings(JOBS_RETRY_BACKOFF=10)
+    def test_failures_are_retried_with_backoff(self):
+        job = explode.enqueue(max_attempts=3)
+        delays = []
+        for attempt in range(1, 3):
+            before = timezone.now()
+            self.assertEqual(self.run_due(), [Job.QUEUED])
+            job.refresh_from_db()
+            self.assertIn('RuntimeError: boom', job.last_error)
+            delays.append((job.run_at - before).total_seconds())
+            Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+
+        self.assertTrue(5 <= delays[0] <= 10.5, delays)
+        self.assertTrue(10 <= delays[1] <= 20.5, delays)
+
+        self.assertEqual(self.run_due(), [Job.FAILED])
+        job.refresh_from_db()
+        self.assertEqual(job.attempts, 3)
+        self.assertIsNotNone(job.finished_at)
+
+    def test_only_tasks_can_run(self):
+        enqueue('jobs.tests.not_a_task', max_attempts=1)
+
+        self.assertEqual(self.run_due(), [Job.FAILED])
+        self.assertEqual(calls, [])
+
+    def test_expired_lease_is_reclaimed(self):
+        job = record.enqueue(value=1)
+        claim_many(10, lease=60)
+        self.assertEqual(list(claim_many(10, lease=60)), [])
+
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(list(claim_many(10, lease=60)), [job.pk])
+        self.assertEqual(Job.objects.get(pk=job.pk).attempts, 2)
+
+    def test_expired_lease_on_the_last_attempt_fails_the_job(self):
+        job = record.enqueue(max_attempts=1, value=1)
+        claim_many(10, lease=60)
+
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(list(claim_many(10, lease=60)), [])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.FAILED)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('lease', job.last_error)
+
+    def test_renew_extends_only_held_claims(self):
+        job = record.enqueue(value=1)
+        started_at = claim_many(10, lease=1)[job.pk]
+        soon = Job.objects.get(pk=job.pk).locked_until
+
+        renew({job.pk: started_at - timedelta(seconds=1)}, lease=60)
+        self.assertEqual(Job.objects.get(pk=job.pk).locked_until, soon)
+
+        renew({job.pk: started_at}, lease=60)
+        self.assertGreater(Job.objects.get(pk=job.pk).locked_until, soon + timedelta(seconds=30))
+
+    def test_outcome_of_a_lost_claim_is_dropped(self):
+        job = outlive_lease.enqueue()
+        started_at = claim_many(10, lease=60)[job.pk]
+
+        with self.assertLogs('jobs.queue', 'WARNING'):
+            self.assertIsNone(execute(job.pk, started_at))
+        self.assertEqual(calls, [[job.pk]])
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.RUNNING)
+        self.assertEqual(job.attempts, 2)
+        self.assertNotEqual(job.started_at, started_at)
+
+        # The old claim can't start the job either.
+        self.assertIsNone(execute(job.pk, started_at))
+        self.assertEqual(len(calls), 1)
+
+
+class QueuedPasswordResetTests(TestCase):
+
+    def test_reset_mail_is_sent_by_a_job(self):
+        User.objects.create_user(username='forgetful', email='forgetful@example.com', password='password')
+
+        response = self.client.post(reverse('password_reset'), {'email': 'forgetful@example.com'})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(mail.outbox, [])
+        job = Job.objects.get(task='accounts.tasks.send_password_reset_email')
+
+        claim_many(1, lease=60)
+        execute(job.pk)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['forgetful@example.com'])
+        link = re.search(r'://testserver(/\S+/reset/\S+)', mail.outbox[0].body).group(1)
+        response = self.client.get(link, follow=True)
+        self.assertTrue(response.context['validlink'])
+
+    def test_the_queued_job_holds_no_token(self):
+        user = User.objects.create_user(username='forgetful', email='forgetful@example.com', password='password')
+
+        self.client.post(reverse('password_reset'), {'email': 'forgetful@example.com'})
+
+        job = Job.objects.get()
+        self.assertEqual(job.kwargs['user_id'], user.pk)
+        serialized = json.dumps(job.kwargs)
+        self.assertNotIn('/reset/', serialized)
+        self.assertNotIn('token', serialized)
+
+
+class RunWorkerTests(TransactionTestCase):
+
+    def setUp(self):
+        calls.clear()
+
+    def test_burst_runs_all_due_jobs(self):
+        for value in range(5):
+            record.enqueue(value=value)
+        explode.enqueue(max_attempts=1)
+        record.enqueue(delay=3600, value='later')
+
+        out = io.StringIO()
+        call_command('runworker', burst=True, concurrency=2, poll_interval=0.01, stdout=out)
+
+        self.assertIn('Worker stopped after 6 jobs.', out.getvalue())
+        self.assertEqual(sorted(calls), [0, 1, 2, 3, 4])
+        self.assertEqual(Job.objects.filter(status=Job.SUCCEEDED).count(), 5)
+        self.assertEqual(Job.objects.filter(status=Job.FAILED).count(), 1)
+        self.assertEqual(Job.objects.filter(status=Job.QUEUED).count(), 1)
+
+    def test_worker_renews_the_lease_of_slow_jobs(self):
+        job = nap.enqueue(seconds=0.6)
+
+        Worker(concurrency=2, lease=0.3, poll_interval=0.01).run(burst=True)
+
+        job.refresh_from_db()
+        self.assertEqual(calls, [0.6])
+        self.assertEqual(job.status, Job.SUCCEEDED)
+        self.assertEqual(job.attempts, 1)
+
+    def test_worker_processes_count(self):
+        record.enqueue(value=1)
+        self.assertEqual(Worker(concurrency=1, poll_interval=0.01).run(burst=True), 1)